@@ -0,0 +1,146 @@
+import asyncio
+import datetime
+import time
+import uuid
+
+from elastic_interface import ElasticAPI, _elasticsearch
+
+
+def _async_client_class():
+    try:
+        from elasticsearch import AsyncElasticsearch
+    except ImportError as ex:
+        raise ImportError("AsyncElasticsearch is not available, "
+                          "install the optional async dependencies with: pip install -r reqs-async.txt") from ex
+    return AsyncElasticsearch
+
+
+class AsyncElasticAPI(ElasticAPI):
+    """ElasticAPI variant with coroutine methods built on AsyncElasticsearch, created on the first use of es"""
+
+    def _create_client(self):
+        return _async_client_class()(**self._client_options)
+
+    async def push(self, data_dict, doc_id=None):
+        ts = datetime.datetime.utcnow()
+        data_dict.update({'timestamp': ts})
+        res = await self.es.index(index=self.es_index, id=doc_id or uuid.uuid1(), body=data_dict, request_timeout=10)
+        return res["_shards"]["successful"] == 1
+
+    async def bulk_push(self, generator):
+        """
+        Pushes the documents in chunks, at most bulk_workers requests are awaited concurrently and
+        at most bulk_queue_size more chunks are prepared in advance. Documents rejected with 429
+        are retried with exponential backoff, returns (success count, errors).
+        """
+        return await self.bulk_push_lines(self._serialize_actions(self.process_generator(generator)))
+
+    async def bulk_push_lines(self, lines):
+        """same as bulk_push, but takes already serialized (action line, data line) pairs of bytes"""
+        async def single_block():
+            yield lines
+        return await self.bulk_push_blocks(single_block())
+
+    async def bulk_push_blocks(self, blocks):
+        """
+        same as bulk_push_lines, but takes an async iterator of blocks of (action line, data line) pairs,
+        so the blocks can be serialized outside of the event loop, every block is chunked on its own,
+        the time spent waiting for the blocks is counted to serialize_s
+        """
+        self._reset_bulk_stats()
+        success = 0
+        errors = list()
+        semaphore = asyncio.Semaphore(self.bulk_workers)
+        tic = time.perf_counter()
+        in_flight = set()
+        blocks = blocks.__aiter__()
+        while True:
+            wait_tic = time.perf_counter()
+            try:
+                block = await blocks.__anext__()
+            except StopAsyncIteration:
+                break
+            self.bulk_stats['serialize_s'] += time.perf_counter() - wait_tic
+            for chunk in self._chunk_lines(block):
+                if len(in_flight) >= self.bulk_workers + self.bulk_queue_size:
+                    wait_tic = time.perf_counter()
+                    done, in_flight = await asyncio.wait(in_flight, return_when=asyncio.FIRST_COMPLETED)
+                    self.bulk_stats['backpressure_s'] += time.perf_counter() - wait_tic
+                    for task in done:
+                        chunk_success, chunk_errors = task.result()
+                        success += chunk_success
+                        errors.extend(chunk_errors)
+                in_flight.add(asyncio.ensure_future(self._send_chunk(chunk, semaphore)))
+
+        for chunk_success, chunk_errors in await asyncio.gather(*in_flight):
+            success += chunk_success
+            errors.extend(chunk_errors)
+
+        self.bulk_stats['elapsed_s'] = time.perf_counter() - tic
+        self.bulk_stats['failed'] = len(errors)
+        if errors:
+            raise _elasticsearch().helpers.BulkIndexError(f"{len(errors)} document(s) failed to index.", errors)
+        return success, errors
+
+    async def _send_chunk(self, chunk, semaphore):
+        """sends the chunk, retries only the documents rejected with 429"""
+        success = 0
+        errors = list()
+        for attempt in range(self.max_retries + 1):
+            body = self._chunk_body(chunk)
+            self.bulk_stats['bytes'] += len(body)
+            self.bulk_stats['chunks'] += 1
+            try:
+                async with semaphore:
+                    tic = time.perf_counter()
+                    try:
+                        resp = await self.es.bulk(body=body)
+                    finally:
+                        self.bulk_stats['latencies_s'].append(time.perf_counter() - tic)
+                items = resp['items']
+            except _elasticsearch().TransportError as ex:
+                if ex.status_code != 429:
+                    raise
+                items = [{'index': {'status': 429, 'error': str(ex)}}] * len(chunk)
+
+            chunk_success, chunk_errors, rejected = self._classify_items(chunk, items)
+            success += chunk_success
+            errors.extend(chunk_errors)
+
+            if not rejected:
+                break
+            if attempt == self.max_retries:
+                errors.extend(item for _, item in rejected)
+                break
+
+            self.bulk_stats['retries'] += len(rejected)
+            await asyncio.sleep(self._backoff(attempt))
+            chunk = [lines for lines, _ in rejected]
+
+        self.bulk_stats['docs'] += success
+        return success, errors
+
+    async def index_exists(self):
+        exists = await self.es.indices.exists(index=self.es_index)
+        if not exists:
+            raise ValueError(f"{self.es_index} does not exist!")
+        return exists
+
+    async def trip_exists(self, trip_id):
+        query = {"query": {"term": {"trip_id": trip_id}}}
+        try:
+            res = await self.es.search(index=self.es_index, body=query, size=0, terminate_after=1, request_timeout=5)
+            return self._total_hits(res) > 0
+
+        except (_elasticsearch().ConnectionError, _elasticsearch().ConnectionTimeout) as ex:
+            self.log.exception(ex)
+            self.log.error("Connection to ES server failed!")
+            return None
+
+    async def should_ingest(self, trip_id):
+        """checks the index and whether the trip is already in it, True if the trip can be ingested"""
+        await self.index_exists()
+        return self.ingest_allowed(trip_id, await self.trip_exists(trip_id))
+
+    async def close(self):
+        await self.es.close()
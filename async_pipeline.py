@@ -0,0 +1,144 @@
+import asyncio
+import collections
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from async_elastic_interface import AsyncElasticAPI
+from batch_tracker import BatchTripTracker, process_file
+from trip_tracker import GpxTripTracker
+
+
+def encode_block(tracker_options, track_pts, odo, stops, trip_type, first_point_id):
+    """worker of the process pool, serializes the bulk lines of a block of the processed trip"""
+    tracker = GpxTripTracker(**tracker_options)
+    tracker.stops = stops
+    return list(tracker.document_lines(track_pts, odo, trip_type, first_point_id))
+
+
+class AsyncBatchTripTracker(BatchTripTracker):
+    """
+    Batch variant overlapping CPU and I/O: parsing and odometry run in a process pool executor,
+    processed trips go through a bounded queue to concurrent writers ingesting with AsyncElasticsearch.
+    The documents are serialized in the executor in blocks of one bulk chunk, so the event loop only sends them.
+    """
+
+    def __init__(self, *args, writers=2, queue_size=2, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.writers = writers
+        self.queue_size = queue_size
+        self.async_es = None
+
+    async def _produce(self, executor, pending, queue):
+        """
+        submits the files to the executor as the slots free up and queues the results as they complete,
+        at most jobs + queue_size files are being processed or wait for a free place in the queue
+        """
+        loop = asyncio.get_running_loop()
+        slots = asyncio.Semaphore(self.jobs + self.queue_size)
+
+        async def process(gpx_file):
+            try:
+                result = await loop.run_in_executor(executor, process_file, self.transport_mode, gpx_file,
+                                                    self.ref_file_path, self.cache, self.rebuild_cache,
+                                                    self.simplify_tolerance_m, self.distance_model,
+                                                    self.corrected_dir, self.detect_stops)
+                await queue.put((gpx_file, ) + result)
+            except Exception as ex:
+                self.log.exception(ex)
+            finally:
+                slots.release()
+
+        tasks = list()
+        for gpx_file in pending:
+            await slots.acquire()
+            tasks.append(asyncio.ensure_future(process(gpx_file)))
+        await asyncio.gather(*tasks)
+        for _ in range(self.writers):
+            await queue.put(None)
+
+    async def _write(self, executor, queue, summaries):
+        """ingests the queued trips until the end marker is received"""
+        while True:
+            result = await queue.get()
+            if result is None:
+                return
+            gpx_file, track_pts, odo, stops, timings = result
+            summary = {'trip_id': gpx_file.stem}
+            try:
+                summary.update(await self.ingest_async(executor, gpx_file, track_pts, odo, stops, timings))
+                summary.update(timings)
+                summary.update({'points': len(track_pts), 'status': 'ok'})
+            except Exception as ex:
+                self.log.exception(ex)
+                summary['status'] = 'failed'
+            summaries[gpx_file] = summary
+
+    async def ingest_async(self, executor, gpx_file, track_pts, odo, stops, timings):
+        """async counterpart of BatchTripTracker.ingest, the documents are serialized in the executor"""
+        tracker_options = dict(self.tracker_options, transport_mode=self.transport_mode, track_file_path=gpx_file,
+                               index=self.index)
+        tracker = GpxTripTracker(**tracker_options)
+        tracker.stops = stops
+        tic = time.perf_counter()
+        global_message = tracker.summarize(track_pts, odo)
+        if self.index is None:
+            return global_message
+
+        elastic = AsyncElasticAPI(index=self.index, es=self.async_es, **self.bulk_options)
+        if self.trips_checked or await elastic.should_ingest(global_message['trip_id']):
+            await elastic.push(dict(global_message), doc_id=global_message['trip_id'])
+            blocks = self._encode_blocks(executor, elastic, tracker_options, track_pts, odo, stops,
+                                         global_message['trip_type'])
+            await elastic.bulk_push_blocks(blocks)
+            timings['docs_per_s'] = elastic.bulk_stats['docs'] / elastic.bulk_stats['elapsed_s']
+            timings['retries'] = elastic.bulk_stats['retries']
+        timings['ingest_s'] = time.perf_counter() - tic
+        return global_message
+
+    async def _encode_blocks(self, executor, elastic, tracker_options, track_pts, odo, stops, trip_type):
+        """
+        yields the serialized blocks of the trip, the point layout is split into blocks of chunk_size points
+        serialized ahead by up to bulk_workers + bulk_queue_size executor calls, the other layouts and the stops
+        need the whole track and are serialized by a single call
+        """
+        loop = asyncio.get_running_loop()
+        if tracker_options['layout'] != 'point':
+            yield await loop.run_in_executor(executor, encode_block, tracker_options, track_pts, odo, stops,
+                                             trip_type, 1)
+            return
+
+        starts = range(0, len(track_pts), elastic.chunk_size)
+        pending = collections.deque()
+        for start in starts:
+            end = start + elastic.chunk_size
+            block_stops = stops if end >= len(track_pts) else None
+            pending.append(loop.run_in_executor(executor, encode_block, tracker_options, track_pts[start:end],
+                                                odo[start:end], block_stops, trip_type, start + 1))
+            if len(pending) > elastic.bulk_workers + elastic.bulk_queue_size:
+                yield await pending.popleft()
+        while pending:
+            yield await pending.popleft()
+
+    async def run_async(self):
+        tic = time.perf_counter()
+        pending, summaries = self.preflight()
+        if self.index is not None:
+            self.async_es = AsyncElasticAPI(index=self.index, maxsize=self.jobs, **self.bulk_options).es
+        queue = asyncio.Queue(maxsize=self.queue_size)
+        try:
+            with ProcessPoolExecutor(max_workers=self.jobs) as executor:
+                await asyncio.gather(self._produce(executor, pending, queue),
+                                     *(self._write(executor, queue, summaries) for _ in range(self.writers)))
+        finally:
+            if self.async_es is not None:
+                await self.async_es.close()
+
+        elapsed = time.perf_counter() - tic
+        summaries = [summaries.get(gpx_file, {'trip_id': gpx_file.stem, 'status': 'failed'})
+                     for gpx_file in self.gpx_files]
+        self.log.info(f'Processed {len(summaries)} files in {elapsed:.2f} s using {self.jobs} jobs '
+                      f'and {self.writers} async writers')
+        return summaries
+
+    def run(self):
+        return asyncio.run(self.run_async())
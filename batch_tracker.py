@@ -0,0 +1,208 @@
+import os
+import glob
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from utils import OUTPUT_DIR, str2path, simple_logger
+from elastic_interface import ElasticAPI
+from trip_tracker import GpxTripTracker, add_processing_arguments
+from track_cache import TrackCache
+from ndjson_serializer import TrackChunkEncoder
+
+
+SUMMARY_COLUMNS = [('trip_id', 24, '{}'), ('trip_type', 10, '{}'), ('points', 9, '{}'),
+                   ('trip_length_km', 15, '{:.2f}'), ('trip_duration_h', 16, '{:.2f}'),
+                   ('read_s', 8, '{:.2f}'), ('correct_s', 10, '{:.2f}'), ('odometry_s', 11, '{:.2f}'),
+                   ('ingest_s', 9, '{:.2f}'), ('docs_per_s', 11, '{:.0f}'), ('retries', 8, '{}'),
+                   ('status', 10, '{}')]
+
+
+def collect_files(gpx_path):
+    """
+    returns sorted GPX files of the directory or the files matching the glob pattern,
+    the corrected files written by the previous runs are not trips of their own and are skipped
+    """
+    path = str2path(gpx_path)
+    if path.is_dir():
+        files = path.glob('*.gpx')
+    else:
+        files = (str2path(file_path) for file_path in glob.glob(gpx_path))
+    return sorted(file_path for file_path in files if not file_path.stem.endswith(GpxTripTracker.CORRECTED_SUFFIX))
+
+
+def process_file(transport_mode, gpx_file, ref_file=None, cache=None, rebuild_cache=False, simplify_tolerance_m=None,
+                 distance_model='vincenty', corrected_dir=OUTPUT_DIR, detect_stops=False):
+    """
+    worker of the process pool, parses the file and computes odometry and stops without ingesting it,
+    the corrected track is written to corrected_dir, so it is not collected as a trip by the next batch
+    """
+    tracker = GpxTripTracker(transport_mode, gpx_file, ref_file, cache=cache, rebuild_cache=rebuild_cache,
+                             simplify_tolerance_m=simplify_tolerance_m, distance_model=distance_model,
+                             corrected_dir=corrected_dir, detect_stops=detect_stops)
+    track_pts, odo = tracker.process()
+    return track_pts, odo, tracker.stops, tracker.timings
+
+
+class BatchTripTracker:
+    """processes many GPX files in a process pool and ingests the results with a single shared ES client"""
+
+    def __init__(self, transport_mode, gpx_files, ref_file_path=None, jobs=None, index=None,
+                 host='localhost', port=9200, cache=None, rebuild_cache=False, simplify_tolerance_m=None,
+                 distance_model='vincenty', corrected_dir=OUTPUT_DIR, detect_stops=False, fast_serialization=False,
+                 layout='point', layout_chunk_size=1000, **bulk_options):
+        self.transport_mode = transport_mode
+        self.gpx_files = gpx_files
+        self.ref_file_path = ref_file_path
+        self.jobs = jobs or os.cpu_count()
+        self.index = index
+        self.cache = cache
+        self.rebuild_cache = rebuild_cache
+        self.simplify_tolerance_m = simplify_tolerance_m
+        self.distance_model = distance_model
+        self.corrected_dir = corrected_dir
+        self.detect_stops = detect_stops
+        self.tracker_options = {'fast_serialization': fast_serialization, 'layout': layout,
+                                'layout_chunk_size': layout_chunk_size}
+        self.bulk_options = bulk_options
+        self.elastic = ElasticAPI(index=index, host=host, port=port, maxsize=self.jobs, **bulk_options)
+        self.trips_checked = False
+        self.log = simple_logger()
+
+    def ingest(self, gpx_file, track_pts, odo, stops, timings):
+        """ingests the processed file using the shared ES client"""
+        tracker = GpxTripTracker(self.transport_mode, gpx_file, self.ref_file_path, index=self.index,
+                                 es=self.elastic.es if self.index is not None else None,
+                                 **self.tracker_options, **self.bulk_options)
+        tracker.stops = stops
+        tic = time.perf_counter()
+        overview = tracker.ingest(track_pts, odo, checked=self.trips_checked)
+        timings['ingest_s'] = time.perf_counter() - tic
+        if tracker.bulk_stats.get('elapsed_s'):
+            timings['docs_per_s'] = tracker.bulk_stats['docs'] / tracker.bulk_stats['elapsed_s']
+            timings['retries'] = tracker.bulk_stats['retries']
+        return overview
+
+    def preflight(self):
+        """
+        checks all the trips in one request, returns the files that are not yet ingested and summaries of the rest,
+        trips_checked is set if the check succeeded, so the ingest does not check the trips again
+        """
+        if self.index is None:
+            return self.gpx_files, dict()
+
+        self.elastic.index_exists()
+        if self.tracker_options['layout'] != 'point':
+            self.elastic.check_mapping(TrackChunkEncoder.MAPPINGS)
+        existing = self.elastic.existing_trips(gpx_file.stem for gpx_file in self.gpx_files)
+        self.trips_checked = existing is not None
+        if existing is None:
+            self.log.error("Trip ID query failed, every trip will be checked during ingest")
+            return self.gpx_files, dict()
+
+        pending = [gpx_file for gpx_file in self.gpx_files if gpx_file.stem not in existing]
+        skipped = {gpx_file: {'trip_id': gpx_file.stem, 'status': 'exists'}
+                   for gpx_file in self.gpx_files if gpx_file.stem in existing}
+        if skipped:
+            self.log.warning(f"{len(skipped)} trips already exist in the index, skipping them")
+        return pending, skipped
+
+    def run(self):
+        """runs the batch, returns the summaries of the files in the input order"""
+        tic = time.perf_counter()
+        pending, summaries = self.preflight()
+        with ProcessPoolExecutor(max_workers=self.jobs) as executor:
+            futures = {executor.submit(process_file, self.transport_mode, gpx_file, self.ref_file_path,
+                                       self.cache, self.rebuild_cache, self.simplify_tolerance_m,
+                                       self.distance_model, self.corrected_dir, self.detect_stops): gpx_file
+                       for gpx_file in pending}
+            for future in as_completed(futures):
+                gpx_file = futures[future]
+                summary = {'trip_id': gpx_file.stem}
+                try:
+                    track_pts, odo, stops, timings = future.result()
+                    summary.update(self.ingest(gpx_file, track_pts, odo, stops, timings))
+                    summary.update(timings)
+                    summary.update({'points': len(track_pts), 'status': 'ok'})
+                except Exception as ex:
+                    self.log.exception(ex)
+                    summary['status'] = 'failed'
+                summaries[gpx_file] = summary
+
+        elapsed = time.perf_counter() - tic
+        summaries = [summaries[gpx_file] for gpx_file in self.gpx_files]
+        self.log.info(f'Processed {len(summaries)} files in {elapsed:.2f} s using {self.jobs} jobs')
+        return summaries
+
+    @staticmethod
+    def format_summary(summaries):
+        """formats the summaries as a table"""
+        lines = [' '.join(name.ljust(width) for name, width, _ in SUMMARY_COLUMNS)]
+        for summary in summaries:
+            cells = list()
+            for name, width, fmt in SUMMARY_COLUMNS:
+                value = summary.get(name)
+                cells.append(('-' if value is None else fmt.format(value)).ljust(width))
+            lines.append(' '.join(cells))
+        return '\n'.join(lines)
+
+
+if __name__ == "__main__":
+    import argparse
+
+    argp = argparse.ArgumentParser()
+    add_processing_arguments(argp)
+    argp.add_argument('--gpx-dir',
+                      dest='gpx_dir',
+                      help='directory with GPX files or a glob pattern of the files to be processed',
+                      required=True)
+    argp.add_argument('--corrected-dir',
+                      dest='corrected_dir',
+                      help='directory the tracks corrected by --ref-file are written to',
+                      default=OUTPUT_DIR)
+    argp.add_argument('--jobs',
+                      type=int,
+                      help='number of worker processes, defaults to the number of CPUs',
+                      default=None)
+    argp.add_argument('--async',
+                      dest='async_mode',
+                      action='store_true',
+                      help='overlap processing and ingest using the asyncio pipeline with AsyncElasticsearch')
+    argp.add_argument('--async-writers',
+                      dest='async_writers',
+                      type=int,
+                      help='number of concurrent async writers, used with --async',
+                      default=2)
+    argp.add_argument('--async-queue',
+                      dest='async_queue',
+                      type=int,
+                      help='maximal number of processed trips waiting for a writer, used with --async',
+                      default=2)
+
+    params = argp.parse_args()
+
+    batch_options = dict()
+    batch_class = BatchTripTracker
+    if params.async_mode:
+        from async_pipeline import AsyncBatchTripTracker
+        batch_class = AsyncBatchTripTracker
+        batch_options = {'writers': params.async_writers, 'queue_size': params.async_queue}
+
+    batch = batch_class(params.mode, collect_files(params.gpx_dir), params.ref_file,
+                        **batch_options,
+                        jobs=params.jobs,
+                        index=params.index,
+                        cache=None if params.no_cache else TrackCache(max_size_mb=params.cache_size_mb),
+                        rebuild_cache=params.rebuild_cache,
+                        simplify_tolerance_m=params.simplify_tolerance_m,
+                        distance_model=params.distance_model,
+                        corrected_dir=params.corrected_dir,
+                        detect_stops=params.detect_stops,
+                        fast_serialization=params.fast_serialization,
+                        layout=params.layout,
+                        layout_chunk_size=params.layout_chunk_size,
+                        chunk_size=params.chunk_size,
+                        max_chunk_bytes=params.chunk_bytes,
+                        bulk_workers=params.bulk_workers,
+                        bulk_queue_size=params.bulk_queue,
+                        max_retries=params.max_retries)
+    print(batch.format_summary(batch.run()))
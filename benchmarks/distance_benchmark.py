@@ -0,0 +1,62 @@
+"""
+Compares the distance models on consecutive points of a GPX file: run time, per-step error and error
+of the total length, both against Vincenty's algorithm.
+
+    python -m benchmarks.distance_benchmark --gpx-file track.gpx [--repeat 5]
+"""
+import time
+import numpy as np
+
+from geo import DISTANCE_MODELS, consecutive_distances
+from trip_tracker import GpxTripTracker
+
+
+def best_time(track_pts, model, repeat):
+    """returns (distances, best elapsed seconds of repeat runs)"""
+    elapsed = list()
+    for _ in range(repeat):
+        tic = time.perf_counter()
+        dists = consecutive_distances(track_pts, model)
+        elapsed.append(time.perf_counter() - tic)
+    return dists, min(elapsed)
+
+
+def run(gpx_file, repeat=5):
+    tracker = GpxTripTracker('bike', gpx_file)
+    track_pts = tracker.read_file(tracker.track_file_path)
+    exact, _ = best_time(track_pts, 'vincenty', 1)
+    step = exact > 0
+
+    results = list()
+    for model in DISTANCE_MODELS:
+        dists, elapsed = best_time(track_pts, model, repeat)
+        abs_err = np.abs(dists - exact)
+        results.append({'model': model,
+                        'points': len(track_pts),
+                        'time_s': elapsed,
+                        'mpairs_per_s': len(dists) / elapsed * 1e-6,
+                        'max_abs_err_m': float(np.max(abs_err)) if len(abs_err) else 0.0,
+                        'max_rel_err': float(np.max(abs_err[step] / exact[step])) if step.any() else 0.0,
+                        'length_err_m': float(np.sum(dists) - np.sum(exact))})
+    return results
+
+
+if __name__ == "__main__":
+    import argparse
+
+    argp = argparse.ArgumentParser()
+    argp.add_argument('--gpx-file',
+                      dest='gpx_file',
+                      help='path to the file used for the benchmark',
+                      required=True)
+    argp.add_argument('--repeat',
+                      type=int,
+                      help='number of runs of every model, the best time is reported',
+                      default=5)
+    args = argp.parse_args()
+
+    columns = ['model', 'points', 'time_s', 'mpairs_per_s', 'max_abs_err_m', 'max_rel_err', 'length_err_m']
+    print(' '.join(column.ljust(14) for column in columns))
+    for row in run(args.gpx_file, args.repeat):
+        print(' '.join((f'{row[column]:.3g}' if isinstance(row[column], float) else str(row[column])).ljust(14)
+                       for column in columns))
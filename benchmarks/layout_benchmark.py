@@ -0,0 +1,99 @@
+"""
+Compares the ingest layouts: document count, bulk payload bytes and serialization time of every layout.
+If --index-prefix is set, every layout is also ingested to a fresh index <prefix>-<layout>, the index size
+reported by ES and the ingest time are measured and the index is deleted afterwards.
+
+    python -m benchmarks.layout_benchmark --gpx-file track.gpx [--index-prefix trip-layout-bench]
+"""
+import time
+
+from trip_tracker import GpxTripTracker
+from ndjson_serializer import TrackChunkEncoder
+
+
+MAPPINGS = {"properties": {"location": {"type": "geo_point"},
+                           **TrackChunkEncoder.MAPPINGS['properties'],
+                           "trip_id": {"type": "keyword"},
+                           "elevation_m": {"type": "float"},
+                           "time_offset_s": {"type": "float", "index": False},
+                           "cumulative_distance_km": {"type": "float"},
+                           "cumulative_time_h": {"type": "float"}}}
+
+
+def serialize(tracker, track_pts, odo):
+    """returns (document count, payload bytes, elapsed seconds) of the bulk lines of the tracker layout"""
+    tic = time.perf_counter()
+    if tracker.layout == 'point':
+        lines = tracker.encode_points(track_pts, odo, 'driven')
+    else:
+        lines = tracker.encode_chunks(track_pts, odo, 'driven')
+    docs = 0
+    payload = 0
+    for action, data in lines:
+        docs += 1
+        payload += len(action) + len(data) + 2
+    return docs, payload, time.perf_counter() - tic
+
+
+def ingest(tracker, track_pts, odo):
+    """ingests to a fresh index, returns (ingest seconds, index store bytes)"""
+    es = tracker.es
+    es.indices.delete(index=tracker.es_index, ignore=[404])
+    es.indices.create(index=tracker.es_index, body={"mappings": MAPPINGS})
+    try:
+        tic = time.perf_counter()
+        tracker.ingest(track_pts, odo)
+        es.indices.refresh(index=tracker.es_index)
+        elapsed = time.perf_counter() - tic
+        es.indices.forcemerge(index=tracker.es_index, max_num_segments=1)
+        stats = es.indices.stats(index=tracker.es_index, metric='store')
+        return elapsed, stats['_all']['primaries']['store']['size_in_bytes']
+    finally:
+        es.indices.delete(index=tracker.es_index, ignore=[404])
+
+
+def run(gpx_file, transport_mode='bike', index_prefix=None, chunk_size=1000, host='localhost', port=9200):
+    results = list()
+    track_pts = odo = None
+    for layout in GpxTripTracker.LAYOUTS:
+        index = f'{index_prefix}-{layout}' if index_prefix else 'layout-benchmark'
+        tracker = GpxTripTracker(transport_mode, gpx_file, layout=layout, layout_chunk_size=chunk_size,
+                                 fast_serialization=True, index=index, host=host, port=port)
+        if track_pts is None:
+            track_pts, odo = tracker.process()
+        docs, payload, serialize_s = serialize(tracker, track_pts, odo)
+        result = {'layout': layout, 'points': len(track_pts), 'docs': docs, 'payload_bytes': payload,
+                  'serialize_s': serialize_s}
+        if index_prefix:
+            result['ingest_s'], result['index_bytes'] = ingest(tracker, track_pts, odo)
+        results.append(result)
+    return results
+
+
+if __name__ == "__main__":
+    import argparse
+
+    argp = argparse.ArgumentParser()
+    argp.add_argument('--gpx-file',
+                      dest='gpx_file',
+                      help='path to the file used for the benchmark',
+                      required=True)
+    argp.add_argument('--mode',
+                      help='Mean of transport, bike, run or walk',
+                      default='bike')
+    argp.add_argument('--index-prefix',
+                      dest='index_prefix',
+                      help='prefix of the temporary benchmark indices, if None, nothing is ingested',
+                      default=None)
+    argp.add_argument('--chunk-size',
+                      dest='chunk_size',
+                      type=int,
+                      help='number of track points in one document of the chunk layout',
+                      default=1000)
+    args = argp.parse_args()
+
+    columns = ['layout', 'points', 'docs', 'payload_bytes', 'serialize_s', 'ingest_s', 'index_bytes']
+    print(' '.join(column.ljust(14) for column in columns))
+    for row in run(args.gpx_file, args.mode, args.index_prefix, args.chunk_size):
+        print(' '.join((f'{row[column]:.3f}' if isinstance(row.get(column), float) else str(row.get(column, '-')))
+                       .ljust(14) for column in columns))
@@ -0,0 +1,143 @@
+"""
+In-process stand-in of the Elasticsearch client endpoints used by the trackers: index, bulk, exists, search
+with term/terms queries, terms aggregation and scroll (so elasticsearch.helpers.scan works), delete_by_query
+and indices.exists/create/delete/get_mapping. Bulk documents are kept as the raw data lines and decoded only when searched,
+so the benchmarks measure the client side of the ingest, not the stand-in.
+
+    es = LocalElasticsearch()
+    tracker = GpxTripTracker('bike', 'track.gpx', index='trips', es=es)
+"""
+import json
+import itertools
+
+from elasticsearch.serializer import JSONSerializer
+
+
+class _Transport:
+    serializer = JSONSerializer()
+
+
+class _Indices:
+
+    def __init__(self, store):
+        self._store = store
+        self._mappings = dict()
+
+    def exists(self, index, **kwargs):
+        return index in self._store
+
+    def create(self, index, body=None, **kwargs):
+        self._store.setdefault(index, dict())
+        self._mappings[index] = (body or dict()).get('mappings', dict())
+        return {'acknowledged': True, 'index': index}
+
+    def delete(self, index, **kwargs):
+        self._store.pop(index, None)
+        self._mappings.pop(index, None)
+        return {'acknowledged': True}
+
+    def get_mapping(self, index, **kwargs):
+        return {index: {'mappings': self._mappings.get(index, dict())}}
+
+
+class LocalElasticsearch:
+    """documents of every index in a dict id -> raw JSON bytes, indices are created on the first write"""
+
+    transport = _Transport()
+
+    def __init__(self, indices=()):
+        self.store = {index: dict() for index in indices}
+        self.indices = _Indices(self.store)
+        self.requests = {'index': 0, 'bulk': 0, 'search': 0}
+        self._scrolls = dict()
+        self._scroll_ids = itertools.count()
+
+    def index(self, index, body, id=None, **kwargs):
+        self.requests['index'] += 1
+        self.store.setdefault(index, dict())[str(id)] = self.transport.serializer.dumps(body).encode('utf-8')
+        return {'_index': index, '_id': str(id), 'result': 'created', '_shards': {'total': 1, 'successful': 1}}
+
+    def bulk(self, body, index=None, **kwargs):
+        self.requests['bulk'] += 1
+        lines = body.splitlines() if isinstance(body, bytes) else body.encode('utf-8').splitlines()
+        items = list()
+        for action_line, data in zip(lines[::2], lines[1::2]):
+            op_type, action = next(iter(json.loads(action_line).items()))
+            doc_index = action.get('_index', index)
+            doc_id = str(action.get('_id', len(self.store.get(doc_index, ()))))
+            self.store.setdefault(doc_index, dict())[doc_id] = data
+            items.append({op_type: {'_index': doc_index, '_id': doc_id, 'status': 201}})
+        return {'took': 0, 'errors': False, 'items': items}
+
+    def exists(self, index, id, **kwargs):
+        return str(id) in self.store.get(index, ())
+
+    def get(self, index, id, **kwargs):
+        return {'_index': index, '_id': str(id), 'found': True, '_source': json.loads(self.store[index][str(id)])}
+
+    def _matches(self, index, query):
+        """(id, source) of the documents matching the term, terms or match_all query"""
+        query = query or {'match_all': {}}
+        kind, condition = next(iter(query.items()))
+        if kind not in ('match_all', 'term', 'terms'):
+            raise ValueError(f'{kind} query is not supported by LocalElasticsearch')
+        field, values = next(iter(condition.items())) if kind != 'match_all' else (None, None)
+        values = values if kind == 'terms' else [values]
+        for doc_id, data in self.store.get(index, dict()).items():
+            source = json.loads(data)
+            if field is None or source.get(field) in values:
+                yield doc_id, source
+
+    def search(self, index, body=None, query=None, size=10, scroll=None, terminate_after=None, aggs=None, **kwargs):
+        self.requests['search'] += 1
+        body = body or dict()
+        query = body.get('query', query)
+        aggs = body.get('aggs', aggs)
+        hits = [{'_index': index, '_id': doc_id, '_source': source} for doc_id, source in self._matches(index, query)]
+        if terminate_after:
+            hits = hits[:terminate_after]
+
+        resp = {'took': 0, 'timed_out': False, '_shards': {'total': 1, 'successful': 1, 'skipped': 0, 'failed': 0},
+                'hits': {'total': {'value': len(hits), 'relation': 'eq'}, 'hits': hits[:size]}}
+        if aggs:
+            resp['aggregations'] = {name: self._terms_aggregation(hits, agg) for name, agg in aggs.items()}
+        if scroll:
+            scroll_id = str(next(self._scroll_ids))
+            self._scrolls[scroll_id] = (hits[size:], size)
+            resp['_scroll_id'] = scroll_id
+        return resp
+
+    @staticmethod
+    def _terms_aggregation(hits, agg):
+        field = agg['terms']['field']
+        counts = dict()
+        for hit in hits:
+            key = hit['_source'].get(field)
+            counts[key] = counts.get(key, 0) + 1
+        buckets = sorted(counts.items(), key=lambda item: -item[1])[:agg['terms'].get('size', 10)]
+        return {'buckets': [{'key': key, 'doc_count': count} for key, count in buckets]}
+
+    def scroll(self, body=None, scroll_id=None, **kwargs):
+        scroll_id = (body or dict()).get('scroll_id', scroll_id)
+        remaining, size = self._scrolls.get(scroll_id, ([], 0))
+        self._scrolls[scroll_id] = (remaining[size:], size)
+        return {'_scroll_id': scroll_id, '_shards': {'total': 1, 'successful': 1, 'skipped': 0, 'failed': 0},
+                'hits': {'total': {'value': len(remaining), 'relation': 'eq'}, 'hits': remaining[:size]}}
+
+    def clear_scroll(self, body=None, scroll_id=None, **kwargs):
+        scroll_ids = (body or dict()).get('scroll_id', scroll_id)
+        for scroll_id in scroll_ids if isinstance(scroll_ids, list) else [scroll_ids]:
+            self._scrolls.pop(scroll_id, None)
+        return {'succeeded': True}
+
+    def delete_by_query(self, index, body=None, query=None, **kwargs):
+        deleted = [doc_id for doc_id, _ in self._matches(index, (body or dict()).get('query', query))]
+        for doc_id in deleted:
+            del self.store[index][doc_id]
+        return {'deleted': len(deleted)}
+
+    def count(self, index, body=None, query=None, **kwargs):
+        return {'count': sum(1 for _ in self._matches(index, (body or dict()).get('query', query)))}
+
+    def close(self):
+        pass
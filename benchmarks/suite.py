@@ -0,0 +1,157 @@
+"""
+Benchmark suite of the processing stages on a synthetic track with gaps, stops and segments: read_file,
+extract_odometry, correct_track_points, find_closest, ingest_generator, encode_points and the end-to-end run
+ingesting to an in-process Elasticsearch stand-in. The results are written as JSON together with the commit
+and the environment, --compare prints the ratios to the results of another run.
+
+    python -m benchmarks.suite --points 100000 --output bench.json [--compare baseline.json]
+"""
+import json
+import time
+import platform
+import subprocess
+import numpy as np
+
+from utils import FDIR, str2path
+from spatial import ReferenceIndex
+from trip_tracker import GpxTripTracker
+from benchmarks.local_es import LocalElasticsearch
+from benchmarks.synthetic_gpx import write_gpx
+
+
+DATA_DIR = FDIR / 'benchmarks' / 'data'
+INDEX = 'trip-bench'
+FIND_CLOSEST_QUERIES = 1000
+
+
+def measure(func, repeat):
+    """returns (result of the last call, list of elapsed seconds of repeat calls)"""
+    elapsed = list()
+    result = None
+    for _ in range(repeat):
+        tic = time.perf_counter()
+        result = func()
+        elapsed.append(time.perf_counter() - tic)
+    return result, elapsed
+
+
+def synthetic_files(points, seed, data_dir=DATA_DIR):
+    """generates the benchmark track and its reference unless they already exist, returns their paths"""
+    data_dir.mkdir(parents=True, exist_ok=True)
+    gaps = max(1, points // 20000)
+    track_path = data_dir / f'synthetic-{points}-{seed}.gpx'
+    ref_path = data_dir / f'synthetic-{points}-{seed}-ref.gpx'
+    if not track_path.exists() or not ref_path.exists():
+        write_gpx(track_path, points, gaps=gaps, stops=max(1, points // 50000), segments=3, seed=seed,
+                  ref_path=ref_path, ref_step=2)
+    return track_path, ref_path
+
+
+def consume(iterable):
+    count = 0
+    for _ in iterable:
+        count += 1
+    return count
+
+
+def run(points=100000, repeat=3, seed=0, data_dir=DATA_DIR):
+    track_path, ref_path = synthetic_files(points, seed, data_dir)
+    tracker = GpxTripTracker('bike', track_path, ref_path, es=LocalElasticsearch())
+    track_pts = tracker.read_file(tracker.track_file_path)
+    ref_pts = tracker.read_file(tracker.ref_file_path)
+    corrected = tracker.correct_track_points(track_pts, ref_pts)
+    odo = tracker.extract_odometry(corrected)
+    ref_index = ReferenceIndex(ref_pts)
+    queries = corrected[np.linspace(0, len(corrected) - 1, FIND_CLOSEST_QUERIES).astype(int)]
+
+    def end_to_end():
+        es = LocalElasticsearch(indices=[INDEX])
+        GpxTripTracker('bike', track_path, ref_path, index=INDEX, es=es, fast_serialization=True).run()
+        return len(es.store[INDEX])
+
+    benchmarks = {'read_file': (lambda: tracker.read_file(tracker.track_file_path), len(track_pts)),
+                  'extract_odometry': (lambda: tracker.extract_odometry(corrected), len(corrected)),
+                  'correct_track_points': (lambda: tracker.correct_track_points(track_pts, ref_pts), len(track_pts)),
+                  'find_closest': (lambda: [tracker.find_closest(pt, ref_pts, 0, ref_index) for pt in queries],
+                                   len(queries)),
+                  'ingest_generator': (lambda: consume(tracker._serialize_actions(tracker.process_generator(
+                      tracker.ingest_generator(corrected, odo, 'driven')))), len(corrected)),
+                  'encode_points': (lambda: consume(tracker.encode_points(corrected, odo, 'driven')), len(corrected)),
+                  'run': (end_to_end, len(corrected))}
+
+    results = dict()
+    for name, (func, items) in benchmarks.items():
+        tracker.log.info(f'Benchmarking {name}...')
+        _, elapsed = measure(func, repeat)
+        results[name] = {'items': items,
+                         'best_s': min(elapsed),
+                         'mean_s': float(np.mean(elapsed)),
+                         'items_per_s': items / min(elapsed)}
+
+    return {'commit': git_commit(),
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'machine': platform.machine(),
+            'params': {'points': points, 'repeat': repeat, 'seed': seed,
+                       'track_points': len(track_pts), 'corrected_points': len(corrected),
+                       'segments': int(len(np.unique(track_pts['sid'])))},
+            'results': results}
+
+
+def git_commit():
+    """commit of the benchmarked tree, None outside of a git checkout"""
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=FDIR, capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(report, baseline):
+    """lines of the best time ratios current/baseline of the benchmarks present in both reports"""
+    lines = [f"{'benchmark'.ljust(22)}{'baseline s'.ljust(14)}{'current s'.ljust(14)}ratio"]
+    for name, result in report['results'].items():
+        if name in baseline['results']:
+            base = baseline['results'][name]['best_s']
+            lines.append(f"{name.ljust(22)}{base:<14.4g}{result['best_s']:<14.4g}{result['best_s'] / base:.2f}")
+    return lines
+
+
+if __name__ == "__main__":
+    import argparse
+    from utils import simple_logger
+
+    argp = argparse.ArgumentParser()
+    argp.add_argument('--points',
+                      type=int,
+                      help='number of points of the synthetic track, 1k to 10M',
+                      default=100000)
+    argp.add_argument('--repeat',
+                      type=int,
+                      help='number of runs of every benchmark, the best and the mean time are reported',
+                      default=3)
+    argp.add_argument('--seed',
+                      type=int,
+                      default=0)
+    argp.add_argument('--data-dir',
+                      dest='data_dir',
+                      help='directory of the generated GPX files, they are reused by the next runs',
+                      default=DATA_DIR)
+    argp.add_argument('--output',
+                      help='path of the JSON results, if None, the results are only printed',
+                      default=None)
+    argp.add_argument('--compare',
+                      help='path of the JSON results of a previous run to compare with',
+                      default=None)
+    args = argp.parse_args()
+
+    simple_logger()
+    report = run(args.points, args.repeat, args.seed, str2path(args.data_dir))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    for name, result in report['results'].items():
+        print(f"{name.ljust(22)}{result['best_s']:<14.4g}{result['items_per_s']:.0f} items/s")
+    if args.compare:
+        with open(args.compare, 'r') as f:
+            print('\n'.join(compare(report, json.load(f))))
@@ -0,0 +1,160 @@
+"""
+Deterministic synthetic GPX tracks for the benchmarks. The route is a random walk with a smoothly changing
+heading, the track samples it every rate_s seconds. Gaps skip gap_s seconds of the route and start a new
+segment, so the track needs a correction, stops hold the position for stop_s seconds, segments splits the track
+into more segments without a gap. The same seed gives the same file, the file is written in blocks, so tracks
+of 10M points do not need to fit in memory. The optional reference file contains every ref_step-th point
+of the whole route including the gaps.
+
+    python -m benchmarks.synthetic_gpx --points 1000000 --output track.gpx [--ref-output ref.gpx] [--gaps 10]
+"""
+import numpy as np
+
+from geo import MEAN_EARTH_RADIUS_M
+
+
+BLOCK_POINTS = 1 << 16
+START_TIME = np.datetime64('2020-05-01T06:00:00', 's')
+START_LAT = 49.0
+START_LON = 14.0
+HEADER = ('<?xml version="1.0" encoding="UTF-8"?>\n'
+          '<gpx version="1.1" creator="trip_tracker synthetic_gpx" xmlns="http://www.topografix.com/GPX/1/1">\n'
+          '<trk><name>{name}</name><trkseg>\n')
+FOOTER = '</trkseg></trk></gpx>\n'
+
+
+def event_starts(rng, count, total, length):
+    """sorted route indices of count non-overlapping events of length samples"""
+    if count <= 0:
+        return np.zeros(0, dtype=np.int64)
+    starts = np.sort(rng.choice(max(total - count * length, count), size=count, replace=False))
+    return starts + np.arange(count) * length
+
+
+def in_events(idx, starts, length):
+    """mask of the route indices idx lying inside the events starting at starts"""
+    if not len(starts):
+        return np.zeros(len(idx), dtype=bool)
+    event = np.searchsorted(starts, idx, side='right') - 1
+    return (event >= 0) & (idx - starts[np.maximum(event, 0)] < length)
+
+
+def route_blocks(total, rate_s, speed_mps, stop_starts, stop_points, seed):
+    """yields (route indices, lat, lon, ele) blocks of the whole route"""
+    rng = np.random.default_rng([seed, 1])
+    lat, lon, heading = START_LAT, START_LON, 0.0
+    for start in range(0, total, BLOCK_POINTS):
+        idx = np.arange(start, min(start + BLOCK_POINTS, total))
+        headings = heading + np.cumsum(rng.normal(0, 0.02, len(idx)))
+        steps = np.where(in_events(idx, stop_starts, stop_points), 0, speed_mps * rate_s)
+        steps = steps * rng.uniform(0.8, 1.2, len(idx))
+        lats = lat + np.rad2deg(np.cumsum(steps * np.cos(headings)) / MEAN_EARTH_RADIUS_M)
+        lons = lon + np.rad2deg(np.cumsum(steps * np.sin(headings)) / MEAN_EARTH_RADIUS_M
+                                / np.cos(np.deg2rad(lat)))
+        eles = 300 + 80 * np.sin(idx / 3000) + rng.normal(0, 0.3, len(idx))
+        lat, lon, heading = lats[-1], lons[-1], headings[-1]
+        yield idx, lats, lons, eles
+
+
+def write_gpx(path, points, rate_s=1.0, gaps=0, stops=0, segments=1, seed=0, ref_path=None, ref_step=1,
+              speed_mps=5.0, gap_s=60, stop_s=300):
+    """
+    writes the synthetic track of points points to path and optionally the reference route to ref_path,
+    returns the number of segments of the track
+    """
+    rng = np.random.default_rng(seed)
+    gap_points = max(1, int(round(gap_s / rate_s)))
+    stop_points = max(1, int(round(stop_s / rate_s)))
+    total = points + gaps * gap_points
+    gap_starts = event_starts(rng, gaps, total, gap_points)
+    stop_starts = event_starts(rng, stops, total, stop_points)
+    breaks = np.sort(rng.choice(total, size=max(segments - 1, 0), replace=False))
+    seg_starts = np.union1d(gap_starts + gap_points, breaks)
+
+    track = open(path, 'w')
+    ref = open(ref_path, 'w') if ref_path else None
+    written = 0
+    seg_count = 1
+    try:
+        track.write(HEADER.format(name='synthetic'))
+        if ref:
+            ref.write(HEADER.format(name='synthetic reference'))
+        for idx, lats, lons, eles in route_blocks(total, rate_s, speed_mps, stop_starts, stop_points, seed):
+            if ref:
+                sel = idx % ref_step == 0
+                ref.write(''.join(f'<trkpt lat="{lat:.7f}" lon="{lon:.7f}"><ele>{ele:.1f}</ele></trkpt>\n'
+                                  for lat, lon, ele in zip(lats[sel], lons[sel], eles[sel])))
+
+            keep = ~in_events(idx, gap_starts, gap_points)
+            keep &= np.cumsum(keep) + written <= points
+            offsets_ms = np.round(idx[keep] * rate_s * 1000).astype(np.int64).astype('m8[ms]')
+            times = np.datetime_as_string(START_TIME + offsets_ms, unit='ms')
+            new_seg = np.isin(idx[keep], seg_starts) & (written + np.arange(keep.sum()) > 0)
+            rows = zip(lats[keep], lons[keep], eles[keep], times, new_seg)
+            track.write(''.join(f'{"</trkseg><trkseg>" if seg else ""}<trkpt lat="{lat:.7f}" lon="{lon:.7f}">'
+                                f'<ele>{ele:.1f}</ele><time>{time}Z</time></trkpt>\n'
+                                for lat, lon, ele, time, seg in rows))
+            written += int(keep.sum())
+            seg_count += int(new_seg.sum())
+        track.write(FOOTER)
+        if ref:
+            ref.write(FOOTER)
+    finally:
+        track.close()
+        if ref:
+            ref.close()
+    return seg_count
+
+
+if __name__ == "__main__":
+    import argparse
+
+    argp = argparse.ArgumentParser()
+    argp.add_argument('--points',
+                      type=int,
+                      help='number of track points',
+                      required=True)
+    argp.add_argument('--output',
+                      help='path of the GPX file to be written',
+                      required=True)
+    argp.add_argument('--ref-output',
+                      dest='ref_output',
+                      help='path of the reference GPX file of the whole route, if None, no reference is written',
+                      default=None)
+    argp.add_argument('--ref-step',
+                      dest='ref_step',
+                      type=int,
+                      help='every REF_STEP-th route point is written to the reference',
+                      default=1)
+    argp.add_argument('--rate-s',
+                      dest='rate_s',
+                      type=float,
+                      help='sampling period in seconds',
+                      default=1.0)
+    argp.add_argument('--gaps',
+                      type=int,
+                      help='number of gaps of --gap-s seconds without points, each starts a new segment',
+                      default=0)
+    argp.add_argument('--gap-s',
+                      dest='gap_s',
+                      type=float,
+                      default=60)
+    argp.add_argument('--stops',
+                      type=int,
+                      help='number of stops of --stop-s seconds',
+                      default=0)
+    argp.add_argument('--stop-s',
+                      dest='stop_s',
+                      type=float,
+                      default=300)
+    argp.add_argument('--segments',
+                      type=int,
+                      help='number of segments the track is split into, not counting the segments started by gaps',
+                      default=1)
+    argp.add_argument('--seed',
+                      type=int,
+                      default=0)
+    args = argp.parse_args()
+
+    write_gpx(args.output, args.points, args.rate_s, args.gaps, args.stops, args.segments, args.seed,
+              args.ref_output, args.ref_step, gap_s=args.gap_s, stop_s=args.stop_s)
@@ -0,0 +1,204 @@
+import tempfile
+import numpy as np
+
+from utils import str2path, current_rss_bytes, RunningMedian, datetime64_to_datetime, stage_timer
+from geo import geodesic_counter
+from spatial import ReferenceIndex
+from gpx_stream import iter_blocks
+from trip_tracker import GpxTripTracker
+
+
+class ChunkedTripTracker(GpxTripTracker):
+    """
+    Processes a tracked trip in blocks of block_size points streamed from the GPX file through correction,
+    odometry and bulk ingest, so the memory does not grow with the trip length. Odometry of every block
+    continues from the last point of the previous one, the stop threshold uses the running median
+    of the time deltas seen so far. If memory_cap_mb is set, the block size is derived from it and halved
+    whenever the RSS exceeds the cap. With spill_dir the processed arrays are appended to files there
+    and returned memory-mapped by process.
+    """
+
+    # a block peaks at about 6 records of both dtypes per point: the parsed, concatenated and corrected track
+    # points and the odometry with its float64 intermediates, doubled for the allocator and the parser buffers
+    BLOCK_RECORD_COPIES = 12
+    BYTES_PER_POINT = BLOCK_RECORD_COPIES * (np.dtype(GpxTripTracker.GPS_DTYPE).itemsize +
+                                             np.dtype(GpxTripTracker.ODO_DTYPE).itemsize)
+    DOC_BYTES = 600
+    MIN_BLOCK_SIZE = 1024
+    MAX_BLOCK_SIZE = 1 << 20
+    DEFAULT_BLOCK_SIZE = 100000
+    SPILL_FILES = ('track_points.bin', 'odometry.bin')
+
+    def __init__(self, *args, block_size=None, memory_cap_mb=None, spill_dir=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        if self.layout != 'point' or self.simplify_tolerance_m is not None or self.detect_stops or self.sinks:
+            raise ValueError("chunked mode supports only the point layout without simplification, stop detection "
+                             "and output sinks")
+        self.block_size = block_size
+        self.memory_cap_bytes = memory_cap_mb * 1024 * 1024 if memory_cap_mb else None
+        self.spill_dir = str2path(spill_dir)
+        self.aggregates = dict()
+
+    def initial_block_size(self):
+        """block_size if set, otherwise the largest block fitting into the memory cap next to the bulk buffers"""
+        if self.block_size:
+            return self.block_size
+        if self.memory_cap_bytes is None:
+            return self.DEFAULT_BLOCK_SIZE
+
+        bulk_bytes = (self.bulk_workers + self.bulk_queue_size + 1) * min(self.chunk_size * self.DOC_BYTES,
+                                                                          self.max_chunk_bytes)
+        free_bytes = self.memory_cap_bytes - (current_rss_bytes() or 0) - bulk_bytes
+        block_size = free_bytes // self.BYTES_PER_POINT
+        if block_size < self.MIN_BLOCK_SIZE:
+            required_mb = (self.memory_cap_bytes - free_bytes + self.MIN_BLOCK_SIZE * self.BYTES_PER_POINT) / 2**20
+            raise ValueError(f"Memory cap is too low, at least {required_mb:.0f} MB is needed "
+                             f"with the current bulk settings")
+        return int(min(block_size, self.MAX_BLOCK_SIZE))
+
+    def read_blocks(self):
+        """yields blocks of the track points, the block size is halved when the RSS exceeds the memory cap"""
+        block_size = self.initial_block_size()
+        self.log.info(f'Processing {self.track_file_path.name} in blocks of {block_size} points')
+        pending = list()
+        count = 0
+        for block in iter_blocks(self.track_file_path, self.GPS_DTYPE, min(block_size, self.MIN_BLOCK_SIZE * 8)):
+            pending.append(block)
+            count += len(block)
+            if count >= block_size:
+                yield np.concatenate(pending)
+                pending = list()
+                count = 0
+                block_size = self._check_memory(block_size)
+        if pending:
+            yield np.concatenate(pending)
+
+    def _check_memory(self, block_size):
+        rss = current_rss_bytes()
+        if rss is None:
+            return block_size
+        self.counters['peak_rss_mb'] = max(self.counters.get('peak_rss_mb', 0), rss / 2**20)
+        if self.memory_cap_bytes is not None and rss > self.memory_cap_bytes and block_size > self.MIN_BLOCK_SIZE:
+            block_size = max(self.MIN_BLOCK_SIZE, block_size // 2)
+            self.log.warning(f'RSS {rss / 2**20:.0f} MB exceeds the memory cap, block size reduced to {block_size}')
+        return block_size
+
+    def iter_processed(self):
+        """yields (track points, odometry) of the corrected blocks, updates the trip aggregates"""
+        ref_points = ref_index = None
+        if self.ref_file_path:
+            ref_points = self.read_file(self.ref_file_path)
+            ref_index = ReferenceIndex(ref_points)
+
+        last_pt = last_odo = None
+        dt_median = RunningMedian()
+        for block in self.read_blocks():
+            if last_pt is None:
+                if not self._is_tracked(block):
+                    raise ValueError("chunked mode needs a tracked trip with timestamps")
+                self.aggregates = {'trip_start_utc': block[0]['timestamp'], 'max_elev_m': np.nan,
+                                   'min_elev_m': np.nan, 'points': 0}
+                track_pts = block
+            else:
+                track_pts = np.concatenate((last_pt, block))
+
+            if ref_points is not None or self.ref_library is not None:
+                track_pts = self.correct_track_points(track_pts, ref_points, ref_index)
+            dt_median.update(np.diff(track_pts['timestamp']) / np.timedelta64(1, 's'))
+
+            if last_pt is None:
+                odo = self.tracked_odometry(track_pts, dt_median.median())
+            else:
+                track_pts = track_pts[1:]
+                odo = self.continue_odometry(track_pts, last_pt, last_odo, dt_median.median())
+
+            last_pt = track_pts[-1:].copy()
+            last_odo = odo[-1:].copy()
+            self._update_aggregates(track_pts, odo)
+            yield track_pts, odo
+
+    def _update_aggregates(self, track_pts, odo):
+        aggregates = self.aggregates
+        elevations = np.append(track_pts['ele'], [aggregates['max_elev_m'], aggregates['min_elev_m']])
+        if not aggregates['points']:
+            elevations = track_pts['ele']
+        aggregates['max_elev_m'] = np.max(elevations)
+        aggregates['min_elev_m'] = np.min(elevations)
+        aggregates['trip_end_utc'] = track_pts[-1]['timestamp']
+        aggregates['trip_length_km'] = odo[-1]['cum_dist_km']
+        aggregates['trip_duration_h'] = odo[-1]['total_time_h']
+        aggregates['points'] += len(track_pts)
+
+    def summarize_aggregates(self):
+        """trip overview message of the processed blocks"""
+        aggregates = self.aggregates
+        return self.overview('driven',
+                             datetime64_to_datetime(aggregates['trip_start_utc']),
+                             datetime64_to_datetime(aggregates['trip_end_utc']),
+                             aggregates['trip_length_km'], aggregates['trip_duration_h'],
+                             aggregates['max_elev_m'], aggregates['min_elev_m'])
+
+    def spill(self, blocks):
+        """appends the blocks to the spill files and passes them through"""
+        self.spill_dir.mkdir(parents=True, exist_ok=True)
+        files = [open(self.spill_dir / name, 'wb') for name in self.SPILL_FILES]
+        try:
+            for arrays in blocks:
+                for f, array in zip(files, arrays):
+                    array.tofile(f)
+                yield arrays
+        finally:
+            for f in files:
+                f.close()
+
+    def load_spilled(self):
+        """memory-mapped (track points, odometry) of the spill files"""
+        return tuple(np.memmap(self.spill_dir / name, dtype=dtype, mode='r')
+                     for name, dtype in zip(self.SPILL_FILES, (self.GPS_DTYPE, self.ODO_DTYPE)))
+
+    def process(self):
+        """processes the whole track into the spill files, returns memory-mapped (track points, odometry)"""
+        if self.spill_dir is None:
+            self.spill_dir = str2path(tempfile.mkdtemp(prefix='trip-spill-'))
+            self.log.info(f'Spilling processed blocks to {self.spill_dir}')
+        for _ in self.spill(self.iter_processed()):
+            pass
+        return self.load_spilled()
+
+    def iter_lines(self, blocks):
+        """serialized bulk lines of all the blocks, point ids continue across the blocks"""
+        first_point_id = 1
+        for track_pts, odo in blocks:
+            if self.fast_serialization:
+                yield from self.encode_points(track_pts, odo, 'driven', first_point_id)
+            else:
+                yield from self._serialize_actions(self.process_generator(
+                    self.ingest_generator(track_pts, odo, 'driven', first_point_id)))
+            first_point_id += len(track_pts)
+
+    def run(self):
+        """streams the blocks through processing and ingest, the overview is pushed when all blocks are ingested"""
+        with stage_timer(self.timings, 'run'), geodesic_counter(self.counters):
+            blocks = self.iter_processed()
+            if self.spill_dir is not None:
+                blocks = self.spill(blocks)
+
+            if self.es_index is not None:
+                if not self.should_ingest(self.track_file_path.stem):
+                    return None
+                self.bulk_push_lines(self.iter_lines(blocks))
+            else:
+                self.log.warning('The index is None, hence no ingest to ES')
+                for _ in blocks:
+                    pass
+
+            overview = self.summarize_aggregates()
+            if self.es_index is not None:
+                self.push(dict(overview), doc_id=overview['trip_id'])
+        self._check_memory(self.MIN_BLOCK_SIZE)
+        self.log.info(f'{overview}')
+        self.log.info(f"Processed {self.aggregates['points']} points in {self.timings['run_s']:.2f} s, "
+                      f"peak RSS {self.counters.get('peak_rss_mb', float('nan')):.0f} MB")
+        if self.bulk_stats:
+            self.log.info(self.bulk_report())
+        return overview
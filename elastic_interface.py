@@ -1,54 +1,339 @@
+import json
 import datetime
 import logging
+import threading
+import time
 import uuid
-import elasticsearch
-import elasticsearch.helpers
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+
+def _elasticsearch():
+    """imports the elasticsearch client on the first use, so the runs without an index never load it"""
+    import elasticsearch
+    import elasticsearch.helpers
+    return elasticsearch
 
 
 class ElasticAPI:
-    def __init__(self, index=None, host='localhost', port=9200):
-        self.es = elasticsearch.Elasticsearch(hosts=[{"host": host, "port": port}], scheme='http')
+    """
+    Elasticsearch access of the trackers. The client is created on the first use of es, so an instance
+    without an index can serialize documents without importing the elasticsearch package.
+    """
+    TERMS_BATCH = 1024
+
+    def __init__(self, index=None, host='localhost', port=9200, es=None, maxsize=10,
+                 chunk_size=500, max_chunk_bytes=100 * 1024 * 1024, bulk_workers=1, bulk_queue_size=4,
+                 max_retries=3, initial_backoff=2, max_backoff=600):
+        self._es = es
+        self._client_options = {'hosts': [{"host": host, "port": port}], 'scheme': 'http',
+                                'maxsize': max(maxsize, bulk_workers)}
         self.es_index = index
+        self.chunk_size = chunk_size
+        self.max_chunk_bytes = max_chunk_bytes
+        self.bulk_workers = bulk_workers
+        self.bulk_queue_size = bulk_queue_size
+        self.max_retries = max_retries
+        self.initial_backoff = initial_backoff
+        self.max_backoff = max_backoff
+        self.bulk_stats = dict()
+        self._stats_lock = threading.Lock()
         self.log = logging.getLogger('root')
 
-    def push(self, data_dict):
+    @property
+    def es(self):
+        """client of the ES server, created on the first access, the bulk threads may access it concurrently"""
+        if self._es is None:
+            with self._stats_lock:
+                if self._es is None:
+                    self._es = self._create_client()
+        return self._es
+
+    def _create_client(self):
+        return _elasticsearch().Elasticsearch(**self._client_options)
+
+    @property
+    def serializer(self):
+        """serializer of the client, documents serialized before the client is created do not need it"""
+        if self._es is None:
+            from ndjson_serializer import DocumentSerializer
+            return DocumentSerializer()
+        return self._es.transport.serializer
+
+    def push(self, data_dict, doc_id=None):
         ts = datetime.datetime.utcnow()
         data_dict.update({'timestamp': ts})
-        res = self.es.index(index=self.es_index, id=uuid.uuid1(), body=data_dict, request_timeout=10)
+        res = self.es.index(index=self.es_index, id=doc_id or uuid.uuid1(), body=data_dict, request_timeout=10)
         return res["_shards"]["successful"] == 1
 
     def bulk_push(self, generator):
-        return elasticsearch.helpers.bulk(self.es, actions=self.process_generator(generator))
+        """
+        Pushes the documents in chunks limited by chunk_size documents and max_chunk_bytes bytes.
+        Chunks are sent by bulk_workers threads, at most bulk_queue_size chunks wait for a free worker.
+        Documents rejected with 429 are retried with exponential backoff, returns (success count, errors).
+        """
+        return self.bulk_push_lines(self._serialize_actions(self.process_generator(generator)))
+
+    def bulk_push_lines(self, lines):
+        """same as bulk_push, but takes already serialized (action line, data line) pairs of bytes"""
+        self._reset_bulk_stats()
+        success = 0
+        errors = list()
+        tic = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=self.bulk_workers) as executor:
+            in_flight = set()
+            for chunk in self._chunk_lines(lines):
+                if len(in_flight) >= self.bulk_workers + self.bulk_queue_size:
+                    wait_tic = time.perf_counter()
+                    done, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+                    self.bulk_stats['backpressure_s'] += time.perf_counter() - wait_tic
+                    for future in done:
+                        chunk_success, chunk_errors = future.result()
+                        success += chunk_success
+                        errors.extend(chunk_errors)
+                in_flight.add(executor.submit(self._send_chunk, chunk))
+
+            for future in in_flight:
+                chunk_success, chunk_errors = future.result()
+                success += chunk_success
+                errors.extend(chunk_errors)
+
+        self.bulk_stats['elapsed_s'] = time.perf_counter() - tic
+        self.bulk_stats['failed'] = len(errors)
+        if errors:
+            raise _elasticsearch().helpers.BulkIndexError(f"{len(errors)} document(s) failed to index.", errors)
+        return success, errors
+
+    def bulk_report(self):
+        """summary of the last bulk_push"""
+        stats = self.bulk_stats
+        elapsed = stats.get('elapsed_s') or float('nan')
+        return (f"Bulk ingest: {stats.get('docs', 0)} docs in {stats.get('chunks', 0)} chunks, "
+                f"{stats.get('docs', 0) / elapsed:.0f} docs/s, {stats.get('bytes', 0) / elapsed / 1024:.0f} kB/s, "
+                f"{stats.get('retries', 0)} retries, {stats.get('failed', 0)} failed")
+
+    def bulk_summary(self):
+        """
+        statistics of the last bulk_push as a JSON serializable dict, serialize_s is the time spent producing
+        the chunks, backpressure_s the time waiting for a free worker, the latencies are of single bulk requests
+        """
+        summary = {key: value for key, value in self.bulk_stats.items() if key != 'latencies_s'}
+        latencies = np.asarray(self.bulk_stats.get('latencies_s', []))
+        if len(latencies):
+            summary.update({'latency_mean_s': float(np.mean(latencies)),
+                            'latency_p50_s': float(np.percentile(latencies, 50)),
+                            'latency_p95_s': float(np.percentile(latencies, 95)),
+                            'latency_max_s': float(np.max(latencies))})
+        return summary
+
+    def _serialize_actions(self, actions):
+        """serializes the actions to (action line, data line) pairs"""
+        serializer = self.serializer
+        for data in actions:
+            action, data = self.expand_action(data)
+            yield serializer.dumps(action).encode('utf-8'), serializer.dumps(data).encode('utf-8')
+
+    @staticmethod
+    def expand_action(data):
+        """
+        splits the document to the bulk action and the source like elasticsearch.helpers.expand_action,
+        the metadata fields are the ones starting with underscore, unset index is left to the bulk request
+        """
+        data = dict(data)
+        op_type = data.pop('_op_type', 'index')
+        meta = {key: data.pop(key) for key in [key for key in data if key.startswith('_') and key != '_source']}
+        action = {op_type: {key: value for key, value in meta.items() if value is not None}}
+        return action, data.get('_source', data)
+
+    def _chunk_lines(self, pairs):
+        """groups (action line, data line) pairs into chunks limited by chunk_size and max_chunk_bytes"""
+        chunk = list()
+        chunk_bytes = 0
+        tic = time.perf_counter()
+        for lines in pairs:
+            size = len(lines[0]) + len(lines[1]) + 2
+            if chunk and (len(chunk) >= self.chunk_size or chunk_bytes + size > self.max_chunk_bytes):
+                self.bulk_stats['serialize_s'] += time.perf_counter() - tic
+                yield chunk
+                tic = time.perf_counter()
+                chunk = list()
+                chunk_bytes = 0
+            chunk.append(lines)
+            chunk_bytes += size
+        self.bulk_stats['serialize_s'] += time.perf_counter() - tic
+        if chunk:
+            yield chunk
+
+    def _send_chunk(self, chunk):
+        """sends the chunk, retries only the documents rejected with 429"""
+        success = 0
+        errors = list()
+        for attempt in range(self.max_retries + 1):
+            body = self._chunk_body(chunk)
+            with self._stats_lock:
+                self.bulk_stats['bytes'] += len(body)
+                self.bulk_stats['chunks'] += 1
+            tic = time.perf_counter()
+            try:
+                resp = self.es.bulk(body=body)
+                items = resp['items']
+            except _elasticsearch().TransportError as ex:
+                if ex.status_code != 429:
+                    raise
+                items = [{'index': {'status': 429, 'error': str(ex)}}] * len(chunk)
+            finally:
+                with self._stats_lock:
+                    self.bulk_stats['latencies_s'].append(time.perf_counter() - tic)
+
+            chunk_success, chunk_errors, rejected = self._classify_items(chunk, items)
+            success += chunk_success
+            errors.extend(chunk_errors)
+
+            if not rejected:
+                break
+            if attempt == self.max_retries:
+                errors.extend(item for _, item in rejected)
+                break
+
+            with self._stats_lock:
+                self.bulk_stats['retries'] += len(rejected)
+            time.sleep(self._backoff(attempt))
+            chunk = [lines for lines, _ in rejected]
+
+        with self._stats_lock:
+            self.bulk_stats['docs'] += success
+        return success, errors
 
     def process_generator(self, generator):
         ts = datetime.datetime.utcnow()
         for data_dict in generator:
-            data_dict.update({'timestamp': ts, '_id': uuid.uuid1(), '_index': self.es_index})
+            if 'point_id' in data_dict:
+                doc_id = self.document_id(data_dict['trip_id'], data_dict['point_id'])
+            elif 'stop_id' in data_dict:
+                doc_id = f"{data_dict['trip_id']}-stop-{data_dict['stop_id']}"
+            else:
+                doc_id = uuid.uuid1()
+            data_dict.update({'timestamp': ts, '_id': doc_id, '_index': self.es_index})
             yield data_dict
 
+    @staticmethod
+    def document_id(trip_id, point_id):
+        """deterministic id of the point document, a retried bulk overwrites the documents instead of duplicating"""
+        return f'{trip_id}-{point_id}'
+
+    def _reset_bulk_stats(self):
+        self.bulk_stats = {'docs': 0, 'bytes': 0, 'chunks': 0, 'retries': 0, 'failed': 0, 'elapsed_s': 0.0,
+                           'serialize_s': 0.0, 'backpressure_s': 0.0, 'latencies_s': list()}
+
+    @staticmethod
+    def _chunk_body(chunk):
+        return b''.join(action + b'\n' + data + b'\n' for action, data in chunk)
+
+    @staticmethod
+    def _classify_items(chunk, items):
+        """splits bulk response items to successes, errors and (lines, item) pairs rejected with 429"""
+        success = 0
+        errors = list()
+        rejected = list()
+        for lines, item in zip(chunk, items):
+            op_result = next(iter(item.values()))
+            status = op_result.get('status', 500)
+            if status == 429:
+                rejected.append((lines, item))
+            elif status >= 300:
+                errors.append(item)
+            else:
+                success += 1
+        return success, errors, rejected
+
+    def _backoff(self, attempt):
+        return min(self.max_backoff, self.initial_backoff * 2 ** attempt)
+
     def index_exists(self):
         exists = self.es.indices.exists(index=self.es_index)
         if not exists:
             raise ValueError(f"{self.es_index} does not exist!")
         return exists
 
+    def check_mapping(self, mappings):
+        """raises ValueError if the index does not map the fields of mappings['properties'] to their types"""
+        for index, index_mapping in self.es.indices.get_mapping(index=self.es_index).items():
+            mapped = index_mapping['mappings'].get('properties', {})
+            for field, field_mapping in mappings['properties'].items():
+                mapped_type = mapped.get(field, {}).get('type')
+                if mapped_type != field_mapping['type']:
+                    raise ValueError(f"{index} maps {field} as {mapped_type} instead of {field_mapping['type']}, "
+                                     f"create the index with the mappings {json.dumps(mappings)}")
+
     def trip_exists(self, trip_id):
         query = {"query": {"term": {"trip_id": trip_id}}}
         try:
-            query_gen = elasticsearch.helpers.scan(self.es, index=self.es_index, query=query, request_timeout=5)
-            return len(list(query_gen)) > 0
+            res = self.es.search(index=self.es_index, body=query, size=0, terminate_after=1, request_timeout=5)
+            return self._total_hits(res) > 0
 
-        except (elasticsearch.ConnectionError, elasticsearch.ConnectionTimeout) as ex:
+        except (_elasticsearch().ConnectionError, _elasticsearch().ConnectionTimeout) as ex:
             self.log.exception(ex)
             self.log.error("Connection to ES server failed!")
             return None
 
+    def ingest_allowed(self, trip_id, trip_exists):
+        """decides on the trip_exists result whether the trip can be ingested, logs the reason if it cannot"""
+        if trip_exists:
+            self.log.warning(f"The trip {trip_id} already exists in the index, skipping ingest")
+            return False
+        if trip_exists is None:
+            self.log.error("Trip ID query failed, cannot ingest")
+            return False
+        return True
+
+    def should_ingest(self, trip_id):
+        """checks the index and whether the trip is already in it, True if the trip can be ingested"""
+        self.index_exists()
+        return self.ingest_allowed(trip_id, self.trip_exists(trip_id))
+
+    def existing_trips(self, trip_ids):
+        """
+        returns the set of trip_ids already present in the index using one request per TERMS_BATCH ids,
+        the trips are checked one by one if the aggregation is rejected, None if the server is not reachable
+        """
+        trip_ids = list(trip_ids)
+        existing = set()
+        try:
+            for start in range(0, len(trip_ids), self.TERMS_BATCH):
+                batch = trip_ids[start:start + self.TERMS_BATCH]
+                query = {"query": {"terms": {"trip_id": batch}},
+                         "aggs": {"trips": {"terms": {"field": "trip_id", "size": len(batch)}}}}
+                res = self.es.search(index=self.es_index, body=query, size=0, request_timeout=10)
+                existing.update(bucket["key"] for bucket in res["aggregations"]["trips"]["buckets"])
+            return existing
+
+        except (_elasticsearch().ConnectionError, _elasticsearch().ConnectionTimeout) as ex:
+            self.log.exception(ex)
+            self.log.error("Connection to ES server failed!")
+            return None
+
+        except _elasticsearch().TransportError as ex:
+            self.log.warning(f"Trip ID aggregation failed ({ex}), checking the trips one by one")
+            existing = set()
+            for trip_id in trip_ids:
+                trip_exists = self.trip_exists(trip_id)
+                if trip_exists is None:
+                    return None
+                if trip_exists:
+                    existing.add(trip_id)
+            return existing
+
+    @staticmethod
+    def _total_hits(res):
+        total = res["hits"]["total"]
+        return total["value"] if isinstance(total, dict) else total
+
     def delete_trip(self, trip_id):
         query = {"query": {"term": {"trip_id": trip_id}}}
         try:
             self.es.delete_by_query(index=self.es_index, body=query)
 
-        except (elasticsearch.ConnectionError, elasticsearch.ConnectionTimeout) as ex:
+        except (_elasticsearch().ConnectionError, _elasticsearch().ConnectionTimeout) as ex:
             self.log.exception(ex)
             self.log.error("Connection to ES server failed!")
 
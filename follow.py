@@ -0,0 +1,226 @@
+import json
+import time
+import pickle
+import hashlib
+import numpy as np
+
+from utils import STATE_DIR, str2path, RunningMedian, datetime64_to_datetime, stage_timer, atomic_write
+from geo import geodesic_counter
+from gpx_stream import read_appended
+from spatial import ReferenceIndex
+from trip_tracker import GpxTripTracker
+
+
+class FollowTripTracker(GpxTripTracker):
+    """
+    Follows a GPX file which is still being written. Every update reads only the points appended
+    since the previous one, continues the odometry from the saved state and ingests only the new point
+    documents, so the cost of the update depends on the number of new points, not on the trip length.
+    The state is saved as JSON in state_dir after the new documents are ingested.
+    """
+
+    STATE_VERSION = 1
+    TAIL_DIGEST_BYTES = 256
+
+    def __init__(self, *args, state_dir=STATE_DIR, **kwargs):
+        super().__init__(*args, **kwargs)
+        if self.layout != 'point' or self.simplify_tolerance_m is not None or self.detect_stops or self.sinks:
+            raise ValueError("follow mode supports only the point layout without simplification, stop detection "
+                             "and output sinks")
+        self.state_dir = str2path(state_dir)
+        self._reference = None
+
+    def state_path(self):
+        """state file of the followed trip, the file path and the index are part of the name"""
+        key = hashlib.sha256(f'{self.track_file_path.resolve()}|{self.es_index}'.encode()).hexdigest()[:16]
+        return self.state_dir / f'{self.track_file_path.stem}-{key}.json'
+
+    def load_state(self):
+        """returns the saved state, None if the trip is followed for the first time"""
+        try:
+            with open(self.state_path(), 'r') as f:
+                state = json.load(f)
+        except FileNotFoundError:
+            return None
+        if state['version'] != self.STATE_VERSION or state['distance_model'] != self.distance_model:
+            raise ValueError(f"{self.state_path()} was saved with other settings, remove it to follow the trip again")
+        return state
+
+    def save_state(self, state):
+        """writes the state atomically, so an interrupted write keeps the old state"""
+        self.state_dir.mkdir(parents=True, exist_ok=True)
+        with atomic_write(self.state_path(), 'w') as f:
+            json.dump(state, f)
+
+    def tail_digest(self, offset):
+        """hash of the bytes preceding offset, detects files rewritten instead of appended"""
+        with open(self.track_file_path, 'rb') as f:
+            start = max(0, offset - self.TAIL_DIGEST_BYTES)
+            f.seek(start)
+            return hashlib.sha256(f.read(offset - start)).hexdigest()
+
+    def read_new_points(self, state):
+        """returns (new track points, offset, sid) of the points appended after the state offset"""
+        offset = state['offset'] if state else 0
+        sid = state['sid'] if state else -1
+        if state and (self.track_file_path.stat().st_size < offset or self.tail_digest(offset) != state['tail_digest']):
+            raise ValueError(f"{self.track_file_path} was rewritten, remove {self.state_path()} to follow it again")
+        return read_appended(self.track_file_path, self.GPS_DTYPE, offset, sid)
+
+    def last_point(self, state):
+        """last ingested point of the state as a single point track array"""
+        last = np.zeros(1, dtype=self.GPS_DTYPE)
+        for field in ('lat', 'lon', 'ele', 'sid', 'pt_type'):
+            last[field] = state['last_point'][field]
+        last['timestamp'] = np.datetime64(state['last_point']['timestamp'], 'ns')
+        return last
+
+    def continue_odometry_from_state(self, track_points, state, dt_median):
+        """
+        odometry of the new track points continuing from the state, the stop threshold uses
+        the running median of the time deltas of the whole trip
+        """
+        if state is None:
+            dt_median.update(np.diff(track_points['timestamp']) / np.timedelta64(1, 's'))
+            return self.tracked_odometry(track_points, dt_median.median())
+
+        last_point = self.last_point(state)
+        timestamps = np.append(last_point['timestamp'], track_points['timestamp'])
+        dt_median.update(np.diff(timestamps) / np.timedelta64(1, 's'))
+        last_odo = np.zeros(1, dtype=self.ODO_DTYPE)
+        for field in ('cum_dist_km', 'total_time_h', 'elev_up_cum_m', 'elev_down_cum_m'):
+            last_odo[field] = state[field]
+        return self.continue_odometry(track_points, last_point, last_odo, dt_median.median())
+
+    def reference_path(self):
+        """file of the parsed and indexed reference track, stored next to the state"""
+        state_path = self.state_path()
+        return state_path.with_name(f'{state_path.stem}-reference.pkl')
+
+    def load_reference(self):
+        """
+        returns (reference points, ReferenceIndex), built once per process and saved next to the state,
+        the saved reference is rebuilt when the reference file changes
+        """
+        stat = self.ref_file_path.stat()
+        key = [str(self.ref_file_path.resolve()), stat.st_size, stat.st_mtime_ns]
+        if self._reference is not None and self._reference[0] == key:
+            return self._reference[1:]
+        reference_path = self.reference_path()
+        try:
+            with open(reference_path, 'rb') as f:
+                reference = pickle.load(f)
+        except (OSError, pickle.UnpicklingError, EOFError, AttributeError, ValueError):
+            reference = None
+        if reference is None or reference[0] != key:
+            ref_points = self.read_file(self.ref_file_path)
+            reference = (key, ref_points, ReferenceIndex(ref_points))
+            self.state_dir.mkdir(parents=True, exist_ok=True)
+            with atomic_write(reference_path) as f:
+                pickle.dump(reference, f, protocol=pickle.HIGHEST_PROTOCOL)
+        self._reference = reference
+        return reference[1:]
+
+    def correct_new_points(self, track_points, state):
+        """corrects the gaps of the new points including the gap between the last ingested and the first new point"""
+        ref_points, ref_index = self.load_reference() if self.ref_file_path else (None, None)
+        if state is None:
+            return self.correct_track_points(track_points, ref_points, ref_index)
+        return self.correct_track_points(np.concatenate((self.last_point(state), track_points)),
+                                         ref_points, ref_index)[1:]
+
+    def update(self):
+        """one follow step, returns the trip overview, None if no new points were written"""
+        state = self.load_state()
+        with stage_timer(self.timings, 'read'):
+            track_pts, offset, sid = self.read_new_points(state)
+        if not len(track_pts):
+            self.log.info(f'No new points in {self.track_file_path.name}')
+            return None
+        if not self._is_tracked(track_pts):
+            raise ValueError("follow mode needs a tracked trip with timestamps")
+        if self.ref_file_path or self.ref_library:
+            with stage_timer(self.timings, 'correct'):
+                track_pts = self.correct_new_points(track_pts, state)
+
+        if state is None and self.es_index is not None and not self.can_follow():
+            return None
+
+        with stage_timer(self.timings, 'odometry'):
+            dt_median = RunningMedian.from_dict(state['dt_median']) if state else RunningMedian()
+            odo = self.continue_odometry_from_state(track_pts, state, dt_median)
+
+        first_point_id = state['points'] + 1 if state else 1
+        new_state = self.next_state(state, track_pts, odo, offset, sid, dt_median)
+        global_message = self.summarize_state(new_state)
+
+        with stage_timer(self.timings, 'ingest'):
+            if self.es_index is not None:
+                self.log.info(f'Ingesting {len(track_pts)} new trip points...')
+                if self.fast_serialization:
+                    self.bulk_push_lines(self.encode_points(track_pts, odo, 'driven', first_point_id))
+                else:
+                    self.bulk_push(self.ingest_generator(track_pts, odo, 'driven', first_point_id))
+                self.push(dict(global_message), doc_id=global_message['trip_id'])
+
+        self.save_state(new_state)
+        return global_message
+
+    def can_follow(self):
+        """
+        the trip can be followed if it is not in the index yet or if its point documents have deterministic ids,
+        e.g. when the first update was interrupted, a trip ingested with random document ids is skipped
+        """
+        self.index_exists()
+        trip_id = self.track_file_path.stem
+        trip_exists = self.trip_exists(trip_id)
+        if trip_exists and self.es.exists(index=self.es_index, id=self.document_id(trip_id, 1)):
+            return True
+        return self.ingest_allowed(trip_id, trip_exists)
+
+    def next_state(self, state, track_pts, odo, offset, sid, dt_median):
+        """state after ingesting the new track points"""
+        last_pt = track_pts[-1]
+        elevations = track_pts['ele'] if state is None else np.append(track_pts['ele'],
+                                                                       [state['max_elev_m'], state['min_elev_m']])
+        return {'version': self.STATE_VERSION,
+                'trip_id': self.track_file_path.stem,
+                'distance_model': self.distance_model,
+                'offset': offset,
+                'tail_digest': self.tail_digest(offset),
+                'sid': sid,
+                'points': (state['points'] if state else 0) + len(track_pts),
+                'last_point': {'lat': float(last_pt['lat']),
+                               'lon': float(last_pt['lon']),
+                               'ele': float(last_pt['ele']),
+                               'timestamp': str(last_pt['timestamp']),
+                               'sid': int(last_pt['sid']),
+                               'pt_type': str(last_pt['pt_type'])},
+                'trip_start_utc': state['trip_start_utc'] if state else str(track_pts[0]['timestamp']),
+                'cum_dist_km': float(odo['cum_dist_km'][-1]),
+                'total_time_h': float(odo['total_time_h'][-1]),
+                'elev_up_cum_m': float(odo['elev_up_cum_m'][-1]),
+                'elev_down_cum_m': float(odo['elev_down_cum_m'][-1]),
+                'max_elev_m': float(np.max(elevations)),
+                'min_elev_m': float(np.min(elevations)),
+                'dt_median': dt_median.to_dict()}
+
+    def summarize_state(self, state):
+        """trip overview message of the followed trip"""
+        return self.overview('driven',
+                             datetime64_to_datetime(np.datetime64(state['trip_start_utc'], 'ns')),
+                             datetime64_to_datetime(np.datetime64(state['last_point']['timestamp'], 'ns')),
+                             state['cum_dist_km'], state['total_time_h'], state['max_elev_m'], state['min_elev_m'])
+
+    def run(self, interval_s=None):
+        """runs a single update, or updates every interval_s seconds until interrupted"""
+        while True:
+            with stage_timer(self.timings, 'run'), geodesic_counter(self.counters):
+                overview = self.update()
+            if overview is not None:
+                self.log.info(f'{overview}')
+                if self.bulk_stats:
+                    self.log.info(self.bulk_report())
+            if interval_s is None:
+                return overview
+            time.sleep(interval_s)
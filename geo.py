@@ -1,7 +1,8 @@
+import contextlib
 import numpy as np
 
 
-def geodesic_distance(lat1, lat2, lon1, lon2):
+def geodesic_distance(lat1, lat2, lon1, lon2, max_iter=200):
     """
     Calculates geodesic distance of two points (P1, P2) described by lat, lon pairs
     using Vincenty's algorithm of the inverse formula.
@@ -11,6 +12,7 @@ def geodesic_distance(lat1, lat2, lon1, lon2):
     :param lat2: latitude [rad] of point P2
     :param lon1: longitude [rad] of point P1
     :param lon2: longitude [rad] of point P2
+    :param max_iter: maximal number of iterations, guards slowly converging nearly antipodal points
     :return: geodesic distance [m] of points P1 and P2
     """
     if lon1 == lon2 and lat1 == lat2:
@@ -20,15 +22,17 @@ def geodesic_distance(lat1, lat2, lon1, lon2):
     b = 6356752.3142
     f = 1 / 298.257223563
     eps = 1e-5
-    precision = 1e-9
+    precision = 1e-12
 
-    lon_delta = np.abs(lon1 - lon2)
+    lon_delta = np.abs((lon2 - lon1 + np.pi) % (2 * np.pi) - np.pi)
     u1 = np.arctan((1 - f) * np.tan(lat1))
     u2 = np.arctan((1 - f) * np.tan(lat2))
     lam = lon_delta
     lam_hat = 2 * np.pi
+    iteration = 0
 
-    while np.abs(lam - lam_hat) > precision:
+    while np.abs(lam - lam_hat) > precision * lon_delta and iteration < max_iter:
+        iteration += 1
         sin_lam = np.sin(lam)
         cos_lam = np.cos(lam)
         sin_u1 = np.sin(u1)
@@ -45,13 +49,14 @@ def geodesic_distance(lat1, lat2, lon1, lon2):
         sin_alpha = cos_u1_u2 * sin_lam / sin_sigma
         cos_alpha_sq = 1 - sin_alpha**2
 
-        cos2sigma_m = cos_sigma - 2 * sin_u1_u2 / cos_alpha_sq
         if cos_alpha_sq < eps:
             cos2sigma_m = 0
+        else:
+            cos2sigma_m = cos_sigma - 2 * sin_u1_u2 / cos_alpha_sq
 
-        c = f / (16 * cos_alpha_sq * (4 + f * (4 - 3 * cos_alpha_sq)))
+        c = f / 16 * cos_alpha_sq * (4 + f * (4 - 3 * cos_alpha_sq))
         lam_hat = lam
-        lam = lon_delta + (1 - c) * f * sin_alpha * (sigma + c * sin_sigma * (cos2sigma_m + c * cos_sigma * (-1 + 2 * cos2sigma_m)))
+        lam = lon_delta + (1 - c) * f * sin_alpha * (sigma + c * sin_sigma * (cos2sigma_m + c * cos_sigma * (-1 + 2 * cos2sigma_m**2)))
 
     u_sq = cos_alpha_sq * (a**2 - b**2) / b**2
     a_cor = 1 + (u_sq / 16384) * (4096 + u_sq * (-768 + u_sq * (320 - 175 * u_sq)))
@@ -61,7 +66,166 @@ def geodesic_distance(lat1, lat2, lon1, lon2):
     return distance
 
 
-def calculate_distance(pt1, pt2):
+def geodesic_distances(lat1, lat2, lon1, lon2, max_iter=200):
+    """
+    Vectorized variant of geodesic_distance, calculates geodesic distances of point pairs (P1, P2)
+    described by lat, lon arrays. Inputs are broadcast against each other, so a single point can be
+    evaluated against many. Vincenty's iteration runs on all pairs together, pairs that have converged
+    are masked out of the following iterations.
+    :param lat1: latitudes [rad] of points P1
+    :param lat2: latitudes [rad] of points P2
+    :param lon1: longitudes [rad] of points P1
+    :param lon2: longitudes [rad] of points P2
+    :param max_iter: maximal number of iterations, guards slowly converging nearly antipodal pairs
+    :return: array of geodesic distances [m] of points P1 and P2
+    """
+    lat1, lat2, lon1, lon2 = np.broadcast_arrays(*(np.asarray(x, dtype='f8') for x in (lat1, lat2, lon1, lon2)))
+    distance = np.zeros(lat1.shape)
+    valid = ~((lon1 == lon2) & (lat1 == lat2))
+    GEODESIC_STATS['calls'] += 1
+    GEODESIC_STATS['pairs'] += lat1.size
+    if not valid.any():
+        return distance
+
+    a = 6378137
+    b = 6356752.3142
+    f = 1 / 298.257223563
+    eps = 1e-5
+    precision = 1e-12
+
+    lon_delta = np.abs((lon2[valid] - lon1[valid] + np.pi) % (2 * np.pi) - np.pi)
+    u1 = np.arctan((1 - f) * np.tan(lat1[valid]))
+    u2 = np.arctan((1 - f) * np.tan(lat2[valid]))
+    sin_u1 = np.sin(u1)
+    cos_u1 = np.cos(u1)
+    sin_u2 = np.sin(u2)
+    cos_u2 = np.cos(u2)
+    cos_u1_u2 = cos_u1 * cos_u2
+    sin_u1_u2 = sin_u1 * sin_u2
+
+    lam = lon_delta.copy()
+    sin_sigma = np.zeros_like(lam)
+    cos_sigma = np.zeros_like(lam)
+    sigma = np.zeros_like(lam)
+    cos_alpha_sq = np.zeros_like(lam)
+    cos2sigma_m = np.zeros_like(lam)
+    active = np.arange(len(lam))
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        for _ in range(max_iter):
+            GEODESIC_STATS['iterations'] += 1
+            GEODESIC_STATS['pair_iterations'] += len(active)
+            lam_act = lam[active]
+            sin_lam = np.sin(lam_act)
+            cos_lam = np.cos(lam_act)
+
+            sin_sig = np.sqrt((cos_u2[active] * sin_lam)**2 +
+                              (cos_u1[active] * sin_u2[active] - sin_u1[active] * cos_u2[active] * cos_lam)**2)
+            cos_sig = sin_u1_u2[active] + cos_u1_u2[active] * cos_lam
+            sig = np.arctan2(sin_sig, cos_sig)
+
+            sin_alpha = cos_u1_u2[active] * sin_lam / sin_sig
+            cos_alp_sq = 1 - sin_alpha**2
+
+            cos2sig_m = cos_sig - 2 * sin_u1_u2[active] / cos_alp_sq
+            cos2sig_m[cos_alp_sq < eps] = 0
+
+            c = f / 16 * cos_alp_sq * (4 + f * (4 - 3 * cos_alp_sq))
+            lam_new = lon_delta[active] + (1 - c) * f * sin_alpha * (sig + c * sin_sig * (cos2sig_m + c * cos_sig * (-1 + 2 * cos2sig_m**2)))
+
+            sin_sigma[active] = sin_sig
+            cos_sigma[active] = cos_sig
+            sigma[active] = sig
+            cos_alpha_sq[active] = cos_alp_sq
+            cos2sigma_m[active] = cos2sig_m
+            lam[active] = lam_new
+
+            active = active[np.abs(lam_new - lam_act) > precision * lon_delta[active]]
+            if not len(active):
+                break
+
+    u_sq = cos_alpha_sq * (a**2 - b**2) / b**2
+    a_cor = 1 + (u_sq / 16384) * (4096 + u_sq * (-768 + u_sq * (320 - 175 * u_sq)))
+    b_cor = (u_sq / 1024) * (256 + u_sq * (-128 + u_sq * (74 - 47 * u_sq)))
+    sigma_delta = b_cor * sin_sigma * (cos2sigma_m + b_cor * 0.25 * (cos_sigma * (-1 + 2 * cos2sigma_m**2) - b_cor * cos2sigma_m * (-3 + 4 * sin_sigma**2) * (-3 + 4 * cos2sigma_m**2) / 6))
+    distance[valid] = b * a_cor * (sigma - sigma_delta)
+    return distance
+
+
+def haversine_distances(lat1, lat2, lon1, lon2):
+    """
+    Calculates great-circle distances of point pairs on the sphere of the mean Earth radius using the haversine formula.
+    :param lat1: latitudes [rad] of points P1
+    :param lat2: latitudes [rad] of points P2
+    :param lon1: longitudes [rad] of points P1
+    :param lon2: longitudes [rad] of points P2
+    :return: array of distances [m] of points P1 and P2
+    """
+    lat1, lat2, lon1, lon2 = np.broadcast_arrays(*(np.asarray(x, dtype='f8') for x in (lat1, lat2, lon1, lon2)))
+    h = np.sin((lat2 - lat1) / 2)**2 + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2)**2
+    return 2 * MEAN_EARTH_RADIUS_M * np.arcsin(np.sqrt(np.clip(h, 0, 1)))
+
+
+def flat_earth_distances(lat1, lat2, lon1, lon2):
+    """
+    Calculates distances of point pairs in the local tangent plane using the WGS84 meridional and prime vertical
+    radii of curvature at the mean latitude of the pair. Accurate for points a few kilometers apart.
+    :param lat1: latitudes [rad] of points P1
+    :param lat2: latitudes [rad] of points P2
+    :param lon1: longitudes [rad] of points P1
+    :param lon2: longitudes [rad] of points P2
+    :return: array of distances [m] of points P1 and P2
+    """
+    lat1, lat2, lon1, lon2 = np.broadcast_arrays(*(np.asarray(x, dtype='f8') for x in (lat1, lat2, lon1, lon2)))
+    a = 6378137
+    f = 1 / 298.257223563
+    e_sq = f * (2 - f)
+    lat_mean = (lat1 + lat2) / 2
+    w_sq = 1 - e_sq * np.sin(lat_mean)**2
+    meridional = a * (1 - e_sq) / w_sq**1.5
+    prime_vertical = a / np.sqrt(w_sq)
+    lon_delta = (lon2 - lon1 + np.pi) % (2 * np.pi) - np.pi
+    return np.hypot(meridional * (lat2 - lat1), prime_vertical * np.cos(lat_mean) * lon_delta)
+
+
+def auto_distances(lat1, lat2, lon1, lon2, threshold_m=None):
+    """
+    Uses the flat earth model for point pairs closer than threshold_m and Vincenty's algorithm for the rest.
+    :return: array of distances [m] of points P1 and P2
+    """
+    threshold_m = AUTO_THRESHOLD_M if threshold_m is None else threshold_m
+    lat1, lat2, lon1, lon2 = np.broadcast_arrays(*(np.asarray(x, dtype='f8') for x in (lat1, lat2, lon1, lon2)))
+    distance = np.array(flat_earth_distances(lat1, lat2, lon1, lon2), ndmin=1)
+    far = ~(distance < threshold_m)
+    if far.any():
+        distance[far] = geodesic_distances(*(np.array(x, ndmin=1)[far] for x in (lat1, lat2, lon1, lon2)))
+    return distance.reshape(lat1.shape)
+
+
+MEAN_EARTH_RADIUS_M = 6371008.8
+AUTO_THRESHOLD_M = 1000
+# counters of the vectorized Vincenty calls, evaluated point pairs, iteration rounds and pair iterations
+# of the process, the scalar geodesic_distance of the gap correction is not counted
+GEODESIC_STATS = {'calls': 0, 'pairs': 0, 'iterations': 0, 'pair_iterations': 0}
+DISTANCE_MODELS = {'vincenty': geodesic_distances,
+                   'haversine': haversine_distances,
+                   'flat': flat_earth_distances,
+                   'auto': auto_distances}
+
+
+@contextlib.contextmanager
+def geodesic_counter(counters):
+    """stores the GEODESIC_STATS increments of the block to counters['geodesic']"""
+    start = dict(GEODESIC_STATS)
+    try:
+        yield
+    finally:
+        counters['geodesic'] = {key: GEODESIC_STATS[key] - start[key] for key in GEODESIC_STATS}
+
+
+def calculate_distance(pt1, pt2, model='vincenty'):
+    if model != 'vincenty':
+        return float(calculate_distances(pt1, pt2, model))
     dist = geodesic_distance(np.deg2rad(pt1['lat']),
                              np.deg2rad(pt2['lat']),
                              np.deg2rad(pt1['lon']),
@@ -69,11 +233,55 @@ def calculate_distance(pt1, pt2):
     return dist
 
 
+def calculate_distances(pts1, pts2, model='vincenty'):
+    """calculates distances [m] between points pts1 and pts2 using the model, both can be arrays or a single point"""
+    dist = DISTANCE_MODELS[model](np.deg2rad(pts1['lat']),
+                                  np.deg2rad(pts2['lat']),
+                                  np.deg2rad(pts1['lon']),
+                                  np.deg2rad(pts2['lon']))
+    return dist
+
+
+def consecutive_distances(points, model='vincenty'):
+    """calculates distances [m] between each pair of consecutive points"""
+    return calculate_distances(points[:-1], points[1:], model)
+
+
+def geodetic_to_ecef(lat, lon):
+    """converts lat, lon [deg] of points on the WGS84 ellipsoid surface to ECEF coordinates [m], shape (n, 3)"""
+    a = 6378137
+    f = 1 / 298.257223563
+    e_sq = f * (2 - f)
+    lat = np.deg2rad(np.asarray(lat, dtype='f8'))
+    lon = np.deg2rad(np.asarray(lon, dtype='f8'))
+    sin_lat = np.sin(lat)
+    n = a / np.sqrt(1 - e_sq * sin_lat**2)
+    x = n * np.cos(lat) * np.cos(lon)
+    y = n * np.cos(lat) * np.sin(lon)
+    z = n * (1 - e_sq) * sin_lat
+    return np.stack((x, y, z), axis=-1)
+
+
 if __name__ == "__main__":
-    expected = 13308.3511
+    expected = 13308.3461
     lt1, lo1, lt2, lo2 = 49.0, 14.0, 49.1, 14.1
     point1 = {'lat': lt1, 'lon': lo1}
     point2 = {'lat': lt2, 'lon': lo2}
 
     out = calculate_distance(point1, point2)
     np.testing.assert_approx_equal(out, expected, 9)
+
+    lats = np.array([lt1, lt2, 49.2, 49.2, -33.9, 0.5])
+    lons = np.array([lo1, lo2, 14.1, 14.1, 151.2, -179.5])
+    points = np.array(list(zip(lats, lons)), dtype=[('lat', 'f8'), ('lon', 'f8')])
+    out = consecutive_distances(points)
+    for idx, dist in enumerate(out):
+        np.testing.assert_approx_equal(dist, calculate_distance(points[idx], points[idx + 1]), 9)
+    out = calculate_distances(point1, points)
+    for idx, dist in enumerate(out):
+        np.testing.assert_approx_equal(dist, calculate_distance(point1, points[idx]), 9)
+
+    for model in DISTANCE_MODELS:
+        np.testing.assert_allclose(calculate_distance(point1, point2, model), expected, rtol=5e-3)
+    near = {'lat': lt1 + 1e-4, 'lon': lo1 + 1e-4}
+    np.testing.assert_allclose(calculate_distance(point1, near, 'flat'), calculate_distance(point1, near), atol=1e-3)
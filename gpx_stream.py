@@ -0,0 +1,250 @@
+import re
+import datetime
+import time
+import logging
+import xml.etree.ElementTree as ET
+import numpy as np
+
+
+GPX_NAMESPACES = ('http://www.topografix.com/GPX/1/1', 'http://www.topografix.com/GPX/1/0')
+BLOCK_SIZE = 8192
+APPEND_READ_BYTES = 1 << 20
+TAIL_SUBSTITUTIONS = ((re.compile(rb'<\?.*?\?>|</?gpx\b[^>]*>|</trkseg>|</trk>'), b''),
+                      (re.compile(rb'<extensions\b.*?</extensions>', re.DOTALL), b''),
+                      (re.compile(rb'<trkseg\b[^>]*>'), b'<trkseg/>'),
+                      (re.compile(rb'<trk\b[^>]*>'), b'<trk/>'))
+
+
+class UnsupportedGpxError(ValueError):
+    """raised when the GPX file cannot be handled by the streaming reader"""
+
+
+class GrowableArray:
+    """structured array preallocated in advance, the capacity is doubled when it is exhausted"""
+
+    def __init__(self, dtype, capacity=BLOCK_SIZE):
+        self._buffer = np.empty(capacity, dtype=dtype)
+        self._size = 0
+
+    def __len__(self):
+        return self._size
+
+    def extend(self, block):
+        required = self._size + len(block)
+        if required > len(self._buffer):
+            capacity = max(required, 2 * len(self._buffer))
+            buffer = np.empty(capacity, dtype=self._buffer.dtype)
+            buffer[:self._size] = self._buffer[:self._size]
+            self._buffer = buffer
+        self._buffer[self._size:required] = block
+        self._size = required
+
+    def to_array(self):
+        """returns the filled part of the buffer, trimmed copy is made only if the spare capacity is large"""
+        if self._size < len(self._buffer) // 2:
+            return self._buffer[:self._size].copy()
+        return self._buffer[:self._size]
+
+
+def parse_timestamps(times):
+    """converts GPX time strings to datetime64[ns] UTC timestamps, None is converted to NaT"""
+    parsed = list()
+    for text in times:
+        if text is None:
+            parsed.append('NaT')
+        elif text.endswith('Z'):
+            parsed.append(text[:-1])
+        elif len(text) > 19 and text[-6] in '+-':
+            try:
+                ts = datetime.datetime.fromisoformat(text)
+            except ValueError as ex:
+                raise UnsupportedGpxError(f'Unsupported time format: {text}') from ex
+            parsed.append(ts.astimezone(datetime.timezone.utc).replace(tzinfo=None).isoformat())
+        else:
+            parsed.append(text)
+    try:
+        return np.array(parsed, dtype='M8[ns]')
+    except ValueError as ex:
+        raise UnsupportedGpxError(f'Unsupported time format: {ex}') from ex
+
+
+class _PointBlock:
+    """column buffers of the points that were parsed, but not yet written to the output array"""
+
+    def __init__(self):
+        self.lats = list()
+        self.lons = list()
+        self.eles = list()
+        self.times = list()
+        self.sids = list()
+
+    def __len__(self):
+        return len(self.lats)
+
+    def append(self, lat, lon, ele, timestamp, sid):
+        self.lats.append(lat)
+        self.lons.append(lon)
+        self.eles.append(ele)
+        self.times.append(timestamp)
+        self.sids.append(sid)
+
+    def flush(self, dtype, pt_type='original'):
+        block = np.empty(len(self), dtype=dtype)
+        block['lat'] = self.lats
+        block['lon'] = self.lons
+        block['ele'] = self.eles
+        block['timestamp'] = parse_timestamps(self.times)
+        block['sid'] = self.sids
+        block['pt_type'] = pt_type
+        self.__init__()
+        return block
+
+
+def _local_name(tag):
+    return tag.rsplit('}', 1)[-1]
+
+
+def _namespace(tag):
+    return tag[1:].split('}', 1)[0] if tag.startswith('{') else ''
+
+
+def read_point(elem, namespace):
+    """extracts lat, lon, ele and time string of the trkpt element"""
+    try:
+        lat = float(elem.attrib['lat'])
+        lon = float(elem.attrib['lon'])
+        ele = elem.findtext(f'{{{namespace}}}ele' if namespace else 'ele')
+        ele = float(ele) if ele else np.nan
+    except (KeyError, ValueError) as ex:
+        raise UnsupportedGpxError(f'Unsupported track point: {ET.tostring(elem)[:200]}') from ex
+    timestamp = elem.findtext(f'{{{namespace}}}time' if namespace else 'time')
+    timestamp = timestamp.strip() if timestamp else None
+    return lat, lon, ele, timestamp
+
+
+def iter_blocks(file_path, dtype, block_size=BLOCK_SIZE):
+    """
+    Parses trkpt elements of the GPX file incrementally and yields them as structured arrays
+    of at most block_size points. Segment id is the index of the segment within its track.
+    """
+    block = _PointBlock()
+    sid = -1
+    namespace = None
+    root = None
+    segment = None
+    try:
+        for event, elem in ET.iterparse(file_path.as_posix(), events=('start', 'end')):
+            name = _local_name(elem.tag)
+            if root is None:
+                root = elem
+                namespace = _namespace(elem.tag)
+                if name != 'gpx' or namespace not in GPX_NAMESPACES:
+                    raise UnsupportedGpxError(f'Unsupported GPX root element: {elem.tag}')
+
+            if event == 'start':
+                if name == 'trk':
+                    sid = -1
+                elif name == 'trkseg':
+                    sid += 1
+                    segment = elem
+
+            elif name == 'trkpt':
+                block.append(*read_point(elem, namespace), sid)
+                elem.clear()
+                if segment is not None:
+                    segment.remove(elem)
+                if len(block) >= block_size:
+                    yield block.flush(dtype)
+
+            elif name in ('trk', 'trkseg', 'rte', 'wpt', 'metadata'):
+                elem.clear()
+                if name == 'trkseg':
+                    segment = None
+
+    except ET.ParseError as ex:
+        raise UnsupportedGpxError(f'{file_path} cannot be parsed: {ex}') from ex
+
+    if len(block):
+        yield block.flush(dtype)
+
+
+def read_gpx(file_path, dtype, block_size=BLOCK_SIZE):
+    """reads all track points of the GPX file into a single structured array"""
+    log = logging.getLogger('root')
+    tic = time.perf_counter()
+    track_points = GrowableArray(dtype, block_size)
+    for block in iter_blocks(file_path, dtype, block_size):
+        track_points.extend(block)
+    elapsed = time.perf_counter() - tic
+    count = len(track_points)
+    log.info(f'Parsed {count} points from {file_path.name} in {elapsed:.3f} s '
+             f'({count / elapsed if elapsed > 0 else 0:.0f} points/s)')
+    return track_points.to_array()
+
+
+def complete_points_end(tail):
+    """position in tail after the last completely written trkpt element, 0 if there is none"""
+    start = tail.rfind(b'<trkpt')
+    while start >= 0:
+        tag_end = tail.find(b'>', start)
+        if tag_end >= 0 and tail[tag_end - 1:tag_end] == b'/':
+            return tag_end + 1
+        elem_end = tail.find(b'</trkpt>', start)
+        if elem_end >= 0:
+            return elem_end + len(b'</trkpt>')
+        start = tail.rfind(b'<trkpt', 0, start)
+    return 0
+
+
+def read_appended(file_path, dtype, offset=0, sid=-1, read_bytes=APPEND_READ_BYTES):
+    """
+    Reads the track points completely written after the byte offset of the GPX file, which may still be
+    growing and miss its closing tags. Returns (track points, offset after the last complete point, sid of
+    the last segment). Only the new part of the file is read, in blocks of read_bytes, so the memory does not
+    grow with the size of the new part beyond the parsed points. Extensions of the points are ignored.
+    """
+    track_points = GrowableArray(dtype)
+    block = _PointBlock()
+    parser = ET.XMLPullParser(events=('start', 'end'))
+    parser.feed(b'<tail>')
+    root = None
+    depth = 0
+    pending = b''
+    end_offset = offset
+    with open(file_path, 'rb') as f:
+        f.seek(offset)
+        for data in iter(lambda: f.read(read_bytes), b''):
+            pending += data
+            end = complete_points_end(pending)
+            if not end:
+                continue
+            body = pending[:end]
+            pending = pending[end:]
+            end_offset += end
+            for pattern, replacement in TAIL_SUBSTITUTIONS:
+                body = pattern.sub(replacement, body)
+
+            try:
+                parser.feed(body)
+                for event, elem in parser.read_events():
+                    if event == 'start':
+                        root = elem if root is None else root
+                        depth += 1
+                        continue
+                    depth -= 1
+                    name = elem.tag if elem.tag in ('trkpt', 'trk', 'trkseg') else _local_name(elem.tag)
+                    if name == 'trkpt':
+                        block.append(*read_point(elem, _namespace(elem.tag)), sid)
+                    elif name == 'trk':
+                        sid = -1
+                    elif name == 'trkseg':
+                        sid += 1
+                    if depth == 1:
+                        root.remove(elem)
+            except ET.ParseError as ex:
+                raise UnsupportedGpxError(f'{file_path} cannot be parsed after offset {offset}: {ex}') from ex
+            if len(block) >= BLOCK_SIZE:
+                track_points.extend(block.flush(dtype))
+
+    track_points.extend(block.flush(dtype))
+    return track_points.to_array(), end_offset, sid
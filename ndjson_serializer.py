@@ -0,0 +1,198 @@
+import json
+import uuid
+import datetime
+import numpy as np
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+NON_FINITE = {'NaN', 'Infinity', '-Infinity'}
+
+
+def dumps(obj):
+    """JSON encoding to str, orjson is used when it is installed"""
+    if orjson is not None:
+        return orjson.dumps(obj).decode('utf-8')
+    return json.dumps(obj, separators=(',', ':'))
+
+
+def _default(obj):
+    """values of the documents the JSON encoders do not handle, encoded like the elasticsearch JSONSerializer"""
+    if isinstance(obj, (datetime.date, datetime.datetime)):
+        return obj.isoformat()
+    if isinstance(obj, uuid.UUID):
+        return str(obj)
+    if isinstance(obj, np.generic):
+        return obj.item()
+    raise TypeError(f'Unable to serialize {obj!r} (type: {type(obj)})')
+
+
+class DocumentSerializer:
+    """serializer of the document dicts used without the elasticsearch client, same interface as its serializer"""
+
+    def dumps(self, data):
+        if orjson is not None:
+            return orjson.dumps(data, default=_default, option=orjson.OPT_SERIALIZE_NUMPY).decode('utf-8')
+        return json.dumps(data, default=_default, separators=(',', ':'))
+
+
+def bulk_action_prefix(index):
+    """start of the bulk index action up to the document id, without an index it is left to the bulk request"""
+    return '{"index":{' + (f'"_index":{dumps(index)},' if index is not None else '') + '"_id":'
+
+
+def encode_numbers(column):
+    """encodes numeric column to the list of JSON values with a single encoder call, non finite values are null"""
+    if not len(column):
+        return []
+    values = dumps(column.tolist())[1:-1].split(',')
+    if orjson is None and column.dtype.kind == 'f' and not np.isfinite(column).all():
+        values = ['null' if value in NON_FINITE else value for value in values]
+    return values
+
+
+def encode_strings(column):
+    """encodes string column to the list of JSON strings, every distinct value is encoded only once"""
+    values, inverse = np.unique(column, return_inverse=True)
+    encoded = [dumps(value) for value in values.tolist()]
+    return [encoded[idx] for idx in inverse.ravel().tolist()]
+
+
+def encode_timestamps(column, fallback):
+    """encodes datetime64 column to the list of JSON ISO strings, NaT is replaced by the fallback datetime"""
+    values = np.datetime_as_string(column, unit='us').astype(object)
+    values[np.isnat(column)] = np.datetime64(fallback, 'us').astype(str)
+    return [f'"{value}"' for value in values.tolist()]
+
+
+class PointDocumentEncoder:
+    """
+    Builds the bulk (action line, data line) pairs of the point documents directly from the track points
+    and odometry arrays. Per-trip constant fields are encoded once, the columns are encoded in batches
+    and combined with a string template instead of creating a dict per point.
+    """
+
+    DATA_TEMPLATE = ('{{"location":{{"lat":{},"lon":{}}},"elevation_m":{},"point_timestamp_utc":{},'
+                     '"point_id":{},"cumulative_distance_km":{},"cumulative_time_h":{},'
+                     '"average_velocity_kmh":{},"point_type":{},')
+    BATCH_SIZE = 4096
+
+    def __init__(self, index, constant_fields):
+        id_prefix = dumps(f"{constant_fields['trip_id']}-")[:-1]
+        self.action_prefix = bulk_action_prefix(index) + id_prefix
+        self.data_suffix = dumps(constant_fields)[1:]
+
+    def encode(self, track_points, odometry, fallback_timestamp, first_point_id=1):
+        """yields (action line, data line) pairs of bytes for every point"""
+        for start in range(0, len(track_points), self.BATCH_SIZE):
+            track_batch = track_points[start:start + self.BATCH_SIZE]
+            odo_batch = odometry[start:start + self.BATCH_SIZE]
+            point_ids = np.arange(first_point_id + start, first_point_id + start + len(track_batch))
+            columns = (encode_numbers(track_batch['lat']),
+                       encode_numbers(track_batch['lon']),
+                       encode_numbers(track_batch['ele']),
+                       encode_timestamps(track_batch['timestamp'], fallback_timestamp),
+                       encode_numbers(point_ids),
+                       encode_numbers(odo_batch['cum_dist_km']),
+                       encode_numbers(odo_batch['total_time_h']),
+                       encode_numbers(odo_batch['avg_vel_kmh']),
+                       encode_strings(track_batch['pt_type']))
+            template = self.DATA_TEMPLATE
+            suffix = self.data_suffix
+            prefix = self.action_prefix
+            for values in zip(*columns):
+                action = f'{prefix}{values[4]}"}}}}'
+                yield action.encode('utf-8'), (template.format(*values) + suffix).encode('utf-8')
+
+
+def finite_list(column):
+    """converts float column to list, non finite values are converted to None"""
+    if np.isfinite(column).all():
+        return column.tolist()
+    return np.where(np.isfinite(column), column, None).tolist()
+
+
+class TrackChunkEncoder:
+    """
+    Builds the bulk (action line, data line) pairs of the compact layout, where every document holds
+    a chunk of the track as a geo_shape linestring and parallel arrays of elevation, time offsets
+    and cumulative distance. Neighbouring chunks share their boundary point, so the trajectory is continuous.
+    The index has to map the trajectory as geo_shape before the first ingest, see MAPPINGS.
+    """
+
+    # explicit mappings of the index, the dynamic mapping would map the linestring as an object
+    MAPPINGS = {"properties": {"trajectory": {"type": "geo_shape"}}}
+
+    def __init__(self, index, constant_fields, chunk_size=None):
+        self.action_prefix = bulk_action_prefix(index)
+        self.constant_fields = constant_fields
+        self.chunk_size = chunk_size
+
+    def chunk_bounds(self, count):
+        """returns (start, end) index pairs of the chunks, end is inclusive"""
+        if count < 2:
+            return [(0, count - 1)] if count else []
+        chunk_size = self.chunk_size or count
+        return [(start, min(start + chunk_size, count - 1)) for start in range(0, count - 1, chunk_size)]
+
+    def encode(self, track_points, odometry, fallback_timestamp, first_point_id=1):
+        """yields (action line, data line) pairs of bytes for every chunk"""
+        fallback = np.datetime64(fallback_timestamp, 'ns')
+        for chunk_id, (start, end) in enumerate(self.chunk_bounds(len(track_points))):
+            track_chunk = track_points[start:end + 1]
+            odo_chunk = odometry[start:end + 1]
+            timestamps = np.where(np.isnat(track_chunk['timestamp']), fallback, track_chunk['timestamp'])
+            coordinates = np.stack((track_chunk['lon'], track_chunk['lat']), axis=-1).tolist()
+            if len(coordinates) > 1:
+                shape = {"type": "linestring", "coordinates": coordinates}
+            else:
+                shape = {"type": "point", "coordinates": coordinates[0]}
+
+            data = {"trajectory": shape,
+                    "chunk_id": chunk_id,
+                    "point_id_start": first_point_id + start,
+                    "point_count": len(track_chunk),
+                    "chunk_start_utc": np.datetime_as_string(timestamps[0], unit='us'),
+                    "chunk_end_utc": np.datetime_as_string(timestamps[-1], unit='us'),
+                    "elevation_m": finite_list(track_chunk['ele']),
+                    "time_offset_s": ((timestamps - timestamps[0]) / np.timedelta64(1, 's')).tolist(),
+                    "cumulative_distance_km": finite_list(odo_chunk['cum_dist_km']),
+                    "cumulative_time_h": finite_list(odo_chunk['total_time_h']),
+                    "average_velocity_kmh": finite_list(odo_chunk['avg_vel_kmh']),
+                    "point_type": track_chunk['pt_type'].tolist()}
+            data.update(self.constant_fields)
+            action = self.action_prefix + dumps(f"{self.constant_fields['trip_id']}-chunk-{chunk_id}") + '}}'
+            yield action.encode('utf-8'), dumps(data).encode('utf-8')
+
+
+if __name__ == "__main__":
+    import argparse
+    import time
+    from trip_tracker import GpxTripTracker
+
+    argp = argparse.ArgumentParser()
+    argp.add_argument('--gpx-file',
+                      dest='gpx_file',
+                      help='path to the file used for the serialization benchmark',
+                      required=True)
+    args = argp.parse_args()
+
+    tracker = GpxTripTracker('bike', args.gpx_file, index='benchmark')
+    track_pts, odo = tracker.process()
+
+    tic = time.perf_counter()
+    dict_bytes = sum(len(action) + len(data) + 2 for action, data in
+                     tracker._serialize_actions(tracker.process_generator(tracker.ingest_generator(track_pts, odo,
+                                                                                                   'driven'))))
+    dict_elapsed = time.perf_counter() - tic
+
+    tic = time.perf_counter()
+    fast_bytes = sum(len(action) + len(data) + 2 for action, data in tracker.encode_points(track_pts, odo, 'driven'))
+    fast_elapsed = time.perf_counter() - tic
+
+    print(f"dict path: {len(track_pts) / dict_elapsed:.0f} docs/s, {dict_bytes / dict_elapsed / 1e6:.1f} MB/s")
+    print(f"fast path: {len(track_pts) / fast_elapsed:.0f} docs/s, {fast_bytes / fast_elapsed / 1e6:.1f} MB/s "
+          f"({'orjson' if orjson is not None else 'json'})")
@@ -0,0 +1,285 @@
+import json
+import hashlib
+import logging
+import numpy as np
+
+from utils import LIBRARY_DIR, str2path, atomic_write
+from geo import MEAN_EARTH_RADIUS_M, calculate_distances
+from gpx_stream import read_gpx, UnsupportedGpxError
+
+
+GEOHASH_BITS = 15
+SEGMENT_DTYPE = [('route', 'i4'), ('start', 'i4'), ('end', 'i4'),
+                 ('lat_min', 'f8'), ('lat_max', 'f8'), ('lon_min', 'f8'), ('lon_max', 'f8')]
+ROUTE_DTYPE = [('lat', 'f8'), ('lon', 'f8'), ('ele', 'f8')]
+
+
+def _spread_bits(values):
+    """spreads the lower 16 bits of values to the even bits"""
+    values = values.astype(np.int64) & 0xFFFF
+    values = (values | (values << 8)) & 0x00FF00FF
+    values = (values | (values << 4)) & 0x0F0F0F0F
+    values = (values | (values << 2)) & 0x33333333
+    return (values | (values << 1)) & 0x55555555
+
+
+def grid_indices(lat, lon, bits=GEOHASH_BITS):
+    """(lat, lon) indices of the geohash cells with bits bits per axis"""
+    cells = 1 << bits
+    lat_idx = np.clip(np.floor((np.asarray(lat) + 90) / 180 * cells), 0, cells - 1).astype(np.int64)
+    lon_idx = np.clip(np.floor((np.asarray(lon) + 180) / 360 * cells), 0, cells - 1).astype(np.int64)
+    return lat_idx, lon_idx
+
+
+def geohash(lat_idx, lon_idx):
+    """integer geohash of the cell indices, longitude bits interleaved first as in the geohash strings"""
+    return (_spread_bits(lon_idx) << 1) | _spread_bits(lat_idx)
+
+
+def cover_cells(segments, bits=GEOHASH_BITS):
+    """sorted geohashes of the cells intersecting the bounding boxes of the segments and the segment of each cell"""
+    lat_min, lon_min = grid_indices(segments['lat_min'], segments['lon_min'], bits)
+    lat_max, lon_max = grid_indices(segments['lat_max'], segments['lon_max'], bits)
+    lat_count = lat_max - lat_min + 1
+    lon_count = lon_max - lon_min + 1
+    counts = lat_count * lon_count
+
+    seg_ids = np.repeat(np.arange(len(segments)), counts)
+    offsets = np.arange(len(seg_ids)) - np.repeat(np.cumsum(counts) - counts, counts)
+    cells = geohash(lat_min[seg_ids] + offsets // lon_count[seg_ids], lon_min[seg_ids] + offsets % lon_count[seg_ids])
+    order = np.argsort(cells, kind='stable')
+    return cells[order], seg_ids[order]
+
+
+def split_segments(route_points, route_id, segment_points):
+    """segments of segment_points steps with their bounding boxes, consecutive segments share the end point"""
+    starts = np.arange(0, max(len(route_points) - 1, 1), segment_points)
+    ends = np.minimum(starts + segment_points, len(route_points) - 1)
+    segments = np.zeros(len(starts), dtype=SEGMENT_DTYPE)
+    segments['route'] = route_id
+    segments['start'] = starts
+    segments['end'] = ends
+    for field, values in (('lat', route_points['lat']), ('lon', route_points['lon'])):
+        segments[f'{field}_min'] = np.minimum.reduceat(values, starts)
+        segments[f'{field}_max'] = np.maximum.reduceat(values, starts)
+        # reduceat stops one point before the next start, the shared end point is added here
+        segments[f'{field}_min'] = np.minimum(segments[f'{field}_min'], values[ends])
+        segments[f'{field}_max'] = np.maximum(segments[f'{field}_max'], values[ends])
+    return segments
+
+
+class ReferenceLibrary:
+    """
+    Library of reference routes, a directory of GPX files. The routes are indexed to index_dir once:
+    route points as .npy files, segments of SEGMENT_POINTS steps with bounding boxes and a grid of geohash
+    cells pointing to the segments they intersect. Only the GPX files added or changed since the last update
+    are parsed, the index arrays are loaded memory-mapped.
+    """
+
+    INDEX_VERSION = 1
+    SEGMENT_POINTS = 32
+    MAX_CONNECT_DIST_M = 500
+    INDEX_FILES = ('segments.npy', 'cells.npy', 'cell_segments.npy')
+
+    def __init__(self, library_dir, dtype, index_dir=None):
+        self.library_dir = str2path(library_dir)
+        self.dtype = dtype
+        if index_dir is None:
+            key = hashlib.sha256(str(self.library_dir.resolve()).encode()).hexdigest()[:16]
+            index_dir = LIBRARY_DIR / f'{self.library_dir.name}-{key}'
+        self.index_dir = str2path(index_dir)
+        self.log = logging.getLogger('root')
+        self.manifest = None
+        self.segments = None
+        self.cells = None
+        self.cell_segments = None
+        self._routes = dict()
+
+    def manifest_path(self):
+        return self.index_dir / 'manifest.json'
+
+    def route_path(self, route_id):
+        return self.index_dir / 'routes' / f'{route_id}.npy'
+
+    def load_manifest(self):
+        try:
+            with open(self.manifest_path(), 'r') as f:
+                manifest = json.load(f)
+        except FileNotFoundError:
+            return None
+        if manifest['version'] != self.INDEX_VERSION or manifest['segment_points'] != self.SEGMENT_POINTS:
+            self.log.warning(f'Reference library index {self.index_dir} was built with other settings, rebuilding')
+            return None
+        return manifest
+
+    def update(self):
+        """indexes the GPX files added or changed since the last update and drops the removed ones"""
+        manifest = self.load_manifest()
+        segments = np.zeros(0, dtype=SEGMENT_DTYPE)
+        if manifest is None:
+            manifest = {'version': self.INDEX_VERSION, 'segment_points': self.SEGMENT_POINTS,
+                        'next_route_id': 0, 'routes': dict()}
+        elif self._index_complete():
+            segments = np.load(self.index_dir / 'segments.npy')
+        else:
+            manifest['routes'] = dict()
+        indexed = manifest['routes']
+        files = {path.name: path.stat() for path in sorted(self.library_dir.glob('*.gpx'))}
+        changed = [name for name, stat in files.items()
+                   if name not in indexed or [stat.st_size, stat.st_mtime_ns] != indexed[name]['stat']]
+        removed = [name for name in indexed if name not in files or name in changed]
+        if not changed and not removed and self._index_complete():
+            return False
+
+        removed_ids = [route_id for route_id in (indexed.pop(name)['route_id'] for name in removed)
+                       if route_id is not None]
+        segments = segments[~np.isin(segments['route'], removed_ids)]
+        for route_id in removed_ids:
+            try:
+                self.route_path(route_id).unlink()
+            except FileNotFoundError:
+                pass
+
+        new_segments = [segments]
+        self.route_path(0).parent.mkdir(parents=True, exist_ok=True)
+        for name in changed:
+            # skipped files are kept in the manifest without a route, so they are not parsed again until changed
+            indexed[name] = {'route_id': None, 'stat': [files[name].st_size, files[name].st_mtime_ns], 'points': 0}
+            try:
+                points = read_gpx(self.library_dir / name, self.dtype)
+            except UnsupportedGpxError as ex:
+                self.log.warning(f'{name} skipped: {ex}')
+                continue
+            if len(points) < 2:
+                self.log.warning(f'{name} skipped: less than 2 points')
+                continue
+            route_points = np.zeros(len(points), dtype=ROUTE_DTYPE)
+            for field in ('lat', 'lon', 'ele'):
+                route_points[field] = points[field]
+            route_id = manifest['next_route_id']
+            manifest['next_route_id'] += 1
+            np.save(self.route_path(route_id), route_points)
+            new_segments.append(split_segments(route_points, route_id, self.SEGMENT_POINTS))
+            indexed[name].update({'route_id': route_id, 'points': len(route_points)})
+
+        segments = np.concatenate(new_segments)
+        cells, cell_segments = cover_cells(segments)
+        for name, array in zip(self.INDEX_FILES, (segments, cells, cell_segments)):
+            self._save_array(name, array)
+        self._save_manifest(manifest)
+        self.log.info(f'Reference library {self.library_dir}: {len(changed)} routes indexed, {len(removed)} removed, '
+                      f'{len(indexed)} routes with {len(segments)} segments in total')
+        return True
+
+    def _index_complete(self):
+        return all((self.index_dir / name).exists() for name in self.INDEX_FILES)
+
+    def _save_array(self, name, array):
+        """writes the array atomically, an interrupted update keeps the old array"""
+        with atomic_write(self.index_dir / name) as f:
+            np.save(f, array)
+
+    def _save_manifest(self, manifest):
+        with atomic_write(self.manifest_path(), 'w') as f:
+            json.dump(manifest, f)
+
+    def load(self):
+        """updates the index and loads it memory-mapped, only the first call does the work"""
+        if self.manifest is not None:
+            return self
+        self.index_dir.mkdir(parents=True, exist_ok=True)
+        self.update()
+        self.manifest = self.load_manifest()
+        self.segments, self.cells, self.cell_segments = (np.load(self.index_dir / name, mmap_mode='r')
+                                                         for name in self.INDEX_FILES)
+        return self
+
+    def fingerprint(self):
+        """hash of the indexed routes, changes whenever a route is added, changed or removed"""
+        self.load()
+        return hashlib.sha256(json.dumps(self.manifest['routes'], sort_keys=True).encode()).hexdigest()
+
+    def route_points(self, route_id):
+        if route_id not in self._routes:
+            self._routes[route_id] = np.load(self.route_path(route_id), mmap_mode='r')
+        return self._routes[route_id]
+
+    def nearby_segments(self, lat, lon, radius_m):
+        """ids of the segments intersecting the cells within radius_m of the point"""
+        dlat = np.rad2deg(radius_m / MEAN_EARTH_RADIUS_M)
+        dlon = dlat / max(np.cos(np.deg2rad(lat)), 1e-6)
+        lat_min, lon_min = grid_indices(lat - dlat, lon - dlon)
+        lat_max, lon_max = grid_indices(lat + dlat, lon + dlon)
+        lat_idx, lon_idx = np.meshgrid(np.arange(lat_min, lat_max + 1), np.arange(lon_min, lon_max + 1))
+        cells = geohash(lat_idx.ravel(), lon_idx.ravel())
+        lo = np.searchsorted(self.cells, cells, side='left')
+        hi = np.searchsorted(self.cells, cells, side='right')
+        return np.unique(np.concatenate([self.cell_segments[l:h] for l, h in zip(lo, hi)] + [np.zeros(0, int)]))
+
+    def closest_route_points(self, track_pt):
+        """{route id: (point index, distance [m])} of the closest point of every route within MAX_CONNECT_DIST_M"""
+        segments = self.segments[self.nearby_segments(track_pt['lat'], track_pt['lon'], self.MAX_CONNECT_DIST_M)]
+        closest = dict()
+        for route_id in np.unique(segments['route']):
+            route_segments = segments[segments['route'] == route_id]
+            idxs = np.unique(np.concatenate([np.arange(start, end + 1) for start, end
+                                             in zip(route_segments['start'], route_segments['end'])]))
+            dists = calculate_distances(track_pt, self.route_points(route_id)[idxs])
+            pos = np.nanargmin(dists)
+            if dists[pos] <= self.MAX_CONNECT_DIST_M:
+                closest[int(route_id)] = (int(idxs[pos]), float(dists[pos]))
+        return closest
+
+    def best_section(self, cur_pt, next_pt):
+        """
+        section of the reference route best connecting cur_pt with next_pt: the route passes within
+        MAX_CONNECT_DIST_M of both points, the sum of the connection distances is minimal and the shorter section
+        wins a tie. Routes are used in both directions, returns the points ordered from cur_pt to next_pt
+        as dtype array, None if no route passes close to both points.
+        """
+        self.load()
+        near_cur = self.closest_route_points(cur_pt)
+        near_next = self.closest_route_points(next_pt)
+        best = None
+        for route_id in near_cur.keys() & near_next.keys():
+            (cur_idx, cur_dist), (next_idx, next_dist) = near_cur[route_id], near_next[route_id]
+            score = (cur_dist + next_dist, abs(next_idx - cur_idx), route_id)
+            if best is None or score < best[0]:
+                best = (score, route_id, cur_idx, next_idx)
+        if best is None:
+            return None
+
+        _, route_id, cur_idx, next_idx = best
+        route_points = self.route_points(route_id)
+        if cur_idx <= next_idx:
+            route_points = route_points[cur_idx:next_idx + 1]
+        else:
+            route_points = route_points[next_idx:cur_idx + 1][::-1]
+        section = np.zeros(len(route_points), dtype=self.dtype)
+        for field in ('lat', 'lon', 'ele'):
+            section[field] = route_points[field]
+        section['timestamp'] = np.datetime64('NaT')
+        section['pt_type'] = 'original'
+        return section
+
+
+if __name__ == "__main__":
+    import argparse
+    from utils import simple_logger
+    from trip_tracker import GpxTripTracker
+
+    argp = argparse.ArgumentParser()
+    argp.add_argument('--library-dir',
+                      dest='library_dir',
+                      help='directory of the reference GPX files to be indexed',
+                      required=True)
+    argp.add_argument('--index-dir',
+                      dest='index_dir',
+                      help='directory of the library index, a directory in reflib by default',
+                      default=None)
+    args = argp.parse_args()
+
+    simple_logger()
+    library = ReferenceLibrary(args.library_dir, GpxTripTracker.GPS_DTYPE, args.index_dir).load()
+    print(f"{len(library.manifest['routes'])} routes, {len(library.segments)} segments, "
+          f"{len(np.unique(library.cells))} grid cells in {library.index_dir}")
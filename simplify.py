@@ -0,0 +1,106 @@
+import numpy as np
+
+from geo import MEAN_EARTH_RADIUS_M
+from trip_tracker import M2KM, SEC2H, MPS2KPH
+
+
+MAX_WINDOW = 512
+
+
+def local_projection(track_points):
+    """equirectangular projection [m] of the track points around their mean latitude, shape (n, 2)"""
+    lat = np.deg2rad(track_points['lat'])
+    lon = np.deg2rad(track_points['lon'])
+    cos_lat0 = np.cos(np.mean(lat)) if len(lat) else 1
+    return np.stack((MEAN_EARTH_RADIUS_M * (lon - lon[0]) * cos_lat0, MEAN_EARTH_RADIUS_M * (lat - lat[0])), axis=-1)
+
+
+def segment_distances(xy, start_xy, end_xy):
+    """distances [m] of points xy to the segments start_xy - end_xy, all arrays are broadcast, shape (n, 2)"""
+    seg = end_xy - start_xy
+    seg_len_sq = np.sum(seg**2, axis=-1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        t = np.clip(np.sum((xy - start_xy) * seg, axis=-1) / seg_len_sq, 0, 1)
+    t = np.where(seg_len_sq > 0, t, 0)
+    closest = start_xy + t[..., np.newaxis] * seg
+    return np.sqrt(np.sum((xy - closest)**2, axis=-1))
+
+
+def protected_points(track_points, odometry):
+    """mask of the points simplification must keep: ends, segment boundaries, corrected points and stops"""
+    keep = np.zeros(len(track_points), dtype=bool)
+    if not len(keep):
+        return keep
+    keep[[0, -1]] = True
+    sid_break = np.where(np.diff(track_points['sid']) != 0)[0]
+    keep[sid_break] = True
+    keep[sid_break + 1] = True
+    keep |= track_points['pt_type'] != 'original'
+    if not np.isnat(track_points['timestamp'][0]):
+        raw_dt = np.diff(track_points['timestamp']) / np.timedelta64(1, 's')
+        stops = np.where(raw_dt > odometry['time_delta_s'][1:] + 1e-6)[0]
+        keep[stops] = True
+        keep[stops + 1] = True
+    return keep
+
+
+def douglas_peucker(xy, keep, tolerance_m, max_window=MAX_WINDOW):
+    """
+    extends keep mask with points needed to approximate xy by a polyline within tolerance_m,
+    every max_window-th point is kept to bound the unbalanced splits and keep the run time near-linear
+    """
+    keep = keep.copy()
+    keep[::max_window] = True
+    anchors = np.where(keep)[0]
+    stack = [(start, end) for start, end in zip(anchors[:-1], anchors[1:]) if end - start > 1]
+    while stack:
+        start, end = stack.pop()
+        dists = segment_distances(xy[start + 1:end], xy[start], xy[end])
+        idx = np.argmax(dists)
+        if dists[idx] > tolerance_m:
+            split = start + 1 + idx
+            keep[split] = True
+            if split - start > 1:
+                stack.append((start, split))
+            if end - split > 1:
+                stack.append((split, end))
+    return keep
+
+
+def max_deviation(xy, keep):
+    """maximal distance [m] of the dropped points to the simplified polyline"""
+    kept = np.where(keep)[0]
+    if len(kept) < 2:
+        return 0.0
+    seg_idx = np.clip(np.searchsorted(kept, np.arange(len(xy)), side='right') - 1, 0, len(kept) - 2)
+    dists = segment_distances(xy, xy[kept[seg_idx]], xy[kept[seg_idx + 1]])
+    return float(np.max(dists))
+
+
+def simplify_track(track_points, odometry, tolerance_m, protected_idx=None):
+    """
+    Douglas-Peucker simplification of the track with tolerance_m [m], the points of protected_idx are kept.
+    Cumulative odometry is taken from the full resolution data, per-sample deltas are recomputed between
+    the kept points. Returns simplified track points, odometry, statistics of the simplification
+    and the mask of the kept points.
+    """
+    xy = local_projection(track_points)
+    protected = protected_points(track_points, odometry)
+    if protected_idx is not None:
+        protected[protected_idx] = True
+    keep = douglas_peucker(xy, protected, tolerance_m)
+
+    simple_pts = track_points[keep]
+    simple_odo = odometry[keep].copy()
+    simple_odo['dist_m'][1:] = np.diff(simple_odo['cum_dist_km']) / M2KM
+    simple_odo['elev_delta_m'][1:] = np.diff(simple_odo['elev_up_cum_m']) - np.diff(simple_odo['elev_down_cum_m'])
+    if len(simple_pts) and not np.isnat(simple_pts['timestamp'][0]):
+        simple_odo['time_delta_s'][1:] = np.diff(simple_odo['total_time_h']) / SEC2H
+        with np.errstate(divide='ignore', invalid='ignore'):
+            simple_odo['avg_vel_kmh'][1:] = simple_odo['dist_m'][1:] / simple_odo['time_delta_s'][1:] * MPS2KPH
+
+    stats = {'points_in': len(track_points),
+             'points_out': len(simple_pts),
+             'reduction_ratio': 1 - len(simple_pts) / len(track_points) if len(track_points) else 0.0,
+             'max_deviation_m': max_deviation(xy, keep)}
+    return simple_pts, simple_odo, stats, keep
@@ -0,0 +1,94 @@
+import abc
+import datetime
+import numpy as np
+
+from utils import OUTPUT_DIR, str2path, atomic_write
+
+
+class TripSink(abc.ABC):
+    """
+    Destination of a processed trip. The tracker computes the overview, track points and odometry,
+    the sink stores them, so the analysis does not depend on the storage backend.
+    """
+
+    @abc.abstractmethod
+    def write(self, tracker, overview, track_points, odometry):
+        """stores the trip overview, track points and odometry processed by tracker"""
+
+
+class ElasticSink(TripSink):
+    """
+    ingest to the index of the tracker, a trip already present in the index is skipped,
+    with checked the index and the trip were already checked by the caller, e.g. by the batch preflight
+    """
+
+    def __init__(self, checked=False):
+        self.checked = checked
+
+    def write(self, tracker, overview, track_points, odometry):
+        if not self.checked and not tracker.should_ingest(overview['trip_id']):
+            return
+
+        tracker.push(overview, doc_id=overview['trip_id'])
+        tracker.log.info('Ingesting trip points...')
+        tracker.bulk_push_lines(tracker.document_lines(track_points, odometry, overview['trip_type']))
+        tracker.counters['documents'] = tracker.bulk_stats['docs']
+
+
+class FileSink(TripSink):
+    """trip written to <output_dir>/<trip_id><SUFFIX>, the file is replaced only when completely written"""
+
+    SUFFIX = ''
+
+    def __init__(self, output_dir=OUTPUT_DIR):
+        self.output_dir = str2path(output_dir)
+
+    def path(self, trip_id):
+        return self.output_dir / f'{trip_id}{self.SUFFIX}'
+
+    def write(self, tracker, overview, track_points, odometry):
+        self.output_dir.mkdir(parents=True, exist_ok=True)
+        path = self.path(overview['trip_id'])
+        with atomic_write(path) as f:
+            self.dump(f, tracker, overview, track_points, odometry)
+        tracker.log.info(f'Trip written to {path}')
+
+    @abc.abstractmethod
+    def dump(self, f, tracker, overview, track_points, odometry):
+        """writes the trip to the binary file object f"""
+
+
+class NdjsonSink(FileSink):
+    """
+    bulk request body of the trip, the overview followed by the documents of the ingest layout,
+    it can be loaded later with curl -H 'Content-Type: application/x-ndjson' --data-binary @file <host>/<index>/_bulk
+    """
+
+    SUFFIX = '.ndjson'
+
+    def dump(self, f, tracker, overview, track_points, odometry):
+        serializer = tracker.serializer
+        overview_doc = dict(overview, timestamp=datetime.datetime.utcnow())
+        action, data = tracker.expand_action(dict(overview_doc, _id=overview['trip_id'], _index=tracker.es_index))
+        f.write(serializer.dumps(action).encode('utf-8') + b'\n' + serializer.dumps(data).encode('utf-8') + b'\n')
+        docs = 0
+        for action_line, data_line in tracker.document_lines(track_points, odometry, overview['trip_type']):
+            f.write(action_line + b'\n' + data_line + b'\n')
+            docs += 1
+        tracker.counters['ndjson_documents'] = docs
+
+
+class NpzSink(FileSink):
+    """track points, odometry and stops as arrays with the overview as JSON, loadable by numpy.load"""
+
+    SUFFIX = '.npz'
+
+    def dump(self, f, tracker, overview, track_points, odometry):
+        arrays = {'track_points': np.asarray(track_points), 'odometry': np.asarray(odometry),
+                  'overview': np.array(tracker.serializer.dumps(overview))}
+        if tracker.stops is not None:
+            arrays['stops'] = tracker.stops
+        np.savez(f, **arrays)
+
+
+FILE_SINKS = {'ndjson': NdjsonSink, 'npz': NpzSink}
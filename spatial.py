@@ -0,0 +1,133 @@
+import heapq
+import numpy as np
+
+from geo import geodetic_to_ecef, calculate_distance, calculate_distances
+
+
+class EcefKDTree:
+    """
+    KD-tree over ECEF coordinates of points. Every node keeps the bounding box and the maximal
+    original index of its points, so the queries can be restricted to points at or after a given index.
+    """
+
+    LEAF_SIZE = 32
+
+    def __init__(self, lat, lon):
+        self.xyz = geodetic_to_ecef(lat, lon).reshape(-1, 3)
+        self.order = np.arange(len(self.xyz))
+        self.start = list()
+        self.end = list()
+        self.children = list()
+        self.max_idx = list()
+        self.box_min = list()
+        self.box_max = list()
+        if len(self.xyz):
+            self._build()
+
+    def __len__(self):
+        return len(self.xyz)
+
+    def _add_node(self, start, end):
+        pts = self.xyz[self.order[start:end]]
+        self.start.append(start)
+        self.end.append(end)
+        self.children.append(None)
+        self.max_idx.append(self.order[start:end].max())
+        self.box_min.append(pts.min(axis=0))
+        self.box_max.append(pts.max(axis=0))
+        return len(self.start) - 1
+
+    def _build(self):
+        stack = [self._add_node(0, len(self.xyz))]
+        while stack:
+            node = stack.pop()
+            start, end = self.start[node], self.end[node]
+            if end - start <= self.LEAF_SIZE:
+                continue
+            axis = np.argmax(self.box_max[node] - self.box_min[node])
+            mid = (start + end) // 2
+            node_order = self.order[start:end]
+            part = np.argpartition(self.xyz[node_order, axis], mid - start)
+            self.order[start:end] = node_order[part]
+            left = self._add_node(start, mid)
+            right = self._add_node(mid, end)
+            self.children[node] = (left, right)
+            stack.extend((left, right))
+
+    def _box_dist(self, node, xyz):
+        """lower bound of the distance between xyz and any point of the node"""
+        delta = np.maximum(self.box_min[node] - xyz, 0) + np.maximum(xyz - self.box_max[node], 0)
+        return np.sqrt(np.dot(delta, delta))
+
+    def _leaf(self, node, xyz, min_idx):
+        idxs = self.order[self.start[node]:self.end[node]]
+        idxs = idxs[idxs >= min_idx]
+        dists = np.sqrt(np.sum((self.xyz[idxs] - xyz)**2, axis=1))
+        return idxs, dists
+
+    def nearest(self, xyz, min_idx=0):
+        """returns index of the point with index >= min_idx closest to xyz in euclidean sense, None if no such point"""
+        if not len(self) or self.max_idx[0] < min_idx:
+            return None
+        best_idx = None
+        best_dist = np.inf
+        heap = [(0.0, 0)]
+        while heap:
+            box_dist, node = heapq.heappop(heap)
+            if box_dist > best_dist:
+                break
+            if self.children[node] is None:
+                idxs, dists = self._leaf(node, xyz, min_idx)
+                if len(idxs):
+                    pos = np.argmin(dists)
+                    if dists[pos] < best_dist:
+                        best_dist = dists[pos]
+                        best_idx = idxs[pos]
+                continue
+            for child in self.children[node]:
+                if self.max_idx[child] >= min_idx:
+                    heapq.heappush(heap, (self._box_dist(child, xyz), child))
+        return best_idx
+
+    def within(self, xyz, radius, min_idx=0):
+        """returns sorted indices >= min_idx of points closer to xyz than radius in euclidean sense"""
+        found = list()
+        stack = [0] if len(self) else []
+        while stack:
+            node = stack.pop()
+            if self.max_idx[node] < min_idx or self._box_dist(node, xyz) > radius:
+                continue
+            if self.children[node] is None:
+                idxs, dists = self._leaf(node, xyz, min_idx)
+                found.append(idxs[dists <= radius])
+            else:
+                stack.extend(self.children[node])
+        if not found:
+            return np.array([], dtype=self.order.dtype)
+        return np.sort(np.concatenate(found))
+
+
+class ReferenceIndex:
+    """
+    Spatial index of reference points for closest point lookups. Euclidean chord between two points
+    on the ellipsoid is never longer than their geodesic distance, so the KD-tree candidates are
+    re-ranked by Vincenty distance, which yields the same results as the brute force search.
+    """
+
+    RADIUS_MARGIN_M = 1.0
+
+    def __init__(self, ref_pts):
+        self.ref_pts = ref_pts
+        self.tree = EcefKDTree(ref_pts['lat'], ref_pts['lon'])
+
+    def closest(self, track_pt, start_idx=0):
+        """finds index of the closest reference point to the track_pt at or after start_idx"""
+        xyz = geodetic_to_ecef(track_pt['lat'], track_pt['lon'])
+        nearest = self.tree.nearest(xyz, start_idx)
+        if nearest is None:
+            return None
+        radius = calculate_distance(track_pt, self.ref_pts[nearest])
+        radius = radius * (1 + 1e-6) + self.RADIUS_MARGIN_M
+        candidates = self.tree.within(xyz, radius, start_idx)
+        dists = calculate_distances(track_pt, self.ref_pts[candidates])
+        return candidates[np.nanargmin(dists)]
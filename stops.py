@@ -0,0 +1,94 @@
+import numpy as np
+
+
+STOP_DTYPE = [('start_idx', 'i8'), ('end_idx', 'i8'), ('start_ts', 'M8[ns]'), ('end_ts', 'M8[ns]'),
+              ('duration_s', 'f8'), ('lat', 'f8'), ('lon', 'f8')]
+
+
+def rolling_speeds(time_s, cum_dist_m, half_window):
+    """
+    mean speed [m/s] over the centered window of half_window steps on both sides of every point,
+    points of windows without elapsed time are treated as moving
+    """
+    idx = np.arange(len(time_s))
+    lo = np.maximum(idx - half_window, 0)
+    hi = np.minimum(idx + half_window, len(time_s) - 1)
+    span_s = time_s[hi] - time_s[lo]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        speeds = (cum_dist_m[hi] - cum_dist_m[lo]) / span_s
+    return np.where(span_s > 0, speeds, np.inf)
+
+
+def run_bounds(mask):
+    """(start, end) indices of the runs of True in mask, both inclusive"""
+    edges = np.diff(np.concatenate(([0], mask.astype(np.int8), [0])))
+    return np.where(edges == 1)[0], np.where(edges == -1)[0] - 1
+
+
+def merge_runs(starts, ends, time_s, merge_gap_s):
+    """merges the runs separated by at most merge_gap_s seconds"""
+    if len(starts) < 2:
+        return starts, ends
+    split = time_s[starts[1:]] - time_s[ends[:-1]] > merge_gap_s
+    return starts[np.concatenate(([True], split))], ends[np.concatenate((split, [True]))]
+
+
+def run_means(values, starts, ends):
+    """means of values over the runs, computed from a single cumulative sum"""
+    cum_values = np.concatenate(([0], np.cumsum(values)))
+    return (cum_values[ends + 1] - cum_values[starts]) / (ends - starts + 1)
+
+
+def find_stops(track_points, dist_m, velocity_threshold_mps, window_s, min_duration_s, merge_gap_s,
+               med_time_delta=None):
+    """
+    Detects the stops of the tracked points with dist_m [m] between the consecutive points. A point is
+    stationary if the mean speed of the window of window_s seconds around it, sized by med_time_delta [s],
+    is below velocity_threshold_mps. Runs of stationary points separated by at most merge_gap_s are merged,
+    runs shorter than min_duration_s are dropped. Linear in the number of points, returns STOP_DTYPE array.
+    """
+    if len(track_points) < 2:
+        return np.zeros(0, dtype=STOP_DTYPE)
+
+    timestamps = track_points['timestamp']
+    time_s = (timestamps - timestamps[0]) / np.timedelta64(1, 's')
+    if med_time_delta is None:
+        med_time_delta = np.median(np.diff(time_s))
+    half_window = max(1, int(np.ceil(window_s / 2 / med_time_delta))) if med_time_delta > 0 else 1
+    cum_dist_m = np.concatenate(([0], np.cumsum(dist_m)))
+
+    starts, ends = run_bounds(rolling_speeds(time_s, cum_dist_m, half_window) < velocity_threshold_mps)
+    starts, ends = merge_runs(starts, ends, time_s, merge_gap_s)
+    duration_s = time_s[ends] - time_s[starts]
+    long_enough = duration_s >= min_duration_s
+    starts, ends, duration_s = starts[long_enough], ends[long_enough], duration_s[long_enough]
+
+    lon0 = track_points['lon'][0]
+    lon_offsets = (track_points['lon'] - lon0 + 180) % 360 - 180
+
+    stops = np.zeros(len(starts), dtype=STOP_DTYPE)
+    stops['start_idx'] = starts
+    stops['end_idx'] = ends
+    stops['start_ts'] = timestamps[starts]
+    stops['end_ts'] = timestamps[ends]
+    stops['duration_s'] = duration_s
+    stops['lat'] = run_means(track_points['lat'], starts, ends)
+    stops['lon'] = (run_means(lon_offsets, starts, ends) + lon0 + 180) % 360 - 180
+    return stops
+
+
+def remap_stops(stops, keep):
+    """stops with the point indices of the track reduced by the keep mask, the stop bounds must be kept"""
+    kept_idx = np.cumsum(keep) - 1
+    remapped = stops.copy()
+    remapped['start_idx'] = kept_idx[stops['start_idx']]
+    remapped['end_idx'] = kept_idx[stops['end_idx']]
+    return remapped
+
+
+def stop_steps(stops, n_steps):
+    """mask of the steps between consecutive points lying inside the stops"""
+    marks = np.zeros(n_steps + 1, dtype=np.int64)
+    marks[stops['start_idx']] += 1
+    marks[stops['end_idx']] -= 1
+    return np.cumsum(marks[:-1]) > 0
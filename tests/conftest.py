@@ -0,0 +1,18 @@
+import sys
+import pathlib
+
+import pytest
+
+sys.path.insert(0, str(pathlib.Path(__file__).resolve().parents[1]))
+
+from benchmarks.synthetic_gpx import write_gpx  # noqa: E402
+
+
+@pytest.fixture(scope='session')
+def synthetic_track(tmp_path_factory):
+    """(track path, reference path) of a synthetic tracked trip with gaps, a stop and segment breaks"""
+    data_dir = tmp_path_factory.mktemp('synthetic')
+    track_path = data_dir / 'synthetic.gpx'
+    ref_path = data_dir / 'synthetic-ref.gpx'
+    write_gpx(track_path, 5000, gaps=2, stops=1, segments=3, seed=1, ref_path=ref_path, ref_step=2)
+    return track_path, ref_path
@@ -0,0 +1,54 @@
+import json
+
+from benchmarks.local_es import LocalElasticsearch
+from benchmarks.synthetic_gpx import write_gpx
+from elastic_interface import ElasticAPI
+from async_elastic_interface import AsyncElasticAPI
+from batch_tracker import BatchTripTracker
+from async_pipeline import AsyncBatchTripTracker
+
+
+class AsyncLocalElasticsearch:
+    """coroutine stub of the AsyncElasticsearch endpoints on top of the in-process stand-in"""
+
+    def __init__(self, es):
+        self._es = es
+        self.indices = self
+        self.transport = es.transport
+
+    def __getattr__(self, name):
+        endpoint = getattr(self._es, name)
+
+        async def call(*args, **kwargs):
+            return endpoint(*args, **kwargs)
+        return call
+
+    async def close(self):
+        pass
+
+
+def ingested_docs(es, index):
+    """documents of the index without the ingest timestamps"""
+    return {doc_id: {field: value for field, value in json.loads(data).items() if field != 'timestamp'}
+            for doc_id, data in es.store[index].items()}
+
+
+def test_async_batch_matches_sync_batch(tmp_path, monkeypatch):
+    gpx_files = [tmp_path / f'trip-{seed}.gpx' for seed in range(3)]
+    for seed, gpx_file in enumerate(gpx_files):
+        write_gpx(gpx_file, 1500, gaps=1, stops=1, segments=2, seed=seed)
+
+    results = list()
+    for tracker_class in (BatchTripTracker, AsyncBatchTripTracker):
+        es = LocalElasticsearch(indices=['trips'])
+        monkeypatch.setattr(ElasticAPI, '_create_client', lambda self: es)
+        monkeypatch.setattr(AsyncElasticAPI, '_create_client', lambda self: AsyncLocalElasticsearch(es))
+        summaries = tracker_class('bike', gpx_files, jobs=2, index='trips', corrected_dir=tmp_path / 'corrected',
+                                  detect_stops=True, chunk_size=200).run()
+        assert [summary['status'] for summary in summaries] == ['ok'] * len(gpx_files)
+        results.append(ingested_docs(es, 'trips'))
+
+    sync_docs, async_docs = results
+    assert async_docs == sync_docs
+    assert {f'trip-{seed}' for seed in range(3)} <= set(async_docs)
+    assert any('-stop-' in doc_id for doc_id in async_docs)
@@ -0,0 +1,26 @@
+import numpy as np
+import pytest
+
+from chunked import ChunkedTripTracker
+from trip_tracker import GpxTripTracker
+
+
+@pytest.mark.parametrize('block_size', [700, 2048, 100000])
+def test_chunked_totals_match_full_run(synthetic_track, tmp_path, block_size):
+    track_path, ref_path = synthetic_track
+    tracker = ChunkedTripTracker('bike', track_path, ref_path, block_size=block_size, spill_dir=tmp_path / 'spill',
+                                 corrected_dir=tmp_path)
+    overview = tracker.run()
+    track_pts, odo = tracker.load_spilled()
+
+    full = GpxTripTracker('bike', track_path, ref_path, corrected_dir=tmp_path)
+    full_pts, full_odo = full.process()
+    expected = full.summarize(full_pts, full_odo)
+    assert len(track_pts) == len(full_pts)
+    assert (track_pts['pt_type'] == full_pts['pt_type']).all()
+    np.testing.assert_allclose(odo['cum_dist_km'], full_odo['cum_dist_km'], rtol=1e-12)
+    np.testing.assert_allclose(odo['total_time_h'], full_odo['total_time_h'], rtol=1e-12)
+    assert overview['trip_start_utc'] == expected['trip_start_utc']
+    assert overview['trip_end_utc'] == expected['trip_end_utc']
+    for key in ('trip_length_km', 'trip_duration_h', 'trip_max_elev_m', 'trip_min_elev_m'):
+        assert overview[key] == pytest.approx(expected[key], rel=1e-9)
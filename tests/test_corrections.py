@@ -0,0 +1,44 @@
+import numpy as np
+
+from trip_tracker import GpxTripTracker
+
+
+def make_points(lats, pt_type):
+    points = np.zeros(len(lats), dtype=GpxTripTracker.GPS_DTYPE)
+    points['lat'] = lats
+    points['pt_type'] = pt_type
+    return points
+
+
+def test_assemble_corrections_keeps_index_alignment():
+    track_pts = make_points(np.arange(10), 'original')
+    gap_fills = [(0, make_points([0.5], 'corrected')),
+                 (3, make_points([3.25, 3.5, 3.75], 'corrected')),
+                 (5, make_points([], 'corrected')),
+                 (8, make_points([8.5, 8.75], 'corrected'))]
+    corrected = GpxTripTracker.assemble_corrections(track_pts, gap_fills)
+
+    expected = np.concatenate([track_pts[:1], gap_fills[0][1], track_pts[1:4], gap_fills[1][1], track_pts[4:9],
+                               gap_fills[3][1], track_pts[9:]])
+    assert (corrected == expected).all()
+    assert (np.diff(corrected['lat']) > 0).all()
+    assert (corrected[corrected['pt_type'] == 'original'] == track_pts).all()
+    assert (GpxTripTracker.assemble_corrections(track_pts, []) == track_pts).all()
+
+
+def test_corrected_track_keeps_original_points(synthetic_track, tmp_path):
+    track_path, ref_path = synthetic_track
+    tracker = GpxTripTracker('bike', track_path, ref_path, corrected_dir=tmp_path)
+    track_pts = tracker.read_file(track_path)
+    ref_pts = tracker.read_file(ref_path)
+    gap_fills = tracker.plan_corrections(track_pts, ref_pts)
+    corrected = tracker.correct_track_points(track_pts, ref_pts)
+
+    assert len(gap_fills)
+    assert len(corrected) == len(track_pts) + sum(len(fill) for _, fill in gap_fills)
+    assert (corrected[corrected['pt_type'] == 'original'] == track_pts).all()
+    offsets = np.cumsum([0] + [len(fill) for _, fill in gap_fills])
+    for (break_id, fill_pts), offset in zip(gap_fills, offsets):
+        assert (corrected[break_id + offset + 1:break_id + offset + 1 + len(fill_pts)] == fill_pts).all()
+        assert corrected[break_id + offset + len(fill_pts) + 1] == track_pts[break_id + 1]
+    assert (np.diff(corrected['timestamp']) >= np.timedelta64(0)).all()
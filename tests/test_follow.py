@@ -0,0 +1,31 @@
+import numpy as np
+import pytest
+
+from follow import FollowTripTracker
+from trip_tracker import GpxTripTracker
+
+
+@pytest.mark.parametrize('with_ref', [False, True])
+def test_follow_totals_match_full_run(synthetic_track, tmp_path, with_ref):
+    track_path, ref_path = synthetic_track
+    ref_path = ref_path if with_ref else None
+    data = track_path.read_bytes()
+    live_path = tmp_path / 'live.gpx'
+
+    overview = None
+    for cut in np.linspace(0, len(data), 9).astype(int)[1:]:
+        live_path.write_bytes(data[:cut])
+        tracker = FollowTripTracker('bike', live_path, ref_path, state_dir=tmp_path / 'state', corrected_dir=tmp_path)
+        overview = tracker.update() or overview
+    assert tracker.update() is None
+
+    full = GpxTripTracker('bike', live_path, ref_path, corrected_dir=tmp_path)
+    track_pts, odo = full.process()
+    expected = full.summarize(track_pts, odo)
+    state = tracker.load_state()
+    assert state['points'] == len(track_pts)
+    assert state['elev_up_cum_m'] == pytest.approx(odo['elev_up_cum_m'][-1], rel=1e-9)
+    assert overview['trip_start_utc'] == expected['trip_start_utc']
+    assert overview['trip_end_utc'] == expected['trip_end_utc']
+    for key in ('trip_length_km', 'trip_duration_h', 'trip_max_elev_m', 'trip_min_elev_m'):
+        assert overview[key] == pytest.approx(expected[key], rel=1e-9)
@@ -0,0 +1,49 @@
+import numpy as np
+import pytest
+
+from geo import geodesic_distance, geodesic_distances, calculate_distance, geodesic_counter
+
+
+def scalar_distances(lat1, lat2, lon1, lon2, **kwargs):
+    return np.array([geodesic_distance(*pair, **kwargs) for pair in zip(lat1, lat2, lon1, lon2)])
+
+
+def test_reference_distance():
+    out = calculate_distance({'lat': 49.0, 'lon': 14.0}, {'lat': 49.1, 'lon': 14.1})
+    np.testing.assert_approx_equal(out, 13308.3461, 9)
+
+
+def test_vectorized_matches_scalar():
+    rng = np.random.default_rng(0)
+    lat1, lat2 = np.deg2rad(rng.uniform(-89, 89, (2, 500)))
+    lon1, lon2 = np.deg2rad(rng.uniform(-180, 180, (2, 500)))
+    lat2[:100] = lat1[:100] + rng.normal(0, 1e-4, 100)
+    lon2[:100] = lon1[:100] + rng.normal(0, 1e-4, 100)
+    lat2[100], lon2[100] = lat1[100], lon1[100]
+
+    np.testing.assert_allclose(geodesic_distances(lat1, lat2, lon1, lon2), scalar_distances(lat1, lat2, lon1, lon2),
+                               rtol=1e-12, atol=1e-9)
+    np.testing.assert_allclose(geodesic_distances(lat1[0], lat2, lon1[0], lon2),
+                               scalar_distances(np.full(500, lat1[0]), lat2, np.full(500, lon1[0]), lon2),
+                               rtol=1e-12, atol=1e-9)
+
+
+@pytest.mark.parametrize('max_iter', [3, 200])
+def test_near_antipodal(max_iter):
+    lat1, lat2, lon1, lon2 = np.deg2rad([[0.0, 10.0, 0.0], [0.5, -10.0, 0.5], [0.0, 20.0, 0.0],
+                                         [179.7, -160.01, 179.5]])
+    counters = dict()
+    with geodesic_counter(counters):
+        out = geodesic_distances(lat1, lat2, lon1, lon2, max_iter=max_iter)
+    assert np.isfinite(out).all()
+    assert counters['geodesic']['iterations'] <= max_iter
+    np.testing.assert_allclose(out, scalar_distances(lat1, lat2, lon1, lon2, max_iter=max_iter), rtol=1e-12)
+    assert (out > 1.99e7).all()
+
+
+def test_longitude_wrap():
+    across = calculate_distance({'lat': 10.0, 'lon': 179.95}, {'lat': 10.0, 'lon': -179.95})
+    same_side = calculate_distance({'lat': 10.0, 'lon': 20.0}, {'lat': 10.0, 'lon': 20.1})
+    np.testing.assert_allclose(across, same_side, rtol=1e-12)
+    lat, lon = np.deg2rad([10.0, 10.0]), np.deg2rad([179.95, -179.95])
+    np.testing.assert_allclose(geodesic_distances(lat[0], lat[1], lon[0], lon[1]), across, rtol=1e-12)
@@ -0,0 +1,55 @@
+import numpy as np
+
+from geo import calculate_distance
+from trip_tracker import GpxTripTracker
+
+
+def make_track(lats, lons, eles, seconds):
+    track_pts = np.zeros(len(lats), dtype=GpxTripTracker.GPS_DTYPE)
+    track_pts['lat'] = lats
+    track_pts['lon'] = lons
+    track_pts['ele'] = eles
+    track_pts['timestamp'] = np.datetime64('2020-06-01T08:00:00', 'ns') + np.array(seconds, dtype='m8[s]')
+    return track_pts
+
+
+def test_tracked_odometry_matches_point_loop():
+    seconds = [0, 10, 20, 30, 230, 240, 250]
+    track_pts = make_track([49.0, 49.0005, 49.001, 49.0015, 49.00151, 49.002, 49.0025],
+                           [14.0, 14.0005, 14.001, 14.0015, 14.00151, 14.002, 14.0025],
+                           [0, 0, 300, 305, 302, 302, 310], seconds)
+    tracker = GpxTripTracker('bike', 'track.gpx')
+    odo = tracker.extract_odometry(track_pts)
+
+    cum_dist_m, total_time_s, up, down = 0, 0, 0, 0
+    for idx in range(1, len(track_pts)):
+        dist = calculate_distance(track_pts[idx - 1], track_pts[idx])
+        dt = seconds[idx] - seconds[idx - 1]
+        if dt > 4 * 10 and dist / dt < tracker.stop_velocity_threshold():
+            dt = 10
+        elev_delta = 0 if track_pts['ele'][idx - 1] == track_pts['ele'][idx] == 0 else \
+            track_pts['ele'][idx] - track_pts['ele'][idx - 1]
+        cum_dist_m += dist
+        total_time_s += dt
+        up += max(elev_delta, 0)
+        down += max(-elev_delta, 0)
+        np.testing.assert_allclose(odo['dist_m'][idx], dist, rtol=1e-12)
+        np.testing.assert_allclose(odo['cum_dist_km'][idx], cum_dist_m / 1000, rtol=1e-12)
+        np.testing.assert_allclose(odo['time_delta_s'][idx], dt)
+        np.testing.assert_allclose(odo['total_time_h'][idx], total_time_s / 3600, rtol=1e-12)
+        np.testing.assert_allclose(odo['avg_vel_kmh'][idx], dist / dt * 3.6, rtol=1e-12)
+        assert odo['elev_up_cum_m'][idx] == up
+        assert odo['elev_down_cum_m'][idx] == down
+    assert odo[0].tolist() == (0,) * len(odo.dtype.names)
+
+
+def test_untracked_odometry_spreads_the_trip_time():
+    track_pts = make_track([49.0, 49.01, 49.02], [14.0, 14.0, 14.01], [200, 210, 205], [0, 0, 0])
+    track_pts['timestamp'] = np.datetime64('NaT')
+    tracker = GpxTripTracker('walk', 'track.gpx', start='2020-06-01T08:00:00', end='2020-06-01T10:00:00')
+    odo = tracker.extract_odometry(track_pts)
+
+    length_km = (calculate_distance(track_pts[0], track_pts[1]) + calculate_distance(track_pts[1], track_pts[2])) / 1000
+    np.testing.assert_allclose(odo['cum_dist_km'][-1], length_km, rtol=1e-12)
+    assert odo['total_time_h'][-1] == 2
+    np.testing.assert_allclose(odo['avg_vel_kmh'][1:], length_km / 2, rtol=1e-12)
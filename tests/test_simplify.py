@@ -0,0 +1,62 @@
+import numpy as np
+import pytest
+
+from simplify import simplify_track, protected_points, local_projection
+from trip_tracker import GpxTripTracker
+
+
+@pytest.fixture(scope='module')
+def processed_track(synthetic_track, tmp_path_factory):
+    track_path, ref_path = synthetic_track
+    tracker = GpxTripTracker('bike', track_path, ref_path, corrected_dir=tmp_path_factory.mktemp('corrected'))
+    return tracker.process()
+
+
+def dropped_point_deviations(xy, keep):
+    """distances of the dropped points to the chord of their neighbouring kept points, point by point"""
+    kept = np.where(keep)[0]
+    deviations = list()
+    for start, end in zip(kept[:-1], kept[1:]):
+        seg = xy[end] - xy[start]
+        for idx in range(start + 1, end):
+            t = np.clip(np.dot(xy[idx] - xy[start], seg) / np.dot(seg, seg), 0, 1) if np.dot(seg, seg) else 0
+            deviations.append(np.linalg.norm(xy[idx] - (xy[start] + t * seg)))
+    return np.array(deviations)
+
+
+@pytest.mark.parametrize('tolerance_m', [0.5, 5.0, 50.0])
+def test_simplify_tolerance_invariants(processed_track, tolerance_m):
+    track_pts, odo = processed_track
+    simple_pts, simple_odo, stats, keep = simplify_track(track_pts, odo, tolerance_m)
+
+    assert keep[0] and keep[-1]
+    assert keep[protected_points(track_pts, odo)].all()
+    assert (track_pts[keep] == simple_pts).all()
+    assert stats['points_in'] == len(track_pts)
+    assert stats['points_out'] == len(simple_pts) < len(track_pts)
+    deviations = dropped_point_deviations(local_projection(track_pts), keep)
+    assert deviations.max() <= tolerance_m
+    assert stats['max_deviation_m'] == pytest.approx(deviations.max(), abs=1e-9)
+
+    np.testing.assert_array_equal(simple_odo['cum_dist_km'], odo['cum_dist_km'][keep])
+    np.testing.assert_array_equal(simple_odo['total_time_h'], odo['total_time_h'][keep])
+    assert simple_odo['dist_m'].sum() == pytest.approx(odo['dist_m'].sum(), rel=1e-12)
+    assert simple_odo['time_delta_s'].sum() == pytest.approx(odo['time_delta_s'].sum(), rel=1e-12)
+
+
+def test_simplify_keeps_protected_idx(processed_track):
+    track_pts, odo = processed_track
+    _, _, coarse, coarse_keep = simplify_track(track_pts, odo, 50.0)
+    protected_idx = np.where(~coarse_keep)[0][::7]
+    _, _, stats, keep = simplify_track(track_pts, odo, 50.0, protected_idx)
+
+    assert keep[protected_idx].all()
+    assert keep[protected_points(track_pts, odo)].all()
+    assert stats['points_out'] > coarse['points_out']
+    assert stats['max_deviation_m'] <= 50.0
+
+
+def test_larger_tolerance_keeps_fewer_points(processed_track):
+    track_pts, odo = processed_track
+    points_out = [simplify_track(track_pts, odo, tolerance_m)[2]['points_out'] for tolerance_m in (0.5, 5.0, 50.0)]
+    assert points_out == sorted(points_out, reverse=True)
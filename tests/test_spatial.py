@@ -0,0 +1,22 @@
+import numpy as np
+
+from spatial import ReferenceIndex
+from trip_tracker import GpxTripTracker
+
+
+def test_closest_matches_brute_force(synthetic_track):
+    track_path, ref_path = synthetic_track
+    tracker = GpxTripTracker('bike', track_path, ref_path)
+    track_pts = tracker.read_file(track_path)
+    ref_pts = tracker.read_file(ref_path)
+    ref_index = ReferenceIndex(ref_pts)
+
+    rng = np.random.default_rng(0)
+    queries = track_pts[rng.choice(len(track_pts), 200, replace=False)]
+    queries['lat'] += rng.normal(0, 1e-3, len(queries))
+    queries['lon'] += rng.normal(0, 1e-3, len(queries))
+    starts = np.where(np.arange(len(queries)) % 2, rng.integers(0, len(ref_pts), len(queries)), 0)
+
+    for track_pt, start_idx in zip(queries, starts):
+        assert ref_index.closest(track_pt, start_idx) == GpxTripTracker.find_closest(track_pt, ref_pts, start_idx)
+    assert ref_index.closest(queries[0], len(ref_pts)) is None
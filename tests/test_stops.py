@@ -0,0 +1,71 @@
+import numpy as np
+import pytest
+
+from geo import consecutive_distances
+from stops import find_stops, stop_steps
+from trip_tracker import GpxTripTracker
+
+# (moving seconds, stationary seconds) phases of the synthetic ride, the 40 s halt is shorter than the minimal stop
+PHASES = [(300, 200), (300, 40), (200, 150), (100, 0)]
+SPEED_MPS = 5.0
+
+
+def make_ride(seed=0):
+    """track sampled every second moving east at SPEED_MPS with GPS noise while stationary, known stop intervals"""
+    rng = np.random.default_rng(seed)
+    east_m, stationary, stop_intervals = [0.0], [False], list()
+    for moving_s, stop_s in PHASES:
+        east_m.extend(east_m[-1] + SPEED_MPS * np.arange(1, moving_s + 1))
+        stationary.extend([False] * moving_s)
+        if stop_s:
+            stop_intervals.append((len(east_m) - 1, len(east_m) - 1 + stop_s))
+        east_m.extend([east_m[-1]] * stop_s)
+        stationary.extend([True] * stop_s)
+    east_m = np.array(east_m)
+    noise_m = np.where(stationary, rng.normal(0, 0.3, (2, len(east_m))), 0)
+
+    track_pts = np.zeros(len(east_m), dtype=GpxTripTracker.GPS_DTYPE)
+    track_pts['lat'] = 49.0 + np.rad2deg(noise_m[1] / 6371008.8)
+    track_pts['lon'] = 14.0 + np.rad2deg((east_m + noise_m[0]) / 6371008.8 / np.cos(np.deg2rad(49.0)))
+    track_pts['timestamp'] = np.datetime64('2020-06-01T08:00:00', 'ns') + np.arange(len(east_m)).astype('m8[s]')
+    track_pts['pt_type'] = 'original'
+    return track_pts, stop_intervals
+
+
+def test_find_stops_on_known_stops():
+    track_pts, stop_intervals = make_ride()
+    tracker = GpxTripTracker('bike', 'ride.gpx', detect_stops=True)
+    stops = tracker.find_stops(track_pts)
+
+    long_stops = [(start, end) for start, end in stop_intervals if end - start >= tracker.STOP_MIN_DURATION_S]
+    assert len(stops) == len(long_stops)
+    half_window = tracker.STOP_WINDOW_S / 2
+    for stop, (start, end) in zip(stops, long_stops):
+        assert abs(stop['start_idx'] - start) <= half_window
+        assert abs(stop['end_idx'] - end) <= half_window
+        assert stop['duration_s'] == pytest.approx(end - start, abs=tracker.STOP_WINDOW_S)
+        assert stop['duration_s'] == (stop['end_ts'] - stop['start_ts']) / np.timedelta64(1, 's')
+        assert stop['lat'] == pytest.approx(track_pts['lat'][start], abs=1e-5)
+        assert stop['lon'] == pytest.approx(track_pts['lon'][start], abs=1e-5)
+
+
+def test_stops_excluded_from_moving_time():
+    track_pts, _ = make_ride()
+    tracker = GpxTripTracker('bike', 'ride.gpx', detect_stops=True)
+    odo = tracker.extract_odometry(track_pts)
+
+    in_stop = stop_steps(tracker.stops, len(track_pts) - 1)
+    stop_time_s = sum(tracker.stops['duration_s'])
+    assert in_stop.sum() == stop_time_s
+    assert odo['total_time_h'][-1] * 3600 == pytest.approx(len(track_pts) - 1 - stop_time_s)
+    assert (odo['avg_vel_kmh'][1:][in_stop] == 0).all()
+
+
+def test_merge_gap_joins_interrupted_stop():
+    track_pts, _ = make_ride()
+    dist = consecutive_distances(track_pts)
+    separate = find_stops(track_pts, dist, 1.4, 30, 30, 0)
+    merged = find_stops(track_pts, dist, 1.4, 30, 30, 600)
+    assert len(merged) < len(separate)
+    assert merged['start_idx'][0] == separate['start_idx'][0]
+    assert merged['end_idx'][-1] == separate['end_idx'][-1]
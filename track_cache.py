@@ -0,0 +1,78 @@
+import os
+import shutil
+import hashlib
+import logging
+import numpy as np
+
+from utils import CACHE_DIR, str2path, atomic_write
+
+
+class TrackCache:
+    """
+    Persistent cache of processed track points and odometry. Every entry is a directory of .npy files
+    named by the hash of the key parts, entries are loaded memory-mapped. Least recently used entries
+    are evicted when the cache grows over max_size_bytes.
+    """
+
+    ENTRY_FILES = ('track_points.npy', 'odometry.npy')
+
+    def __init__(self, cache_dir=CACHE_DIR, max_size_mb=512):
+        self.cache_dir = str2path(cache_dir)
+        self.max_size_bytes = max_size_mb * 1024 * 1024
+        self.log = logging.getLogger('root')
+
+    @staticmethod
+    def file_hash(file_path):
+        """sha256 of the file content, empty string for no file"""
+        if file_path is None:
+            return ''
+        digest = hashlib.sha256()
+        with open(file_path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                digest.update(chunk)
+        return digest.hexdigest()
+
+    @staticmethod
+    def key(*parts):
+        return hashlib.sha256('|'.join(str(part) for part in parts).encode()).hexdigest()
+
+    def load(self, key):
+        """returns memory-mapped (track_points, odometry) of the entry, None if the entry does not exist"""
+        entry_dir = self.cache_dir / key
+        try:
+            arrays = tuple(np.load((entry_dir / name).as_posix(), mmap_mode='c') for name in self.ENTRY_FILES)
+            os.utime(entry_dir.as_posix())
+        except (OSError, ValueError):
+            return None
+        return arrays
+
+    def store(self, key, track_points, odometry):
+        """
+        stores the entry, every file is written atomically, the key depends on the content,
+        so the files of an entry never mix two versions and an incomplete entry fails to load
+        """
+        entry_dir = self.cache_dir / key
+        entry_dir.mkdir(parents=True, exist_ok=True)
+        for name, array in zip(self.ENTRY_FILES, (track_points, odometry)):
+            with atomic_write(entry_dir / name) as f:
+                np.save(f, array)
+        self.evict()
+
+    def evict(self):
+        """removes least recently used entries until the cache fits into max_size_bytes"""
+        entries = list()
+        total_size = 0
+        for entry_dir in self.cache_dir.iterdir():
+            try:
+                size = sum(f.stat().st_size for f in entry_dir.iterdir())
+                entries.append((entry_dir.stat().st_mtime, size, entry_dir))
+            except OSError:
+                continue
+            total_size += size
+
+        for _, size, entry_dir in sorted(entries):
+            if total_size <= self.max_size_bytes:
+                break
+            self.log.info(f'Evicting cache entry {entry_dir.name}')
+            shutil.rmtree(entry_dir.as_posix(), ignore_errors=True)
+            total_size -= size
@@ -1,10 +1,12 @@
 import datetime
+import itertools
 import numpy as np
-import gpxpy
 
-from utils import str2path, simple_logger, interpolate_timestamps
-from geo import calculate_distance
+from utils import str2path, simple_logger, interpolate_timestamps, datetime64_to_datetime
+from utils import stage_timer, peak_rss_bytes, to_json, run_profiled, OUTPUT_DIR
+from geo import calculate_distance, calculate_distances, consecutive_distances, DISTANCE_MODELS, geodesic_counter
 from elastic_interface import ElasticAPI
+from gpx_stream import read_gpx, UnsupportedGpxError
 
 
 FDIR = str2path(__file__).parent.resolve()
@@ -15,17 +17,25 @@ MPS2KPH = 3.6
 
 class GpxTripTracker(ElasticAPI):
 
-    GPS_DTYPE = [('lat', 'f8'), ('lon', 'f8'), ('ele', 'f8'), ('timestamp', 'O'), ('sid', 'i4'), ('pt_type', 'U16')]
+    GPS_DTYPE = [('lat', 'f8'), ('lon', 'f8'), ('ele', 'f8'), ('timestamp', 'M8[ns]'), ('sid', 'i4'), ('pt_type', 'U16')]
     ODO_DTYPE = [('cum_dist_km', 'f8'), ('dist_m', 'f8'), ('avg_vel_kmh', 'f8'), ('elev_delta_m', 'f8'),
                  ('time_delta_s', 'f8'), ('total_time_h', 'f8'), ('elev_up_cum_m', 'f8'), ('elev_down_cum_m', 'f8')]
     MODES = ['bike', 'run', 'walk']
+    LAYOUTS = ['point', 'chunk', 'trip']
     SLOW_MODES = ['walk']
     STOP_VEL_FAST_MPS = 1.4
     STOP_VEL_SLOW_MPS = 0.7
+    STOP_WINDOW_S = 30
+    STOP_MIN_DURATION_S = 60
+    STOP_MERGE_GAP_S = 30
     MIN_SEPARATION_CORRECTION_DIST_M = 30
+    ALGORITHM_VERSION = 2
+    CORRECTED_SUFFIX = '_corrected'
 
     def __init__(self, transport_mode=None, track_file_path=None, ref_file_path=None, start=None, end=None,
-                 *args, **kwargs):
+                 cache=None, rebuild_cache=False, fast_serialization=False, layout='point', layout_chunk_size=1000,
+                 simplify_tolerance_m=None, distance_model='vincenty', detect_stops=False, ref_library=None,
+                 metrics_in_overview=False, sinks=None, corrected_dir=None, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self.transport_mode = self._validate_transport_mode(transport_mode)
         self.track_file_path = str2path(track_file_path)
@@ -33,6 +43,24 @@ class GpxTripTracker(ElasticAPI):
         self.start = datetime.datetime.fromisoformat(start) if start else start
         self.end = datetime.datetime.fromisoformat(end) if end else end
         self.log = simple_logger()
+        self.timings = dict()
+        self.counters = dict()
+        self.cache = cache
+        self.rebuild_cache = rebuild_cache
+        self.fast_serialization = fast_serialization
+        self.layout = self._validate_layout(layout)
+        self.layout_chunk_size = layout_chunk_size
+        self.simplify_tolerance_m = simplify_tolerance_m
+        self.distance_model = self._validate_distance_model(distance_model)
+        self.detect_stops = detect_stops
+        self.stops = None
+        self.ref_library = None
+        if ref_library:
+            from reference_library import ReferenceLibrary
+            self.ref_library = ReferenceLibrary(ref_library, self.GPS_DTYPE)
+        self.metrics_in_overview = metrics_in_overview
+        self.sinks = list(sinks or ())
+        self.corrected_dir = str2path(corrected_dir)
 
     def read_file(self, file_path):
         """reads GPX file and builds track points data structure"""
@@ -41,6 +69,15 @@ class GpxTripTracker(ElasticAPI):
             self.log.error(err_msg)
             raise FileExistsError(err_msg)
 
+        try:
+            return read_gpx(file_path, self.GPS_DTYPE)
+        except UnsupportedGpxError as ex:
+            self.log.warning(f'{ex}, falling back to gpxpy parser')
+            return self._read_file_gpxpy(file_path)
+
+    def _read_file_gpxpy(self, file_path):
+        """reads GPX file using gpxpy object model, slow but handles exotic files"""
+        import gpxpy
         track_points = list()
         pt_type = 'original'
         with open(file_path, 'r') as gpx_file:
@@ -49,19 +86,64 @@ class GpxTripTracker(ElasticAPI):
                 for sid, segment in enumerate(track.segments):
                     for point in segment.points:
                         if point.time is None:
-                            timestamp = 0
+                            timestamp = np.datetime64('NaT')
                         else:
-                            timestamp = datetime.datetime.utcfromtimestamp(point.time.timestamp())
+                            timestamp = np.datetime64(datetime.datetime.utcfromtimestamp(point.time.timestamp()), 'ns')
                         track_points.append((point.latitude, point.longitude, point.elevation, timestamp, sid, pt_type))
 
         return np.array(track_points, dtype=self.GPS_DTYPE)
 
-    def ingest(self, track_points, odometry):
-        """main ingestion to the elastic index"""
-        if isinstance(track_points[0]['timestamp'], datetime.datetime):
+    def index_exists(self):
+        """the compact layouts also need the geo_shape mapping of the trajectory, see TrackChunkEncoder.MAPPINGS"""
+        exists = super().index_exists()
+        if self.layout != 'point':
+            from ndjson_serializer import TrackChunkEncoder
+            self.check_mapping(TrackChunkEncoder.MAPPINGS)
+        return exists
+
+    def ingest(self, track_points, odometry, checked=False):
+        """
+        main ingestion, the trip is written to the elastic index if set and to the sinks,
+        the ES sink is loaded only with an index, so the offline runs never import the client,
+        checked skips the index and trip checks already done by the caller
+        """
+        global_message = self.summarize(track_points, odometry)
+
+        sinks = self.sinks
+        if self.es_index is not None:
+            from sinks import ElasticSink
+            sinks = [ElasticSink(checked)] + sinks
+        else:
+            self.log.warning('The index is None, hence no ingest to ES')
+
+        for sink in sinks:
+            sink.write(self, global_message, track_points, odometry)
+
+        return global_message
+
+    def document_lines(self, track_points, odometry, trip_type, first_point_id=1):
+        """
+        serialized bulk (action line, data line) pairs of the trip documents of the layout and of the stops,
+        first_point_id applies to the point layout, the chunk and trip layouts need the whole track
+        """
+        if self.layout != 'point':
+            lines = self.encode_chunks(track_points, odometry, trip_type)
+        elif self.fast_serialization:
+            lines = self.encode_points(track_points, odometry, trip_type, first_point_id)
+        else:
+            lines = self._serialize_actions(self.process_generator(
+                self.ingest_generator(track_points, odometry, trip_type, first_point_id)))
+        if self.stops is not None and len(self.stops):
+            lines = itertools.chain(lines, self._serialize_actions(self.process_generator(
+                self.stop_generator(self.stops, trip_type))))
+        return lines
+
+    def summarize(self, track_points, odometry):
+        """builds the trip overview message"""
+        if self._is_tracked(track_points):
             trip_type = 'driven'
-            trip_start_utc = track_points[0]['timestamp']
-            trip_end_utc = track_points[-1]['timestamp']
+            trip_start_utc = datetime64_to_datetime(track_points[0]['timestamp'])
+            trip_end_utc = datetime64_to_datetime(track_points[-1]['timestamp'])
 
         elif self.start is not None:
             trip_type = 'untracked'
@@ -72,12 +154,19 @@ class GpxTripTracker(ElasticAPI):
             trip_start_utc = ''
             trip_end_utc = ''
 
-        trip_length_km = odometry['cum_dist_km'][-1]
-        trip_duration_h = odometry['total_time_h'][-1]
+        global_message = self.overview(trip_type, trip_start_utc, trip_end_utc, odometry['cum_dist_km'][-1],
+                                       odometry['total_time_h'][-1], np.max(track_points['ele']),
+                                       np.min(track_points['ele']))
+        if self.stops is not None:
+            global_message['trip_stop_count'] = len(self.stops)
+            global_message['trip_stopped_h'] = np.sum(self.stops['duration_s']) * SEC2H
+        return global_message
+
+    def overview(self, trip_type, trip_start_utc, trip_end_utc, trip_length_km, trip_duration_h,
+                 trip_max_elev_m, trip_min_elev_m):
+        """builds the trip overview message from the trip aggregates"""
         trip_total_duration_h = (trip_end_utc - trip_start_utc).total_seconds() * SEC2H
         trip_avg_vel_kph = trip_length_km / trip_duration_h if trip_duration_h > 0 else 0
-        trip_max_elev_m = np.max(track_points['ele'])
-        trip_min_elev_m = np.min(track_points['ele'])
 
         global_message = {"trip_id": self.track_file_path.stem,
                           "trip_type": trip_type,
@@ -92,30 +181,12 @@ class GpxTripTracker(ElasticAPI):
                           "trip_max_elev_m": trip_max_elev_m,
                           "trip_min_elev_m": trip_min_elev_m}
 
-        if self.es_index is not None:
-            self.index_exists()
-            trip_exists = self.trip_exists(global_message['trip_id'])
-            if trip_exists:
-                self.log.warning(f"The trip {global_message['trip_id']} already exists in the index, skipping ingest")
-                return global_message
-
-            elif trip_exists is None:
-                self.log.error("Trip ID query failed, cannot ingest")
-                return global_message
-
-            else:
-                self.push(global_message)
-                self.log.info('Ingesting trip points...')
-                self.bulk_push(self.ingest_generator(track_points, odometry, trip_type))
-        else:
-            self.log.warning('The index is None, hence no ingest to ES')
-
         return global_message
 
     def _ingest_geo_point(self, track_pt, odo_sample, trip_type, point_id):
         """push track point data to the elastic"""
-        point_timestamp_utc = track_pt['timestamp']
-        if not isinstance(track_pt['timestamp'], datetime.datetime):
+        point_timestamp_utc = datetime64_to_datetime(track_pt['timestamp'])
+        if point_timestamp_utc is None:
             point_timestamp_utc = self.start if self.start else datetime.datetime.utcnow()
         data = {"location": {"lat": track_pt['lat'], "lon": track_pt['lon']},
                 "elevation_m": track_pt['ele'],
@@ -131,69 +202,130 @@ class GpxTripTracker(ElasticAPI):
                 "transport_mode": self.transport_mode}
         return data
 
-    def ingest_generator(self, track_points, odometry, trip_type):
+    def stop_generator(self, stops, trip_type):
+        """stop documents, point ids refer to the ingested track points, the simplified ones with simplification"""
+        for stop_id, stop in enumerate(stops):
+            yield {"location": {"lat": stop['lat'], "lon": stop['lon']},
+                   "trip_id": self.track_file_path.stem,
+                   "stop_id": stop_id,
+                   "trip_type": trip_type,
+                   "trip_source_gpx": self.track_file_path.as_posix(),
+                   "transport_mode": self.transport_mode,
+                   "stop_start_utc": datetime64_to_datetime(stop['start_ts']),
+                   "stop_end_utc": datetime64_to_datetime(stop['end_ts']),
+                   "stop_duration_s": stop['duration_s'],
+                   "start_point_id": int(stop['start_idx']) + 1,
+                   "end_point_id": int(stop['end_idx']) + 1}
+
+    def ingest_generator(self, track_points, odometry, trip_type, first_point_id=1):
         for idx, (pt, odo_sample) in enumerate(zip(track_points, odometry)):
-            data = self._ingest_geo_point(pt, odo_sample, trip_type, idx + 1)
+            data = self._ingest_geo_point(pt, odo_sample, trip_type, idx + first_point_id)
             yield data
 
+    def encode_points(self, track_points, odometry, trip_type, first_point_id=1):
+        """fast counterpart of ingest_generator, yields serialized bulk lines of the point documents"""
+        from ndjson_serializer import PointDocumentEncoder
+        ingest_ts = datetime.datetime.utcnow()
+        encoder = PointDocumentEncoder(self.es_index, self._constant_fields(trip_type, ingest_ts))
+        return encoder.encode(track_points, odometry, self.start if self.start else ingest_ts, first_point_id)
+
+    def encode_chunks(self, track_points, odometry, trip_type):
+        """yields serialized bulk lines of the compact layout, one document per trip or per layout_chunk_size points"""
+        from ndjson_serializer import TrackChunkEncoder
+        ingest_ts = datetime.datetime.utcnow()
+        constant_fields = self._constant_fields(trip_type, ingest_ts)
+        constant_fields['doc_layout'] = self.layout
+        chunk_size = self.layout_chunk_size if self.layout == 'chunk' else None
+        encoder = TrackChunkEncoder(self.es_index, constant_fields, chunk_size)
+        return encoder.encode(track_points, odometry, self.start if self.start else ingest_ts)
+
+    def _constant_fields(self, trip_type, ingest_ts):
+        return {"trip_id": self.track_file_path.stem,
+                "trip_type": trip_type,
+                "trip_source_gpx": self.track_file_path.as_posix(),
+                "transport_mode": self.transport_mode,
+                "timestamp": ingest_ts.isoformat()}
+
     def extract_odometry(self, track_points):
         """Odometry extraction"""
-        odo = np.zeros((len(track_points)), dtype=self.ODO_DTYPE)
+        if self._is_tracked(track_points):
+            return self.tracked_odometry(track_points)
 
-        if isinstance(track_points[0]['timestamp'], datetime.datetime):
-            elev_up_cum = 0
-            elev_down_cum = 0
-            med_time_delta = np.median(np.diff(track_points['timestamp'])).total_seconds()
-            time_threshold = med_time_delta * 4
-
-            for idx, pt in enumerate(track_points):
-                try:
-                    next_pt = track_points[idx+1]
-                    dist = calculate_distance(pt, next_pt)
-                    dt = (next_pt['timestamp'] - pt['timestamp']).total_seconds()
-                    if dt > time_threshold:
-                        if self._check_stop(dt, dist):
-                            dt = med_time_delta
-                    elev_delta = next_pt['ele'] - pt['ele'] if (next_pt['ele'] != 0 or pt['ele'] != 0) else 0
-                    if elev_delta > 0:
-                        elev_up_cum += elev_delta
-                    else:
-                        elev_down_cum -= elev_delta
-
-                    odo[idx+1]['dist_m'] = dist
-                    odo[idx+1]['elev_delta_m'] = elev_delta
-                    odo[idx+1]['elev_up_cum_m'] = elev_up_cum
-                    odo[idx+1]['elev_down_cum_m'] = elev_down_cum
-                    odo[idx+1]['time_delta_s'] = dt
-
-                except IndexError:
-                    break
+        odo = np.zeros((len(track_points)), dtype=self.ODO_DTYPE)
+        total_time_s = 0
+        if self.start is not None:
+            total_time_s = (self.end - self.start).total_seconds()
 
-            odo['avg_vel_kmh'][1:] = (odo['dist_m'][1:] / odo['time_delta_s'][1:]) * MPS2KPH
-            odo['total_time_h'] = (np.cumsum(odo['time_delta_s'])) * SEC2H
-            odo['cum_dist_km'] = (np.cumsum(odo['dist_m'])) * M2KM
-        else:
-            total_time_s = 0
-            if self.start is not None:
-                total_time_s = (self.end - self.start).total_seconds()
+        odo['dist_m'][1:] = consecutive_distances(track_points, self.distance_model)
+        odo['cum_dist_km'] = (np.cumsum(odo['dist_m'])) * M2KM
+        odo['total_time_h'][-1] = total_time_s * SEC2H
+        odo['avg_vel_kmh'][1:] = (odo['cum_dist_km'][-1] / odo['total_time_h'][-1]) if total_time_s else 0
 
-            for idx, pt in enumerate(track_points):
-                try:
-                    next_pt = track_points[idx + 1]
-                    dist = calculate_distance(pt, next_pt)
-                    odo[idx + 1]['dist_m'] = dist
+        return odo
 
-                except IndexError:
-                    break
+    def tracked_odometry(self, track_points, med_time_delta=None):
+        """
+        odometry of the tracked points, cumulative values start from zero at the first point,
+        stops are detected against med_time_delta [s], the median of the track time deltas by default,
+        with detect_stops the detected stops are kept in stops and excluded from the moving time
+        """
+        odo = np.zeros((len(track_points)), dtype=self.ODO_DTYPE)
+        dist = consecutive_distances(track_points, self.distance_model)
+        dt = np.diff(track_points['timestamp']) / np.timedelta64(1, 's')
+        if med_time_delta is None:
+            med_time_delta = np.median(dt)
+        time_threshold = med_time_delta * 4
+
+        stop_candidates = np.where(dt > time_threshold)[0]
+        stops = stop_candidates[self._check_stop(dt[stop_candidates], dist[stop_candidates])]
+        dt[stops] = med_time_delta
+        in_stop = None
+        if self.detect_stops:
+            from stops import stop_steps
+            self.stops = self.find_stops(track_points, dist, med_time_delta)
+            in_stop = stop_steps(self.stops, len(dt))
+            dt[in_stop] = 0
+
+        ele = track_points['ele']
+        elev_delta = np.diff(ele)
+        elev_delta[(ele[1:] == 0) & (ele[:-1] == 0)] = 0
+
+        odo['dist_m'][1:] = dist
+        odo['elev_delta_m'][1:] = elev_delta
+        odo['elev_up_cum_m'][1:] = np.cumsum(np.where(elev_delta > 0, elev_delta, 0))
+        odo['elev_down_cum_m'][1:] = np.cumsum(np.where(elev_delta > 0, 0, -elev_delta))
+        odo['time_delta_s'][1:] = dt
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            odo['avg_vel_kmh'][1:] = (odo['dist_m'][1:] / odo['time_delta_s'][1:]) * MPS2KPH
+        if in_stop is not None:
+            odo['avg_vel_kmh'][1:][in_stop] = 0
+        odo['total_time_h'] = (np.cumsum(odo['time_delta_s'])) * SEC2H
+        odo['cum_dist_km'] = (np.cumsum(odo['dist_m'])) * M2KM
 
-            odo['cum_dist_km'] = (np.cumsum(odo['dist_m'])) * M2KM
-            odo['total_time_h'][-1] = total_time_s * SEC2H
-            odo['avg_vel_kmh'][1:] = (odo['cum_dist_km'][-1] / odo['total_time_h'][-1]) if total_time_s else 0
+        return odo
 
+    def find_stops(self, track_points, dist=None, med_time_delta=None):
+        """stop intervals of the tracked points, see stops.find_stops"""
+        from stops import find_stops
+        if dist is None:
+            dist = consecutive_distances(track_points, self.distance_model)
+        return find_stops(track_points, dist, self.stop_velocity_threshold(), self.STOP_WINDOW_S,
+                          self.STOP_MIN_DURATION_S, self.STOP_MERGE_GAP_S, med_time_delta)
+
+    def continue_odometry(self, track_points, last_point, last_odo, med_time_delta):
+        """
+        odometry of the tracked points following last_point, a single point array with odometry last_odo,
+        the cumulative values continue from last_odo
+        """
+        odo = self.tracked_odometry(np.concatenate((last_point, track_points)), med_time_delta)[1:]
+        for field in ('cum_dist_km', 'total_time_h', 'elev_up_cum_m', 'elev_down_cum_m'):
+            odo[field] += last_odo[field]
         return odo
 
     def write_corrected_data(self, track_points):
-        """writes corrected track_points to the GPX file"""
+        """writes corrected track_points to the GPX file next to the track or to corrected_dir if set"""
+        import gpxpy.gpx
         gpx = gpxpy.gpx.GPX()
 
         gpx_track = gpxpy.gpx.GPXTrack()
@@ -203,11 +335,14 @@ class GpxTripTracker(ElasticAPI):
         gpx_track.segments.append(gpx_segment)
 
         for pt in track_points:
-            gpx_segment.points.append(gpxpy.gpx.GPXTrackPoint(pt['lat'], pt['lon'], pt['ele'], pt['timestamp']))
+            gpx_segment.points.append(gpxpy.gpx.GPXTrackPoint(pt['lat'], pt['lon'], pt['ele'],
+                                                              datetime64_to_datetime(pt['timestamp'])))
 
         xml2write = gpx.to_xml()
-        output_name = self.track_file_path.stem + '_corrected' + self.track_file_path.suffix
-        output_path = self.track_file_path.parent / output_name
+        output_name = self.track_file_path.stem + self.CORRECTED_SUFFIX + self.track_file_path.suffix
+        output_dir = self.corrected_dir or self.track_file_path.parent
+        output_dir.mkdir(parents=True, exist_ok=True)
+        output_path = output_dir / output_name
 
         with open(output_path.as_posix(), 'w') as f:
             f.write(xml2write)
@@ -220,37 +355,179 @@ class GpxTripTracker(ElasticAPI):
             ref_points = self.read_file(self.ref_file_path)
         return track_points, ref_points
 
+    def process(self):
+        """
+        data extraction, possible data correction, extraction of odometry and optional simplification,
+        stage timings are kept in timings
+        """
+        track_pts, odo = self._process_full_resolution()
+        if self.simplify_tolerance_m is not None:
+            track_pts, odo = self.simplify(track_pts, odo)
+        return track_pts, odo
+
+    def simplify(self, track_pts, odo):
+        """
+        simplifies the track within simplify_tolerance_m keeping the odometry of the full resolution data,
+        the stop bounds are kept and the stops are renumbered to the simplified points
+        """
+        from simplify import simplify_track
+        from stops import remap_stops
+        protected_idx = None
+        if self.stops is not None:
+            protected_idx = np.concatenate((self.stops['start_idx'], self.stops['end_idx']))
+        with stage_timer(self.timings, 'simplify'):
+            track_pts, odo, stats, keep = simplify_track(track_pts, odo, self.simplify_tolerance_m, protected_idx)
+        if self.stops is not None:
+            self.stops = remap_stops(self.stops, keep)
+        self.counters['simplified_points'] = stats['points_out']
+        self.log.info(f"Simplified {stats['points_in']} to {stats['points_out']} points, "
+                      f"reduction ratio: {stats['reduction_ratio']:.3f}, "
+                      f"max deviation: {stats['max_deviation_m']:.2f} m")
+        return track_pts, odo
+
+    def _process_full_resolution(self):
+        cache_key = None
+        if self.cache is not None:
+            with stage_timer(self.timings, 'cache'):
+                cache_key = self.cache_key()
+                cached = None if self.rebuild_cache else self.cache.load(cache_key)
+            if cached is not None:
+                self.log.info(f'Loaded {self.track_file_path.name} from cache')
+                self.counters['cache_hit'] = True
+                self.counters['points'] = len(cached[0])
+                if self.detect_stops and self._is_tracked(cached[0]):
+                    self.stops = self.find_stops(cached[0])
+                return cached
+
+        with stage_timer(self.timings, 'read'):
+            track_pts, ref_pts = self.extract_data()
+        self.counters['track_points'] = len(track_pts)
+        self.counters['ref_points'] = len(ref_pts) if ref_pts is not None else 0
+
+        with stage_timer(self.timings, 'correct'):
+            if ref_pts is not None or self.ref_library is not None:
+                track_pts = self.correct_track_points(track_pts, ref_pts)
+                self.write_corrected_data(track_pts)
+        self.counters['points'] = len(track_pts)
+
+        with stage_timer(self.timings, 'odometry'):
+            odo = self.extract_odometry(track_pts)
+
+        if cache_key is not None:
+            self.cache.store(cache_key, track_pts, odo)
+        return track_pts, odo
+
+    def cache_key(self):
+        """key of the processed data, depends on the content of the files and on all the processing parameters"""
+        return self.cache.key(self.cache.file_hash(self.track_file_path),
+                              self.cache.file_hash(self.ref_file_path),
+                              self.transport_mode,
+                              self.start,
+                              self.end,
+                              self.distance_model,
+                              self.detect_stops,
+                              self.ref_library.fingerprint() if self.ref_library else '',
+                              self.ALGORITHM_VERSION)
+
     def run(self):
-        """main method for data extraction, possible data correction, extraction of odometry and ingest to elastic"""
-        track_pts, ref_pts = self.extract_data()
-        if ref_pts is not None:
-            track_pts = self.correct_track_points(track_pts, ref_pts)
-            self.write_corrected_data(track_pts)
-        odo = self.extract_odometry(track_pts)
-        overview = self.ingest(track_pts, odo)
+        """
+        main method for data extraction, possible data correction, extraction of odometry and ingest to elastic,
+        with metrics_in_overview the instrumentation is added to the overview as metrics
+        """
+        with stage_timer(self.timings, 'run'), geodesic_counter(self.counters):
+            track_pts, odo = self.process()
+            with stage_timer(self.timings, 'ingest'):
+                overview = self.ingest(track_pts, odo)
         self.log.info(f'{overview}')
-
-    def correct_track_points(self, track_points, ref_points):
-        """runs the correction of the track_points using ref_points"""
+        if self.bulk_stats:
+            self.log.info(self.bulk_report())
+        metrics = self.metrics()
+        self.log.info(f'Metrics: {to_json(metrics)}')
+        if self.metrics_in_overview:
+            overview['metrics'] = metrics
+            if 'documents' in self.counters:
+                self.push(dict(overview), doc_id=overview['trip_id'])
+        return overview
+
+    def metrics(self):
+        """instrumentation of the last run: stage wall and CPU times, counters, bulk statistics and peak memory"""
+        stages = dict()
+        for key, value in self.timings.items():
+            if not key.endswith('_s') or key.endswith('_cpu_s'):
+                continue
+            stage = key[:-2]
+            stages[stage] = {'wall_s': value}
+            if f'{stage}_cpu_s' in self.timings:
+                stages[stage]['cpu_s'] = self.timings[f'{stage}_cpu_s']
+        peak_rss = peak_rss_bytes()
+        return {'trip_id': self.track_file_path.stem,
+                'stages': stages,
+                'counters': dict(self.counters),
+                'bulk': self.bulk_summary() if self.bulk_stats else None,
+                'peak_rss_mb': peak_rss / 2**20 if peak_rss is not None else None}
+
+    def correct_track_points(self, track_points, ref_points, ref_index=None):
+        """
+        runs the correction of the track_points using ref_points, ref_index is built if not given,
+        the gaps are filled from the reference library if ref_points is None
+        """
+        gap_fills = self.plan_corrections(track_points, ref_points, ref_index)
+        return self.assemble_corrections(track_points, gap_fills)
+
+    def plan_corrections(self, track_points, ref_points, ref_index=None):
+        """plans gap fills of all the segment breaks, returns list of (break_id, fill points) pairs"""
         sid_delta = track_points['sid'][1:] - track_points['sid'][:-1]
         idx = np.where(sid_delta != 0)[0]
+        if ref_index is None and ref_points is not None and len(idx):
+            from spatial import ReferenceIndex
+            ref_index = ReferenceIndex(ref_points)
+        gap_fills = list()
         for sid in idx:
             cur_pt = track_points[sid]
             next_pt = track_points[sid+1]
             dist = calculate_distance(cur_pt, next_pt)
             if dist > self.MIN_SEPARATION_CORRECTION_DIST_M:
                 self.log.info(f'Correcting segment between points: {sid}-{sid+1}, distance: {dist} m')
-                track_points = self.correct(track_points, ref_points, sid)
+                if ref_points is not None:
+                    gap_fills.append((sid, self.plan_gap_fill(track_points, ref_points, sid, ref_index)))
+                    continue
+                section = self.ref_library.best_section(cur_pt, next_pt)
+                if section is None:
+                    self.log.warning(f'No reference route of the library connects points {sid}-{sid+1}')
+                    continue
+                gap_fills.append((sid, self.plan_gap_fill(track_points, section, sid)))
 
-        return track_points
+        return gap_fills
 
-    def correct(self, track_pts, ref_pts, break_id):
+    @staticmethod
+    def assemble_corrections(track_pts, gap_fills):
+        """builds the corrected track in a single preallocated array, gap_fills must be sorted by break_id"""
+        corrected_pts = np.empty(len(track_pts) + sum(len(fill) for _, fill in gap_fills), dtype=track_pts.dtype)
+        src_idx = 0
+        dst_idx = 0
+        for break_id, fill_pts in gap_fills:
+            count = break_id + 1 - src_idx
+            corrected_pts[dst_idx:dst_idx+count] = track_pts[src_idx:break_id+1]
+            dst_idx += count
+            corrected_pts[dst_idx:dst_idx+len(fill_pts)] = fill_pts
+            dst_idx += len(fill_pts)
+            src_idx = break_id + 1
+        corrected_pts[dst_idx:] = track_pts[src_idx:]
+
+        return corrected_pts
+
+    def correct(self, track_pts, ref_pts, break_id, ref_index=None):
         """fills the gap of broken track_pts sequence using ref_pts"""
+        fill_pts = self.plan_gap_fill(track_pts, ref_pts, break_id, ref_index)
+        return self.assemble_corrections(track_pts, [(break_id, fill_pts)])
+
+    def plan_gap_fill(self, track_pts, ref_pts, break_id, ref_index=None):
+        """selects ref_pts filling the gap after break_id, ref_index speeds up the closest points lookup"""
         cur_pt = track_pts[break_id]
         next_pt = track_pts[break_id+1]
 
-        cur_closest_ref_id = self.find_closest(cur_pt, ref_pts, 0)
-        next_closest_ref_id = self.find_closest(next_pt, ref_pts, cur_closest_ref_id)
+        cur_closest_ref_id = self.find_closest(cur_pt, ref_pts, 0, ref_index)
+        next_closest_ref_id = self.find_closest(next_pt, ref_pts, cur_closest_ref_id, ref_index)
 
         dist_track_points = calculate_distance(cur_pt, next_pt)
         cur_ref2next_track = calculate_distance(ref_pts[cur_closest_ref_id], next_pt)
@@ -262,30 +539,24 @@ class GpxTripTracker(ElasticAPI):
         if dist_track_points < next_ref2cur_track:
             next_closest_ref_id -= 1
 
-        ref_sel_pts = ref_pts[cur_closest_ref_id:next_closest_ref_id+1]
+        ref_sel_pts = ref_pts[cur_closest_ref_id:next_closest_ref_id+1].copy()
         ref_sel_pts['timestamp'] = interpolate_timestamps(cur_pt['timestamp'],
                                                           next_pt['timestamp'],
                                                           len(ref_sel_pts))
         ref_sel_pts['sid'] = cur_pt['sid']
         ref_sel_pts['pt_type'] = 'corrected'
-        new_track_pts = track_pts[:break_id+1]
-        new_track_pts = np.concatenate((new_track_pts, ref_sel_pts))
-        new_track_pts = np.concatenate((new_track_pts, track_pts[break_id+1:]))
 
-        return new_track_pts
+        return ref_sel_pts
 
     @staticmethod
-    def find_closest(track_pt, ref_pts, start_idx):
-        """finds closest reference point to the track_pt"""
-        idxs = range(start_idx, len(ref_pts))
-        closest_dist = np.inf
-        closest_id = None
-        for idx in idxs:
-            dist = calculate_distance(track_pt, ref_pts[idx])
-            if dist < closest_dist:
-                closest_dist = dist
-                closest_id = idx
-        return closest_id
+    def find_closest(track_pt, ref_pts, start_idx, ref_index=None):
+        """finds closest reference point to the track_pt at or after start_idx"""
+        if ref_index is not None:
+            return ref_index.closest(track_pt, start_idx)
+        if start_idx >= len(ref_pts):
+            return None
+        dists = calculate_distances(track_pt, ref_pts[start_idx:])
+        return start_idx + np.nanargmin(dists)
 
     def _validate_transport_mode(self, transport_mode):
         if transport_mode in self.MODES:
@@ -294,27 +565,43 @@ class GpxTripTracker(ElasticAPI):
             self.log.error(f"{transport_mode} is unknown mean of transport, known are: {self.MODES}")
             raise ValueError(f"{transport_mode} is unknown mean of transport")
 
+    def _validate_layout(self, layout):
+        if layout in self.LAYOUTS:
+            return layout
+        else:
+            self.log.error(f"{layout} is unknown ingest layout, known are: {self.LAYOUTS}")
+            raise ValueError(f"{layout} is unknown ingest layout")
+
+    def _validate_distance_model(self, distance_model):
+        if distance_model in DISTANCE_MODELS:
+            return distance_model
+        else:
+            self.log.error(f"{distance_model} is unknown distance model, known are: {list(DISTANCE_MODELS)}")
+            raise ValueError(f"{distance_model} is unknown distance model")
+
+    @staticmethod
+    def _is_tracked(track_points):
+        """track points with recorded timestamps belong to a driven trip"""
+        return not np.isnat(track_points[0]['timestamp'])
+
+    def stop_velocity_threshold(self):
+        """speed [m/s] under which the transport mode is considered stopped"""
+        if self.transport_mode in self.SLOW_MODES:
+            return self.STOP_VEL_SLOW_MPS
+        return self.STOP_VEL_FAST_MPS
+
     def _check_stop(self, time_delta, dist):
         """detects stop in point samples"""
-        velo_threshold_ms = self.STOP_VEL_SLOW_MPS
-        if self.transport_mode not in self.SLOW_MODES:
-            velo_threshold_ms = self.STOP_VEL_FAST_MPS
         velo_ms = dist / time_delta
 
-        return velo_ms < velo_threshold_ms
-
+        return velo_ms < self.stop_velocity_threshold()
 
-if __name__ == "__main__":
-    import argparse
 
-    argp = argparse.ArgumentParser()
+def add_processing_arguments(argp):
+    """adds the command line options of the processing and ingest parameters shared by the command line tools"""
     argp.add_argument('--mode',
                       help='Mean of transport, bike, run or walk',
                       required=True)
-    argp.add_argument('--gpx-file',
-                      dest='gpx_file',
-                      help='path to the file to be processed',
-                      required=True)
     argp.add_argument('--ref-file',
                       dest='ref_file',
                       help='path to the reference file to be used for correction',
@@ -322,6 +609,96 @@ if __name__ == "__main__":
     argp.add_argument('--index',
                       help='elasticsearch index to be used for data storage, if None, no indexing will happen',
                       default=None)
+    argp.add_argument('--no-cache',
+                      dest='no_cache',
+                      action='store_true',
+                      help='do not use the cache of processed tracks')
+    argp.add_argument('--rebuild-cache',
+                      dest='rebuild_cache',
+                      action='store_true',
+                      help='process the tracks even if they are cached and replace the cache entries')
+    argp.add_argument('--cache-size-mb',
+                      dest='cache_size_mb',
+                      type=int,
+                      help='maximal size of the cache of processed tracks in MB',
+                      default=512)
+    argp.add_argument('--chunk-size',
+                      dest='chunk_size',
+                      type=int,
+                      help='maximal number of documents in one bulk request',
+                      default=500)
+    argp.add_argument('--chunk-bytes',
+                      dest='chunk_bytes',
+                      type=int,
+                      help='maximal size of one bulk request in bytes',
+                      default=100 * 1024 * 1024)
+    argp.add_argument('--bulk-workers',
+                      dest='bulk_workers',
+                      type=int,
+                      help='number of threads sending bulk requests in parallel',
+                      default=1)
+    argp.add_argument('--bulk-queue',
+                      dest='bulk_queue',
+                      type=int,
+                      help='maximal number of prepared bulk requests waiting for a free worker',
+                      default=4)
+    argp.add_argument('--max-retries',
+                      dest='max_retries',
+                      type=int,
+                      help='maximal number of retries of documents rejected with 429',
+                      default=3)
+    argp.add_argument('--fast-serialization',
+                      dest='fast_serialization',
+                      action='store_true',
+                      help='serialize the point documents directly from the arrays instead of building a dict per point')
+    argp.add_argument('--simplify-tolerance-m',
+                      dest='simplify_tolerance_m',
+                      type=float,
+                      help='simplify the tracks before ingest keeping the deviation within the tolerance in meters, '
+                           'if None, no simplification will happen',
+                      default=None)
+    argp.add_argument('--layout',
+                      choices=GpxTripTracker.LAYOUTS,
+                      help='ingest layout: point - document per track point, '
+                           'chunk - document per --layout-chunk-size points, trip - single document per trip',
+                      default='point')
+    argp.add_argument('--layout-chunk-size',
+                      dest='layout_chunk_size',
+                      type=int,
+                      help='number of track points in one document of the chunk layout',
+                      default=1000)
+    argp.add_argument('--distance-model',
+                      dest='distance_model',
+                      choices=list(DISTANCE_MODELS),
+                      help='distance model of the odometry: vincenty - exact on the WGS84 ellipsoid, '
+                           'haversine - sphere, flat - local tangent plane, auto - flat for steps under 1 km, '
+                           'vincenty otherwise',
+                      default='vincenty')
+    argp.add_argument('--detect-stops',
+                      dest='detect_stops',
+                      action='store_true',
+                      help='detect the stops of the tracked trips, exclude them from the moving time '
+                           'and ingest them as separate documents')
+
+
+if __name__ == "__main__":
+    import argparse
+    import functools
+
+    from sinks import FILE_SINKS
+    from track_cache import TrackCache
+
+    argp = argparse.ArgumentParser()
+    add_processing_arguments(argp)
+    argp.add_argument('--gpx-file',
+                      dest='gpx_file',
+                      help='path to the file to be processed',
+                      required=True)
+    argp.add_argument('--ref-library',
+                      dest='ref_library',
+                      help='directory of reference GPX files, the gaps are filled from the route connecting them best, '
+                           'used if --ref-file is not set',
+                      default=None)
     argp.add_argument('--start',
                       help='Isoformat time of a trip start,'
                            ' set it for untracked trips, None for tracked or planned trips',
@@ -330,11 +707,98 @@ if __name__ == "__main__":
                       help='Isoformat time of a trip end, '
                            'set it for untracked trips, None for tracked or planned trips',
                       default=None)
+    argp.add_argument('--output-format',
+                      dest='output_format',
+                      choices=list(FILE_SINKS),
+                      help='write the trip to a local file, ndjson - bulk request body of the trip documents, '
+                           'npz - track points, odometry and stops arrays with the overview, works without --index',
+                      default=None)
+    argp.add_argument('--output-dir',
+                      dest='output_dir',
+                      help='directory of the --output-format files, named by the trip id',
+                      default=OUTPUT_DIR)
+    argp.add_argument('--metrics-file',
+                      dest='metrics_file',
+                      help='path of the JSON file the stage timings, counters and bulk statistics are written to',
+                      default=None)
+    argp.add_argument('--metrics-in-overview',
+                      dest='metrics_in_overview',
+                      action='store_true',
+                      help='add the stage timings, counters and bulk statistics to the trip overview as metrics')
+    argp.add_argument('--profile',
+                      action='store_true',
+                      help='run under cProfile and tracemalloc, the dumps are written to the logs directory')
+    argp.add_argument('--follow',
+                      action='store_true',
+                      help='follow the GPX file being written, ingest only the points appended since the last run')
+    argp.add_argument('--follow-interval',
+                      dest='follow_interval',
+                      type=float,
+                      help='with --follow, check the file for new points every FOLLOW_INTERVAL seconds, '
+                           'if None, a single update is run',
+                      default=None)
+    argp.add_argument('--chunked',
+                      action='store_true',
+                      help='stream the track in blocks through processing and ingest with bounded memory')
+    argp.add_argument('--block-size',
+                      dest='block_size',
+                      type=int,
+                      help='with --chunked, number of track points in one block, derived from --memory-cap-mb if None',
+                      default=None)
+    argp.add_argument('--memory-cap-mb',
+                      dest='memory_cap_mb',
+                      type=int,
+                      help='with --chunked, peak RSS cap in MB, the block size is reduced when it is exceeded',
+                      default=None)
+    argp.add_argument('--spill-dir',
+                      dest='spill_dir',
+                      help='with --chunked, directory the processed blocks are written to as memory-mappable arrays',
+                      default=None)
 
     params = argp.parse_args()
 
-    tracker = GpxTripTracker(params.mode, params.gpx_file, params.ref_file,
-                             start=params.start,
-                             end=params.end,
-                             index=params.index)
-    tracker.run()
+    sinks = [FILE_SINKS[params.output_format](params.output_dir)] if params.output_format else None
+    tracker_options = dict()
+    tracker_class = GpxTripTracker
+    if params.follow:
+        from follow import FollowTripTracker
+        tracker_class = FollowTripTracker
+    elif params.chunked:
+        from chunked import ChunkedTripTracker
+        tracker_class = ChunkedTripTracker
+        tracker_options = {'block_size': params.block_size, 'memory_cap_mb': params.memory_cap_mb,
+                           'spill_dir': params.spill_dir}
+
+    tracker = tracker_class(params.mode, params.gpx_file, params.ref_file,
+                            **tracker_options,
+                            start=params.start,
+                            end=params.end,
+                            cache=None if params.no_cache else TrackCache(max_size_mb=params.cache_size_mb),
+                            rebuild_cache=params.rebuild_cache,
+                            fast_serialization=params.fast_serialization,
+                            layout=params.layout,
+                            layout_chunk_size=params.layout_chunk_size,
+                            simplify_tolerance_m=params.simplify_tolerance_m,
+                            distance_model=params.distance_model,
+                            detect_stops=params.detect_stops,
+                            ref_library=params.ref_library,
+                            metrics_in_overview=params.metrics_in_overview,
+                            sinks=sinks,
+                            index=params.index,
+                            chunk_size=params.chunk_size,
+                            max_chunk_bytes=params.chunk_bytes,
+                            bulk_workers=params.bulk_workers,
+                            bulk_queue_size=params.bulk_queue,
+                            max_retries=params.max_retries)
+    run = tracker.run
+    if params.follow:
+        run = functools.partial(tracker.run, params.follow_interval)
+    if params.profile:
+        profile_name = f'{tracker.track_file_path.stem}-{datetime.datetime.utcnow():%Y%m%dT%H%M%S}'
+        _, tracker.counters['profile'] = run_profiled(run, profile_name)
+        tracker.log.info(f"Profile written to {tracker.counters['profile']['profile']}")
+    else:
+        run()
+    if params.metrics_file:
+        with open(params.metrics_file, 'w') as f:
+            f.write(to_json(tracker.metrics()))
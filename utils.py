@@ -1,12 +1,21 @@
+import os
+import sys
+import time
+import json
+import uuid
+import contextlib
 import pathlib
 import logging
 import datetime
-from logging.handlers import RotatingFileHandler
 import numpy as np
 
 
 FDIR = pathlib.Path(__file__).parent.resolve()
 LOG_DIR = FDIR / 'logs'
+CACHE_DIR = FDIR / 'cache'
+STATE_DIR = FDIR / 'state'
+LIBRARY_DIR = FDIR / 'reflib'
+OUTPUT_DIR = FDIR / 'output'
 
 
 def str2path(str_path):
@@ -22,6 +31,7 @@ def simple_logger(logger_name='root', log_file_name=None):
     formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
 
     if log_file_name:
+        from logging.handlers import RotatingFileHandler
         LOG_DIR.mkdir(parents=True, exist_ok=True)
         log_file = LOG_DIR / log_file_name
         file_handler = RotatingFileHandler(log_file.as_posix(), maxBytes=1048576)
@@ -29,15 +39,158 @@ def simple_logger(logger_name='root', log_file_name=None):
         file_handler.setLevel(logging.INFO)
         log.addHandler(file_handler)
 
-    stream_handler = logging.StreamHandler()
-    stream_handler.setFormatter(formatter)
-    stream_handler.setLevel(logging.INFO)
-    log.addHandler(stream_handler)
+    if not any(type(handler) is logging.StreamHandler for handler in log.handlers):
+        stream_handler = logging.StreamHandler()
+        stream_handler.setFormatter(formatter)
+        stream_handler.setLevel(logging.INFO)
+        log.addHandler(stream_handler)
 
     return log
 
 
+@contextlib.contextmanager
+def atomic_write(path, mode='wb'):
+    """
+    yields a temporary file next to path which replaces path when the block completes, so readers see
+    either the old or the complete new file, the temporary file is removed if the block fails
+    """
+    path = pathlib.Path(path)
+    tmp_path = path.with_name(f'.{path.name}.{uuid.uuid4().hex}.tmp')
+    try:
+        with open(tmp_path, mode) as f:
+            yield f
+        os.replace(tmp_path, path)
+    except BaseException:
+        try:
+            tmp_path.unlink()
+        except FileNotFoundError:
+            pass
+        raise
+
+
 def interpolate_timestamps(start_ts, end_ts, count):
-    timestamps_s = np.linspace(start_ts.timestamp(), end_ts.timestamp(), count+2)
-    timestamps = np.array([datetime.datetime.fromtimestamp(ts) for ts in timestamps_s])
+    start_ts = np.datetime64(start_ts, 'ns')
+    end_ts = np.datetime64(end_ts, 'ns')
+    if np.isnat(start_ts) or np.isnat(end_ts):
+        return np.full(count, np.datetime64('NaT'), dtype='M8[ns]')
+    span_ns = (end_ts - start_ts).astype('i8')
+    offsets_ns = np.linspace(0, span_ns, count+2).astype('i8')
+    timestamps = start_ts + offsets_ns.astype('m8[ns]')
     return timestamps[1:-1]
+
+
+def datetime64_to_datetime(timestamp):
+    """converts numpy datetime64 to datetime.datetime, NaT is converted to None"""
+    if np.isnat(timestamp):
+        return None
+    return np.datetime64(timestamp, 'us').astype(datetime.datetime)
+
+
+def current_rss_bytes():
+    """resident set size of the process, the peak RSS where the current one is not available, None on failure"""
+    try:
+        with open('/proc/self/statm', 'r') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        return peak_rss_bytes()
+
+
+def peak_rss_bytes():
+    """peak resident set size of the process, None where it is not available"""
+    try:
+        import resource
+    except ImportError:
+        return None
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return max_rss if sys.platform == 'darwin' else max_rss * 1024
+
+
+@contextlib.contextmanager
+def stage_timer(timings, stage):
+    """stores wall and CPU time [s] of the block to timings as <stage>_s and <stage>_cpu_s"""
+    tic = time.perf_counter()
+    cpu_tic = time.process_time()
+    try:
+        yield
+    finally:
+        timings[f'{stage}_s'] = time.perf_counter() - tic
+        timings[f'{stage}_cpu_s'] = time.process_time() - cpu_tic
+
+
+def run_profiled(func, name):
+    """
+    runs func under cProfile and tracemalloc, writes the profile to LOG_DIR/<name>.prof and the top allocations
+    to LOG_DIR/<name>-memory.txt, returns (result of func, {'profile', 'memory', 'tracemalloc_peak_mb'})
+    """
+    import cProfile
+    import tracemalloc
+
+    LOG_DIR.mkdir(parents=True, exist_ok=True)
+    profiler = cProfile.Profile()
+    tracemalloc.start()
+    try:
+        result = profiler.runcall(func)
+    finally:
+        snapshot = tracemalloc.take_snapshot()
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        profile_path = LOG_DIR / f'{name}.prof'
+        memory_path = LOG_DIR / f'{name}-memory.txt'
+        profiler.dump_stats(profile_path.as_posix())
+        with open(memory_path, 'w') as f:
+            f.write(f'tracemalloc peak: {peak / 2**20:.1f} MB\n')
+            f.writelines(f'{stat}\n' for stat in snapshot.statistics('lineno')[:50])
+    return result, {'profile': profile_path.as_posix(), 'memory': memory_path.as_posix(),
+                    'tracemalloc_peak_mb': peak / 2**20}
+
+
+def to_json(data):
+    """JSON of the instrumentation data, numpy scalars and datetimes are converted"""
+    def default(value):
+        if isinstance(value, np.generic):
+            return value.item()
+        if isinstance(value, (datetime.datetime, pathlib.Path)):
+            return str(value)
+        raise TypeError(f'{type(value).__name__} is not JSON serializable')
+    return json.dumps(data, default=default)
+
+
+class RunningMedian:
+    """
+    Exact median of a growing sample kept as counts of the distinct values rounded to the resolution,
+    the memory depends on the number of distinct values only, e.g. time deltas of GPS samples
+    """
+
+    def __init__(self, resolution=1e-3, values=None, counts=None):
+        self.resolution = resolution
+        self.values = np.asarray(values if values is not None else [], dtype='i8')
+        self.counts = np.asarray(counts if counts is not None else [], dtype='i8')
+
+    def __len__(self):
+        return int(np.sum(self.counts))
+
+    def update(self, samples):
+        samples = np.round(np.asarray(samples, dtype='f8') / self.resolution).astype('i8')
+        values, inverse = np.unique(np.concatenate((self.values, samples)), return_inverse=True)
+        counts = np.zeros(len(values), dtype='i8')
+        np.add.at(counts, inverse[:len(self.values)], self.counts)
+        np.add.at(counts, inverse[len(self.values):], 1)
+        self.values = values
+        self.counts = counts
+
+    def median(self):
+        """same as np.median of the rounded samples, NaN for no samples"""
+        total = len(self)
+        if not total:
+            return np.nan
+        cum_counts = np.cumsum(self.counts)
+        lower = self.values[np.searchsorted(cum_counts, (total - 1) // 2, side='right')]
+        upper = self.values[np.searchsorted(cum_counts, total // 2, side='right')]
+        return (lower + upper) / 2 * self.resolution
+
+    def to_dict(self):
+        return {'resolution': self.resolution, 'values': self.values.tolist(), 'counts': self.counts.tolist()}
+
+    @classmethod
+    def from_dict(cls, state):
+        return cls(state['resolution'], state['values'], state['counts'])